@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# Script to benchmark ItemMatrixComputer phases on synthetic courses
+#
+# For each event count, generates (or reuses) a synthetic course, then runs
+# read_attempts, compute_attempts, compute_timing and export in a fresh
+# process per engine, recording wall time per phase and peak memory.
+# Results are saved as JSON per label (by default the current git commit)
+# and compared against a baseline run to flag regressions.
+#
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from Queue import Empty
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'src'))
+import generate_synthetic
+from parallel import peak_rss_mb
+
+COURSE = 'Synthetic_IRT101_Spring2016'
+PHASES = ['read_attempts', 'compute_attempts', 'compute_timing', 'export']
+
+
+def run_phases(rawdir, engine, fmt, queue):
+    '''
+    Time each phase for one course in this process and report through queue.
+    '''
+    from compute_matrices import ItemMatrixComputer
+    raw = os.path.join(rawdir, COURSE)
+    timer = ItemMatrixComputer(raw + '_ProblemEvents.csv', raw + '_BrowseEvents.csv', raw + '_ProblemMetadata.csv',
+                               raw + '_Registrations.csv', engine=engine, root='')
+    outdir = tempfile.mkdtemp(prefix='bench-export-')
+    timings = dict()
+    error = None
+    try:
+        for phase in PHASES:
+            start = time.time()
+            if phase == 'export':
+                timer.writeSparse(outdir) if fmt == 'sparse' else timer.writeMatrices(outdir)
+            else:
+                getattr(timer, phase)()
+            timings[phase] = time.time() - start
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        shutil.rmtree(outdir, ignore_errors=True)
+    queue.put({'seconds': timings, 'peak_rss_mb': peak_rss_mb(), 'error': error})
+
+
+def measure(rawdir, engine, fmt):
+    '''
+    Run the phases in a child process so peak memory is measured per run.
+    A failed run, including a child killed before reporting (e.g. by the OOM
+    killer), comes back with an error and only the phases that finished.
+    '''
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run_phases, args=(rawdir, engine, fmt, queue))
+    proc.start()
+    result = None
+    while result is None and proc.is_alive():
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            pass
+    if result is None:
+        try:
+            result = queue.get(timeout=1)  # Put just before exiting
+        except Empty:
+            result = {'seconds': {}, 'peak_rss_mb': None, 'error': 'benchmark process exited with code %s' % proc.exitcode}
+    proc.join()
+    return result
+
+
+def git_label():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=here).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return time.strftime('%Y%m%d-%H%M%S')
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Print phases that got slower than baseline by more than tolerance, runs
+    that failed, and runs the baseline has nothing to compare with (e.g. a
+    different format or size), which count as regressions too.
+    '''
+    base = dict(((r['events'], r['engine'], r['format']), r) for r in baseline['results'])
+    regressions = 0
+    for r in results:
+        old = base.get((r['events'], r['engine'], r['format']))
+        if old is None:
+            regressions += 1
+            print("WARNING no baseline for events=%d engine=%s format=%s in %s" % (r['events'], r['engine'], r['format'], baseline['label']))
+            continue
+        if r['error']:
+            regressions += 1
+            print("REGRESSION events=%d engine=%s failed" % (r['events'], r['engine']))
+            continue
+        if old.get('error'):
+            continue
+        for phase in PHASES:
+            before, after = old['seconds'][phase], r['seconds'][phase]
+            if before > 0.05 and after > before * (1 + tolerance):
+                regressions += 1
+                print("REGRESSION %s events=%d engine=%s: %.2fs -> %.2fs (+%.0f%%)" % (phase, r['events'], r['engine'], before, after,
+                                                                                   100 * (after / before - 1)))
+        if r['peak_rss_mb'] > old['peak_rss_mb'] * (1 + tolerance):
+            regressions += 1
+            print("REGRESSION memory events=%d engine=%s: %.0f MB -> %.0f MB" % (r['events'], r['engine'], old['peak_rss_mb'], r['peak_rss_mb']))
+    print("%d regressions against %s" % (regressions, baseline['label']))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark ItemMatrixComputer phases on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='approximate event counts, up to 100000000')
+    parser.add_argument('--engines', nargs='+', default=['rows', 'columnar'], choices=['rows', 'columnar'])
+    parser.add_argument('--format', choices=['dense', 'sparse'], default='dense', help='export format to time')
+    parser.add_argument('--data-dir', default='./data/benchmarks/raws', help='where to keep generated courses between runs')
+    parser.add_argument('--results-dir', default='./data/benchmarks/results', help='where to save results')
+    parser.add_argument('--label', default=None, help='name for this run (default: git describe)')
+    parser.add_argument('--baseline', default=None, help='label of a saved run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='slowdown fraction reported as a regression')
+    args = parser.parse_args()
+
+    label = args.label or git_label()
+    results = list()
+    for events in args.sizes:
+        rawdir = os.path.join(args.data_dir, '%d' % events)
+        counts_file = os.path.join(rawdir, 'counts.json')
+        if not os.path.exists(counts_file):
+            counts = generate_synthetic.generate(rawdir, COURSE, learners=generate_synthetic.learners_for(events))
+            with open(counts_file, 'w') as f:
+                json.dump(counts, f)
+        with open(counts_file, 'r') as f:
+            counts = json.load(f)
+
+        for engine in args.engines:
+            result = measure(rawdir, engine, args.format)
+            result.update({'events': events, 'rows': counts, 'engine': engine, 'format': args.format})
+            results.append(result)
+            if result['error']:
+                print("events=%-10d engine=%-8s FAILED" % (events, engine))
+                print(result['error'])
+                continue
+            print("events=%-10d engine=%-8s %s  peak %.0f MB" % (events, engine, '  '.join('%s %.2fs' % (p, result['seconds'][p]) for p in PHASES),
+                                                               result['peak_rss_mb']))
+
+    if not os.path.isdir(args.results_dir):
+        os.makedirs(args.results_dir)
+    with open(os.path.join(args.results_dir, '%s.json' % label), 'w') as f:
+        json.dump({'label': label, 'created': time.time(), 'python': sys.version.split()[0], 'results': results}, f, indent=4)
+    print("Saved results as %s" % label)
+
+    if args.baseline:
+        with open(os.path.join(args.results_dir, '%s.json' % args.baseline), 'r') as f:
+            sys.exit(1 if compare(results, json.load(f), args.tolerance) else 0)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Script to check ActivityGrade parsing on awkward rows
+#
+# Writes a small ActivityGrade raw file with a row cut short before
+# num_attempts, a NULL attempt count, an unparseable one and a never-attempted
+# module, reads it with ActivityGradeReader and checks each parsed record and
+# the diagnostics it records.
+#
+
+from __future__ import print_function
+import math
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from activity_grades import ActivityGradeReader
+
+ROWS = [
+    ['l1', 'i1', 'problem', '1', '2', '0.5', '3', '2015-01-10 10:00:00', '2015-01-10 11:00:00'],
+    ['l1', 'i2', 'problem', '0', '2', '0', '-1', '\\N', '\\N'],
+    ['l2', 'i1', 'problem', '2', '2', '1', '\\N', '\\N', '\\N'],
+    ['l2', 'i2', 'problem', '1', '2', '0.5', 'many', '\\N', '\\N'],
+    ['l3', 'i1', 'problem', '1', '2'],  # Cut short before percent_grade and num_attempts
+]
+
+
+def same(a, b):
+    return (isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b)) or a == b
+
+
+def check(grades, learner, item, **expected):
+    '''
+    Print each field of a parsed record that isn't as expected; returns the number of mismatches.
+    '''
+    record = grades.get(learner, {}).get(item)
+    if record is None:
+        print("%s %s: missing" % (learner, item))
+        return 1
+    wrong = [(field, getattr(record, field), value) for field, value in sorted(expected.items()) if not same(getattr(record, field), value)]
+    for field, got, value in wrong:
+        print("%s %s %s: got %r, expected %r" % (learner, item, field, got, value))
+    return len(wrong)
+
+
+if __name__ == '__main__':
+
+    scratch = tempfile.mkdtemp(prefix='check-activity-grades-')
+    try:
+        path = os.path.join(scratch, 'Check_IRT101_Spring2016_ActivityGrade_headless.csv')
+        with open(path, 'w') as f:
+            for row in ROWS:
+                f.write(','.join(row) + '\n')
+
+        reader = ActivityGradeReader(path)
+        reader.read_grades()
+        nan = float('nan')
+        failures = 0
+        failures += check(reader.item_grades, 'l1', 'i1', response=1.0, grade=1.0, percent_grade=0.5, num_attempts=3.0)
+        failures += check(reader.item_grades, 'l1', 'i2', response=-1.0, grade=0.0, num_attempts=-1.0, first_submit=nan)
+        failures += check(reader.item_grades, 'l2', 'i1', response=2.0, num_attempts=nan)
+        failures += check(reader.item_grades, 'l2', 'i2', response=1.0, num_attempts=nan)
+        failures += check(reader.item_grades, 'l3', 'i1', response=1.0, grade=1.0, max_grade=2.0, percent_grade=nan, num_attempts=nan,
+                          last_submit=nan)
+        if reader.diagnostics.counts() != {'unparsed': {'num_attempts': 1}}:
+            failures += 1
+            print("diagnostics: got %r, expected one unparsed num_attempts" % reader.diagnostics.counts())
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    print("%d ActivityGrade parsing failures" % failures)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Script to check that incremental updates reproduce a full run
+#
+# Generates a synthetic course, then cuts its ProblemEvents and BrowseEvents
+# at each of several points in time to stand in for successive nightly
+# exports. Each cut is fed to process_course with incremental=True in turn,
+# and the result after the complete export is compared cell by cell, along
+# with dropped.jsonl and the summary counts, against a full run. Early cuts
+# leave items unattempted, so later updates add new item columns.
+#
+
+from __future__ import print_function
+import argparse
+import csv
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import export
+import generate_synthetic
+import ingest
+import timestamps
+
+COURSE = 'Synthetic_IRT101_Spring2016'
+
+
+def cut_raws(srcdir, dstdir, fraction):
+    '''
+    Copy a course's raw files to dstdir, keeping only the problem and browse
+    events up to the time fraction of the way through the course.
+    '''
+    if os.path.isdir(dstdir):
+        shutil.rmtree(dstdir)
+    os.makedirs(dstdir)
+    for name in os.listdir(srcdir):
+        path = os.path.join(srcdir, name)
+        if ingest.parse_name(path)[1] not in ('ProblemEvents', 'BrowseEvents') or fraction >= 1:
+            shutil.copy(path, dstdir)
+            continue
+        with ingest.open_raw(path) as (header, rows):
+            at = header.index('time')
+            rows = [row for row in rows if row]
+        times = sorted(timestamps.decode(row[at]) for row in rows)
+        cut = times[int(len(times) * fraction)]
+        with open(path, 'r') as f, open(os.path.join(dstdir, name), 'w') as out:
+            if not name.endswith('_headless.csv'):
+                out.write(f.readline())
+            csv.writer(out, quoting=csv.QUOTE_NONNUMERIC).writerows(row for row in rows if timestamps.decode(row[at]) < cut)
+
+
+def run(home, fmt, incremental):
+    '''
+    Process the course in raws under home, returning its export directory.
+    '''
+    os.environ['HOME'] = home
+    import compute_matrices
+    compute_matrices.process_course(COURSE, fmt=fmt, spill=True, incremental=incremental)
+    return os.path.join(home, 'Code/irt/data/exports', COURSE)
+
+
+def cells(outdir, fmt):
+    '''
+    Every exported cell as {field: {(learner, item): value}}, whatever the row and column order.
+    '''
+    fields = dict()
+    if fmt == 'sparse':
+        learners, items = export.read_index(os.path.join(outdir, 'learners.txt')), export.read_index(os.path.join(outdir, 'items.txt'))
+        codes = export.read_index(os.path.join(outdir, 'codes.txt'))
+        for name in os.listdir(outdir):
+            if name.endswith('.npy'):
+                field = name[:-len('.npy')]
+                triplets = export.read_sparse(outdir, field)
+                coded = triplets.dtype['value'].kind == 'i' and triplets.dtype['value'].itemsize == 2
+                fields[field] = dict(((learners[row], items[col]), codes[value] if coded else value) for row, col, value in triplets.tolist())
+    else:
+        for name in os.listdir(outdir):
+            if name.endswith('.csv') and not name.startswith('irt_'):
+                with open(os.path.join(outdir, name), 'rU') as f:
+                    reader = csv.reader(f)
+                    columns = next(reader)[1:]
+                    fields[name[:-len('.csv')]] = dict(((line[0], item), value) for line in reader
+                                                       for item, value in zip(columns, line[1:]) if value != 'NA')
+    return fields
+
+
+def summary_counts(outdir):
+    '''
+    The counts section of export_summary.txt, without the random sample of dropped records.
+    '''
+    with open(os.path.join(outdir, 'export_summary.txt'), 'r') as f:
+        return f.read().split('Dropped events (sample')[0]
+
+
+def compare(full, incremental, fmt):
+    '''
+    Print every difference between the full and incremental exports; returns the number found.
+    '''
+    differences = 0
+    expected, got = cells(full, fmt), cells(incremental, fmt)
+    for field in sorted(set(expected) | set(got)):
+        a, b = expected.get(field, {}), got.get(field, {})
+        if a != b:
+            differences += 1
+            wrong = [key for key in set(a) | set(b) if a.get(key) != b.get(key)]
+            print("%s %s: %d of %d cells differ, e.g. %s" % (fmt, field, len(wrong), len(a), sorted(wrong)[:3]))
+    with open(os.path.join(full, 'dropped.jsonl'), 'r') as f, open(os.path.join(incremental, 'dropped.jsonl'), 'r') as g:
+        if sorted(f.read().splitlines()) != sorted(g.read().splitlines()):
+            differences += 1
+            print("%s dropped.jsonl differs" % fmt)
+    if summary_counts(full) != summary_counts(incremental):
+        differences += 1
+        print("%s export_summary.txt counts differ" % fmt)
+    return differences
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check that incremental updates of a synthetic course match a full run.')
+    parser.add_argument('--cutoffs', type=float, nargs='+', default=[0.02, 0.5], help='fractions of the course time at which exports are cut')
+    parser.add_argument('--formats', nargs='+', default=['dense', 'sparse'], choices=['dense', 'sparse'])
+    parser.add_argument('--learners', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory and print its path")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='check-incremental-')
+    try:
+        rawdir = os.path.join(scratch, 'raws')
+        generate_synthetic.generate(rawdir, COURSE, learners=args.learners, seed=args.seed)
+        differences = 0
+        for fmt in args.formats:
+            full, updated = os.path.join(scratch, fmt, 'full'), os.path.join(scratch, fmt, 'incremental')
+            for home in [full, updated]:
+                os.makedirs(os.path.join(home, 'Code/irt/data/exports'))
+            cut_raws(rawdir, os.path.join(full, 'Code/irt/data/raws'), 1)
+            expected = run(full, fmt, False)
+            for fraction in sorted(args.cutoffs) + [1]:
+                cut_raws(rawdir, os.path.join(updated, 'Code/irt/data/raws'), fraction)
+                got = run(updated, fmt, True)
+                items = set(item for _, item in cells(got, fmt)['first_grade'])
+                print("%s: updated through %.0f%% of the course, %d items" % (fmt, 100 * fraction, len(items)))
+            differences += compare(expected, got, fmt)
+    finally:
+        if args.keep:
+            print("Kept %s" % scratch)
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    print("%d differences between incremental and full runs" % differences)
+    sys.exit(1 if differences else 0)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Script to check that merged dropped-record samples are uniform
+#
+# Samples streams of very different lengths with separate reservoirs, as
+# shards and incremental runs do, merges them, then offers one more stream to
+# the merged reservoir. Over many seeded trials every item of the combined
+# stream should be kept equally often; a chi-square test on the per-item
+# counts flags any bias, such as towards the shorter stream.
+#
+
+from __future__ import print_function
+import argparse
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from diagnostics import Reservoir
+
+# (reservoir size, lengths of the streams merged in turn, length offered after merging)
+CASES = [
+    (5, [10, 1000], 0),
+    (5, [1000, 10], 0),
+    (5, [3, 4], 0),
+    (5, [200, 200, 200], 0),
+    (5, [10, 1000], 500),
+]
+
+
+def kept_counts(size, lengths, after, trials, rng):
+    '''
+    How often each item of the combined stream ends up in the sample.
+    '''
+    counts = [0] * (sum(lengths) + after)
+    for _ in range(trials):
+        merged, offset = Reservoir(size, rng), 0
+        for n in lengths:
+            part = Reservoir(size, rng)
+            part.offer_many(n, lambda i, offset=offset: offset + i)
+            merged.merge(part.seen, part.items)
+            offset += n
+        merged.offer_many(after, lambda i: offset + i)
+        for item in merged.items:
+            counts[item] += 1
+    return counts
+
+
+def chi_square(counts, expected):
+    '''
+    Chi-square statistic and degrees of freedom for counts that should all equal expected.
+    '''
+    return sum((count - expected) ** 2 / expected for count in counts), len(counts) - 1
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check that merging reservoir samples keeps them uniform.')
+    parser.add_argument('--trials', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failures = 0
+    for size, lengths, after in CASES:
+        counts = kept_counts(size, lengths, after, args.trials, rng)
+        total = len(counts)
+        expected = args.trials * min(size, total) / float(total)
+        stat, df = chi_square(counts, expected)
+        limit = df + 5 * math.sqrt(2 * df)  # About five standard deviations above the mean
+        share = sum(counts[:lengths[0]]) / float(sum(counts))
+        ok = stat <= limit
+        failures += not ok
+        print("%s size %d, streams %s then %d: chi-square %.0f (limit %.0f, df %d), first stream kept %.4f of the time, expected %.4f"
+              % ('ok ' if ok else 'BIASED', size, lengths, after, stat, limit, df, share, lengths[0] / float(total)))
+
+    print("%d biased merges" % failures)
+    sys.exit(1 if failures else 0)
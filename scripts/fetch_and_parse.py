@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# Script to download raw data files and parse each course as soon as it arrives
+#
+# Lists the raw export directory on the remote host, downloads every listed
+# file for the courses in data/done_courses.txt over a bounded number of
+# connections, and hands each course to a compute_matrices worker once all of
+# its files are downloaded and verified. Downloads of later courses continue
+# while earlier ones are parsed. Takes the same parsing options as
+# compute_matrices.py. Point --url at a local HTTP server to test.
+#
+
+from __future__ import print_function
+import argparse
+import email.utils
+import httplib
+import json
+import os
+import shutil
+import socket
+import ssl
+import sys
+import time
+import urllib
+import urllib2
+import urlparse
+from HTMLParser import HTMLParser
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import compute_matrices
+import ingest
+import parallel
+
+home = os.path.expanduser("~")
+raws_dir = home + "/Code/irt/data/raws/"
+
+
+class LinkParser(HTMLParser):
+    '''
+    Collects the href of every link in a directory listing page.
+    '''
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = list()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.links.extend(value for name, value in attrs if name == 'href' and value)
+
+
+def make_opener(url, user=None, password=None, verify=True):
+    '''
+    A urllib2 opener for the export host, with basic auth if user is given.
+    '''
+    handlers = list()
+    if user:
+        passwords = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        passwords.add_password(None, url, user, password)
+        handlers.append(urllib2.HTTPBasicAuthHandler(passwords))
+    if not verify:
+        handlers.append(urllib2.HTTPSHandler(context=ssl._create_unverified_context()))
+    return urllib2.build_opener(*handlers)
+
+
+def list_raws(opener, url, timeout):
+    '''
+    Raw file names in the directory listing at url, grouped by course ID.
+    '''
+    parser = LinkParser()
+    parser.feed(opener.open(url, timeout=timeout).read())
+    files = dict()
+    for link in parser.links:
+        name = urllib.unquote(urlparse.urlparse(link).path.rstrip('/').split('/')[-1])
+        course, kind = ingest.parse_name(name)
+        if name.endswith('.csv') and kind is not None:
+            files.setdefault(course, set()).add(name)
+    return dict((course, sorted(names)) for course, names in files.items())
+
+
+def verify(path, expected):
+    '''
+    Check that a download is complete: it has the advertised length, if any,
+    and ends with a full line, as every SQL export does.
+    '''
+    size = os.path.getsize(path)
+    if expected is not None and size != int(expected):
+        raise IOError("got %d of %s bytes" % (size, expected))
+    if size:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != '\n':
+                raise IOError("file ends mid-line")
+
+
+def modified_time(headers):
+    '''
+    Epoch seconds of a response's Last-Modified header, or None if it has none.
+    '''
+    modified = headers.getheader('Last-Modified')
+    parsed = email.utils.parsedate_tz(modified) if modified else None
+    return email.utils.mktime_tz(parsed) if parsed else None
+
+
+def up_to_date(opener, url, path, timeout):
+    '''
+    Whether the copy of url at path is complete and matches the remote file's
+    length and modification time, so it needn't be downloaded again. Courses
+    still running are re-exported nightly, so the same name can have new data.
+    '''
+    if not os.path.exists(path):
+        return False
+    request = urllib2.Request(url)
+    request.get_method = lambda: 'HEAD'
+    headers = opener.open(request, timeout=timeout).info()
+    modified = modified_time(headers)
+    if modified is not None and int(os.path.getmtime(path)) != modified:
+        return False
+    try:
+        verify(path, headers.getheader('Content-Length'))
+    except IOError:
+        return False
+    return True
+
+
+def fetch(opener, url, path, timeout, retries, backoff):
+    '''
+    Download url to path, through a .part file that is only renamed into
+    place once verified, retrying on failure. A file already at path is kept
+    if it is up to date; downloads are stamped with the remote modification
+    time, as wget does, to compare against next time. Returns a timing record
+    for the file.
+    '''
+    start = time.time()
+    status, error = 'ok', None
+    for attempt in range(1, retries + 2):
+        try:
+            if up_to_date(opener, url, path, timeout):
+                status, error = 'kept', None
+                break
+            response = opener.open(url, timeout=timeout)
+            with open(path + '.part', 'wb') as out:
+                shutil.copyfileobj(response, out, 1 << 20)
+            verify(path + '.part', response.info().getheader('Content-Length'))
+            modified = modified_time(response.info())
+            if modified is not None:
+                os.utime(path + '.part', (time.time(), modified))
+            os.rename(path + '.part', path)
+            error = None
+            break
+        except (urllib2.URLError, httplib.HTTPException, socket.error, IOError) as e:
+            error = repr(e)
+        if attempt <= retries:
+            time.sleep(backoff * 2 ** (attempt - 1))
+    if error and os.path.exists(path + '.part'):
+        os.remove(path + '.part')
+    return {'file': os.path.basename(path), 'status': 'failed' if error else status, 'attempts': attempt,
+            'bytes': os.path.getsize(path) if not error else 0, 'seconds': time.time() - start, 'error': error}
+
+
+def fetched_courses(opener, url, files, outdir, connections, timeout, retries, backoff, timings, failed):
+    '''
+    Download the files of each course, course by course over up to connections
+    at once, and yield each course ID as soon as all its files are in place.
+    Per-file records are added to timings; courses with a failed download are
+    added to failed as CourseStatus records instead of being yielded.
+    '''
+    start = time.time()
+    outstanding = dict((course, len(names)) for course, names in files.items())
+    errors = dict((course, list()) for course in files)
+    tasks = [(course, name) for course in files for name in files[course]]
+
+    def download(task):
+        course, name = task
+        return course, fetch(opener, urlparse.urljoin(url, urllib.quote(name)), os.path.join(outdir, name), timeout, retries, backoff)
+
+    workers = ThreadPool(connections)
+    try:
+        for course, record in workers.imap_unordered(download, tasks):
+            timings.append(record)
+            outstanding[course] -= 1
+            if record['error']:
+                errors[course].append('%s: %s' % (record['file'], record['error']))
+            if outstanding[course]:
+                continue
+            if errors[course]:
+                failed.append(parallel.CourseStatus(course, 'download failed', time.time() - start, 0.0, '\n'.join(errors[course])))
+                print("%s: download failed" % course)
+            else:
+                print("Downloaded %d files: %s" % (len(files[course]), course))
+                yield course
+    finally:
+        workers.close()
+        workers.join()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Download raw data files and calculate IRT matrices as courses arrive.')
+    parser.add_argument('--url', default='https://%s/researcher/SU_Kindel_IRT_raws/' % os.environ.get('DS_HOST', 'localhost'),
+                        help='raw export directory listing (default from $DS_HOST)')
+    parser.add_argument('--connections', type=int, default=4, help='maximum number of downloads at once')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait on a stalled connection')
+    parser.add_argument('--retries', type=int, default=2, help='retries per failed download')
+    parser.add_argument('--backoff', type=float, default=5.0, help='seconds to wait before the first retry; doubles each time')
+    parser.add_argument('--no-check-certificate', dest='verify', action='store_false', help="don't verify the host's certificate")
+    parser.add_argument('--courses', default='./data/done_courses.txt', help='file listing one course per line')
+    parser.add_argument('--timing-log', default=home + "/Code/irt/data/fetch_raws_timing.json", help='where to write per-file timings')
+    compute_matrices.add_arguments(parser)
+    args = parser.parse_args()
+    process = compute_matrices.course_processor(parser, args)
+
+    # Find each course's raw files on the host
+    opener = make_opener(args.url, os.environ.get('DS_EXPORT_U'), os.environ.get('DS_EXPORT_P'), args.verify)
+    listing = list_raws(opener, args.url, args.timeout)
+    course_ids = compute_matrices.read_courses(args.courses)
+    files = dict((course, listing[course]) for course in course_ids if course in listing)
+    missing = [course for course in course_ids if course not in listing]
+    if not os.path.isdir(raws_dir):
+        os.makedirs(raws_dir)
+
+    # Parse each course while the next ones download
+    timings, failed = list(), [parallel.CourseStatus(course, 'not on server', 0.0, 0.0, None) for course in missing]
+    start = time.time()
+    courses = fetched_courses(opener, args.url, files, raws_dir, args.connections, args.timeout, args.retries, args.backoff,
+                              timings, failed)
+    report = parallel.run_courses(process, courses, workers=args.workers, max_memory=args.max_memory, total=len(files))
+    print("Fetched and parsed in %.1fs" % (time.time() - start))
+
+    with open(args.timing_log, 'w') as out:
+        json.dump(timings, out, indent=4)
+    parallel.write_report(report + failed, args.report)
@@ -1,6 +1,16 @@
 #!/usr/bin/env python
-import MySQLdb
+from __future__ import print_function
+import argparse
+import json
 import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 # Target files
 home = os.path.expanduser("~")
@@ -8,33 +18,143 @@ course_list = home + "/Code/irt/data/courselist.txt"
 db_auth = home + "/.ssh/mysql_user"
 exports_dir = home + "/Code/irt/sql/"
 
-# Set up database auth
-with open(db_auth, 'r') as f:
-    dbuser = f.readline().rstrip()
-    dbpass = f.readline().rstrip()
-
-# Read in export query templates
-queries = []
-for query_file in os.listdir(exports_dir):
-    with open(os.getcwd() + "/sql/" + query_file, 'r') as query:
-        queries.append(query.read())
-
-# Read in course list
-courses = []
-with open(course_list, 'r') as clist:
-    for line in clist.readlines():
-        courses.append(line.rstrip())
-
-# Connect to database
-db = MySQLdb.connect(host='127.0.0.1', port=3306, user=dbuser, passwd=dbpass)
-cursor = db.cursor()
-
-# Run loaded queries over each course
-for course in courses:
-    for query in queries:
-        outdir = course.replace('/', '_')
-        cursor.execute(query.format(outdir, course))
-
-# Close database
-cursor.close()
-db.close()
+
+class ConnectionPool(object):
+    '''
+    Bounded pool of database connections shared by worker threads. At most
+    size connections are open at once; broken connections are discarded.
+    '''
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.idle = queue.Queue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            try:
+                return self.connect()
+            except Exception:
+                self.slots.release()
+                raise
+
+    def release(self, conn, broken=False):
+        if broken:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        else:
+            self.idle.put(conn)
+        self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def mysql_connector():
+    '''
+    Connect to MySQL through the ssh tunnel with the stored credentials.
+    '''
+    import MySQLdb
+
+    # Set up database auth
+    with open(db_auth, 'r') as f:
+        dbuser = f.readline().rstrip()
+        dbpass = f.readline().rstrip()
+    return lambda: MySQLdb.connect(host='127.0.0.1', port=3306, user=dbuser, passwd=dbpass)
+
+
+def sqlite_connector(path):
+    '''
+    Connect to a local SQLite database standing in for MySQL.
+    '''
+    import sqlite3
+    return lambda: sqlite3.connect(path, check_same_thread=False)
+
+
+def run_query(pool, course, name, query, retries, backoff):
+    '''
+    Run one export query for one course, retrying on failure.
+    Queries that write INTO OUTFILE are only retried if they never reached the
+    server: MySQL won't overwrite the partial file a failed one may leave, so a
+    retry could only fail again. Returns a timing record for the query.
+    '''
+    outdir = course.replace('/', '_')
+    writes_file = 'INTO OUTFILE' in query.upper()
+    start = time.time()
+    error = None
+    for attempt in range(1, retries + 2):
+        try:
+            conn = pool.acquire()
+        except Exception as e:
+            error = repr(e)
+        else:
+            try:
+                cursor = conn.cursor()
+                cursor.execute(query.format(outdir, course))
+                cursor.close()
+                conn.commit()
+            except Exception as e:
+                pool.release(conn, broken=True)
+                error = repr(e)
+                if writes_file:
+                    break  # Run make remote-clean before running it again
+            else:
+                pool.release(conn)
+                error = None
+                break
+        if attempt <= retries:
+            time.sleep(backoff * 2 ** (attempt - 1))
+    record = {'course': course, 'query': name, 'status': 'failed' if error else 'ok',
+              'attempts': attempt, 'seconds': time.time() - start, 'error': error}
+    print("%s %s: %s (%.1fs, %d attempts)" % (course, name, record['status'], record['seconds'], attempt))
+    return record
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build raw data files on the remote host.')
+    parser.add_argument('--concurrency', type=int, default=4, help='maximum number of queries (and connections) at once')
+    parser.add_argument('--retries', type=int, default=2, help='retries per failed query')
+    parser.add_argument('--backoff', type=float, default=5.0, help='seconds to wait before the first retry; doubles each time')
+    parser.add_argument('--sql-dir', default=exports_dir, help='directory of query templates')
+    parser.add_argument('--courses', default=course_list, help='file listing one course per line')
+    parser.add_argument('--sqlite', default=None, help='run against this SQLite database instead of MySQL')
+    parser.add_argument('--timing-log', default=home + "/Code/irt/data/generate_raws_timing.json", help='where to write per-query timings')
+    args = parser.parse_args()
+
+    # Read in export query templates
+    queries = []
+    for query_file in sorted(os.listdir(args.sql_dir)):
+        with open(os.path.join(args.sql_dir, query_file), 'r') as query:
+            queries.append((query_file, query.read()))
+
+    # Read in course list
+    courses = []
+    with open(args.courses, 'r') as clist:
+        for line in clist.readlines():
+            courses.append(line.rstrip())
+
+    # Run loaded queries over each course, several at a time
+    pool = ConnectionPool(sqlite_connector(args.sqlite) if args.sqlite else mysql_connector(), args.concurrency)
+    workers = ThreadPool(args.concurrency)
+    try:
+        tasks = [(course, name, query) for course in courses for name, query in queries]
+        timings = workers.map(lambda task: run_query(pool, task[0], task[1], task[2], args.retries, args.backoff), tasks, chunksize=1)
+    finally:
+        workers.close()
+        workers.join()
+        pool.close()
+
+    failed = [t for t in timings if t['status'] != 'ok']
+    print("Ran %d queries: %d ok, %d failed" % (len(timings), len(timings) - len(failed), len(failed)))
+    with open(args.timing_log, 'w') as out:
+        json.dump(timings, out, indent=4)
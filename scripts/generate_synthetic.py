@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# Script to generate synthetic OpenEdX raw data files for testing and benchmarks
+#
+# Writes <course>_ProblemEvents.csv, <course>_BrowseEvents_headless.csv and
+# <course>_ProblemMetadata_headless.csv with the columns and header/headless
+# layout produced by the queries in sql/. BrowseEvents is time-ordered, as
+# the export is ORDER BY time, unless --unsorted is given.
+#
+
+from __future__ import print_function
+import argparse
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import extsort
+import ingest
+
+START = 1420070400  # 2015-01-01 00:00:00 UTC
+
+
+def hexid(rng, bits):
+    return '%0*x' % (bits // 4, rng.getrandbits(bits))
+
+
+def stamp(rng, t):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t)) + '.%06d' % rng.randint(0, 999999)
+
+
+def generate(outdir, course='Synthetic_IRT101_Spring2016', learners=1000, items=100, items_per_learner=20,
+             attempts=2.0, browser_ratio=0.5, dirty=0.05, invisible=0.1, days=60, unsorted=False, seed=0):
+    '''
+    Write a synthetic course's raw files to outdir. Each learner attempts
+    items_per_learner random items with a geometric number of submissions
+    (mean attempts) per item part; browser_ratio is the chance of a browser
+    event alongside each server submission. A dirty fraction of rows is
+    corrupted (bad problem IDs, ignored event types, views after attempts)
+    and an invisible fraction of items is missing from the metadata.
+    Returns row counts per file.
+    '''
+    rng = random.Random(seed)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    org, number, run = (course.split('_') + ['X', 'X', 'X'])[:3]
+    catalog = [(hexid(rng, 128), ['_%d_1' % (p + 2) for p in range(rng.choice([1, 1, 1, 2, 3]))]) for _ in range(items)]
+    visible = [item for item, _ in catalog[int(len(catalog) * invisible):]]
+    counts = {'ProblemEvents': 0, 'BrowseEvents': 0, 'ProblemMetadata': len(visible)}
+
+    # Problem definitions for the visible items
+    with open(os.path.join(outdir, '%s_ProblemMetadata_headless.csv' % course), 'w') as f:
+        wrt = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        for idx, item in enumerate(visible):
+            wrt.writerow([item, 'Problem %d' % idx, course.replace('_', '/'), '<problem/>', 'i4x://%s/%s/problem/%s' % (org, number, item),
+                          'i4x://%s/%s/vertical/v%d' % (org, number, idx), idx, 'i4x://%s/%s/sequential/s%d' % (org, number, idx // 10),
+                          idx % 10, 'i4x://%s/%s/chapter/c%d' % (org, number, idx // 50), idx // 10 % 5, idx // 50 + 1, 0,
+                          '%d.%d.%d' % (idx // 50 + 1, idx // 10 % 5, idx % 10)])
+
+    # Events, one learner at a time; browse events are sorted afterwards
+    browse_path = os.path.join(outdir, '%s_BrowseEvents_headless.csv' % course)
+    scratch = tempfile.NamedTemporaryFile('w', dir=outdir, suffix='.csv', delete=False)
+    event_id = 0
+    with open(os.path.join(outdir, '%s_ProblemEvents.csv' % course), 'w') as pf:
+        problems = csv.writer(pf, quoting=csv.QUOTE_NONNUMERIC)
+        problems.writerow(ingest.SCHEMAS['ProblemEvents'])
+        browse = csv.writer(scratch, quoting=csv.QUOTE_NONNUMERIC)
+        for _ in range(learners):
+            learner = hexid(rng, 160)
+            for item, parts in rng.sample(catalog, min(items_per_learner, len(catalog))):
+                first = START + rng.randint(0, days * 86400)
+
+                # The learner views the problem, usually before attempting it
+                view = first - rng.randint(1, 3600) if rng.random() >= dirty else first + rng.randint(1, 3600)
+                uri = '/courses/%s/%s/%s/xblock/i4x:;_;_%s;_%s;_problem;_%s/handler/xmodule_handler/problem_get' % (org, number, run, org, number, item)
+                event_id += 1
+                browse.writerow([event_id, uri, learner, stamp(rng, view), '\\N'])
+                counts['BrowseEvents'] += 1
+
+                n = 1
+                while rng.random() > 1.0 / attempts:
+                    n += 1
+                for k in range(n):
+                    t = first + k * rng.randint(10, 900)
+                    for part in parts:
+                        problem_id = 'input_i4x-%s-%s-problem-%s%s' % (org, number, item, part)
+                        event_type = 'problem_check'
+                        if rng.random() < dirty:
+                            problem_id, event_type = rng.choice([('i4x://%s/%s/problem/%s' % (org, number, item), event_type), ('\\N', event_type),
+                                                                 (problem_id, 'problem_save'), (problem_id, 'problem_check_fail')])
+                        success = rng.choice(['correct', 'incorrect'])
+                        event_id += 1
+                        problems.writerow([event_id, learner, event_type, 'server', stamp(rng, t), 'Problem', '\\N', problem_id, '\\N',
+                                           '\\N', k + 1, success, '\\N', '\\N'])
+                        counts['ProblemEvents'] += 1
+                        if rng.random() < browser_ratio:
+                            event_id += 1
+                            problems.writerow([event_id, learner, 'problem_check', 'browser', stamp(rng, t - 1), 'Problem',
+                                               'https://lagunita.stanford.edu/courses/%s/%s/%s/courseware' % (org, number, run),
+                                               problem_id, '\\N', '\\N', '\\N', '\\N', '\\N', '\\N'])
+                            counts['ProblemEvents'] += 1
+    scratch.close()
+
+    # Order browse events by time, as the export query does
+    try:
+        if unsorted:
+            os.rename(scratch.name, browse_path)
+        else:
+            header = ingest.SCHEMAS['BrowseEvents']
+            with open(scratch.name, 'rU') as f, open(browse_path, 'w') as out:
+                csv.writer(out, quoting=csv.QUOTE_NONNUMERIC).writerows(extsort.sorted_rows(header, csv.reader(f), 'time'))
+    finally:
+        if os.path.exists(scratch.name):
+            os.remove(scratch.name)
+    return counts
+
+
+def learners_for(events, items_per_learner=20, attempts=2.0, browser_ratio=0.5, parts=1.6):
+    '''
+    Number of learners needed for roughly the given number of events in total.
+    '''
+    per_learner = items_per_learner * (1 + attempts * parts * (1 + browser_ratio))
+    return max(1, int(round(events / per_learner)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Generate synthetic OpenEdX raw data files.')
+    parser.add_argument('outdir', help='directory for the raw files')
+    parser.add_argument('--course', default='Synthetic_IRT101_Spring2016', help='course ID as used in raw file names')
+    parser.add_argument('--events', type=int, default=None, help='approximate total number of events; sets --learners')
+    parser.add_argument('--learners', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--items-per-learner', type=int, default=20)
+    parser.add_argument('--attempts', type=float, default=2.0, help='mean submissions per learner-item part')
+    parser.add_argument('--browser-ratio', type=float, default=0.5, help='browser events per server submission')
+    parser.add_argument('--dirty', type=float, default=0.05, help='fraction of corrupted rows')
+    parser.add_argument('--invisible', type=float, default=0.1, help='fraction of items missing from the metadata')
+    parser.add_argument('--unsorted', action='store_true', help='leave BrowseEvents in generation order')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    learners = args.learners
+    if args.events:
+        learners = learners_for(args.events, args.items_per_learner, args.attempts, args.browser_ratio)
+    counts = generate(args.outdir, args.course, learners, args.items, args.items_per_learner, args.attempts,
+                      args.browser_ratio, args.dirty, args.invisible, unsorted=args.unsorted, seed=args.seed)
+    print("Wrote %s: %s" % (args.course, ', '.join('%d %s rows' % (n, kind) for kind, n in sorted(counts.items()))))
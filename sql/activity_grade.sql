@@ -0,0 +1,7 @@
+SELECT anon_screen_name, module_id, module_type, grade, max_grade, percent_grade, num_attempts, first_submit, last_submit
+INTO OUTFILE '/home/dataman/Data/CustomExcerpts/SU_Kindel_IRT_raws/{0}_ActivityGrade_headless.csv'
+	FIELDS ESCAPED BY '"' TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+	LINES TERMINATED BY '\n'
+FROM Edx.ActivityGrade
+WHERE course_display_name = '{1}'
+AND module_type = 'problem'
@@ -0,0 +1,158 @@
+# Response matrices from the ActivityGrade table
+#
+# ActivityGrade has one row per learner and module with the learner's final
+# grade, so for grade-only analyses it replaces parsing EdxTrackEvent-derived
+# files entirely. Rows are streamed once into hash-indexed learner -> item
+# dicts, which feed the same dense and sparse writers as ItemMatrixComputer.
+# Older exports of this table have quoted column names ("'module_id'"); these
+# are unquoted on reading.
+#
+
+from __future__ import print_function
+import json
+import os
+import shutil
+from collections import namedtuple, defaultdict
+from os.path import expanduser
+
+import diagnostics
+import export
+import ingest
+import instrument
+import timestamps
+
+ActivityGradeData = namedtuple('ActivityGradeData', ['response', 'grade', 'max_grade', 'percent_grade', 'num_attempts',
+                                                     'first_submit', 'last_submit'])
+
+
+def number(value):
+    '''
+    A grade as a float, or NaN if it is missing (\\N) or not a number.
+    '''
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return float('nan')
+
+
+def attempt_count(value):
+    '''
+    num_attempts as a float: NaN if missing (NULL, empty, or cut off a short
+    row). Raises ValueError if it isn't a whole number.
+    '''
+    if value is None or value in ('', '\\N'):
+        return float('nan')
+    return float(int(value))
+
+
+def submit_time(value):
+    '''
+    Epoch seconds for a submission time, or NaN if there was none.
+    '''
+    try:
+        return timestamps.decode(value)
+    except (ValueError, TypeError):
+        return float('nan')
+
+
+class ActivityGradeReader(object):
+    '''
+    Reads an ActivityGrade raw file into learner -> item -> ActivityGradeData.
+    Grades and attempt counts are floats (NaN if missing), so sparse output
+    stores them as numbers. Response is the grade, or -1 for modules the
+    learner never attempted (num_attempts -1). Rows for modules other than
+    problems are skipped. Attempt counts that can't be parsed are kept as
+    missing and recorded in diagnostics, sampled and spilled as for
+    ItemMatrixComputer.
+    '''
+
+    def __init__(self, path, metrics=None, sample_size=100, spill_path=None):
+        self.path = path
+        self.metrics = metrics if metrics is not None else instrument.Metrics()
+        self.diagnostics = diagnostics.Diagnostics(sample_size, spill_path)
+        self.item_grades = defaultdict(dict)
+        self.problemset = set()
+        self.skipped = defaultdict(int)
+
+    @instrument.phase('read_grades')
+    def read_grades(self):
+        rows = 0
+        for row in ingest.read_rows(self.path):
+            rows += 1
+            if row['module_type'] != 'problem':
+                self.skipped[row['module_type']] += 1
+                continue
+            try:
+                attempts = attempt_count(row['num_attempts'])
+            except ValueError:
+                self.diagnostics.record('unparsed', 'num_attempts', {"learner": row['anon_screen_name'], "item": row['module_id'],
+                                                                     "num_attempts": row['num_attempts']})
+                attempts = float('nan')
+            grade = number(row['grade'])
+            self.item_grades[row['anon_screen_name']][row['module_id']] = ActivityGradeData(
+                response=-1.0 if attempts == -1 else grade,
+                grade=grade,
+                max_grade=number(row['max_grade']),
+                percent_grade=number(row['percent_grade']),
+                num_attempts=attempts,
+                first_submit=submit_time(row['first_submit']),
+                last_submit=submit_time(row['last_submit']))
+            self.problemset.add(row['module_id'])
+        kept = rows - sum(self.skipped.values())
+        self.metrics.rows(rows, kept, rows - kept)
+
+    @instrument.phase('export')
+    def writeMatrices(self, outdir, variables=None):
+        variables = list(variables or ActivityGradeData._fields)
+        export.write_dense(outdir, self.item_grades, variables, sorted(self.problemset))
+        self.metrics.rows(len(self.problemset), len(self.problemset))
+
+    @instrument.phase('export')
+    def writeSparse(self, outdir, variables=None):
+        variables = list(variables or ActivityGradeData._fields)
+        export.write_sparse(outdir, [(self.item_grades, variables)], sorted(self.problemset))
+        self.metrics.rows(len(self.problemset), len(self.problemset))
+
+    def loadsummary(self, outfile):
+        '''
+        Output summary counts.
+        '''
+        with open(outfile, 'a') as out:
+            print("Learners: %d" % len(self.item_grades), file=out)
+            print("Problems: %d" % len(self.problemset), file=out)
+            print("Rows skipped by module type:", file=out)
+            print(json.dumps(self.skipped, indent=4), file=out)
+            print("Unparsed values by field:", file=out)
+            print(json.dumps(self.diagnostics.counts(), indent=4), file=out)
+            print("Unparsed values (sample of %d):" % self.diagnostics.sample_size, file=out)
+            print(json.dumps(self.diagnostics.sample('unparsed'), indent=4), file=out)
+        self.diagnostics.close()
+
+
+def process_course(course_id, fmt='dense', variables=None, profile=None, profiler='cprofile', sample_size=100, spill=False):
+    '''
+    Compute and export response matrices for one course from its ActivityGrade raw file.
+    If profile names a phase, it is run under profiler with output in the export directory.
+    Unparsed values are sampled up to sample_size per reason, and all written to dropped.jsonl if spill.
+    '''
+    # Ensure output directory exists
+    export_dir = expanduser("~") + "/Code/irt/data/exports/%s/" % course_id
+    try:
+        os.mkdir(export_dir, 0775)
+    except OSError:
+        shutil.rmtree(export_dir)
+        os.mkdir(export_dir, 0775)
+
+    reader = ActivityGradeReader(expanduser("~") + "/Code/irt/data/raws/%s_ActivityGrade.csv" % course_id,
+                                 instrument.Metrics(profile, profiler, export_dir), sample_size=sample_size,
+                                 spill_path=export_dir + 'dropped.jsonl' if spill else None)
+    reader.read_grades()
+    print("Loaded activity grades: %s" % course_id)
+    reader.loadsummary(export_dir + 'export_summary.txt')
+
+    if fmt == 'sparse':
+        reader.writeSparse(export_dir, variables)
+    else:
+        reader.writeMatrices(export_dir, variables)
+    print("Exported data to %s matrices: %s" % (fmt, course_id))
+    reader.metrics.write(export_dir + 'export_metrics.json', course_id=course_id, source='ActivityGrade', format=fmt)
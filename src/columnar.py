@@ -0,0 +1,288 @@
+# Columnar storage and vectorized computations for problem event data
+#
+
+import array
+from collections import defaultdict
+from itertools import izip
+
+import numpy as np
+
+import timestamps
+from interning import Vocabulary
+
+ORDINALS = ['first', 'second', 'third', 'fourth', 'fifth']
+
+# Column layouts (coded string columns, timestamp columns) for each raw file type
+PROBLEM_EVENT_COLUMNS = (['learner', 'item', 'type', 'source', 'grade', 'page', 'rdn'], ['time'])
+BROWSE_EVENT_COLUMNS = (['learner', 'item'], ['time'])
+PROBLEM_DEF_COLUMNS = (['problem_id'], [])
+
+
+class RawColumns(object):
+    '''
+    Typed columns for the rows of one raw file. String columns are stored as
+    integer codes into per-column vocabularies; timestamp columns as epoch
+    seconds. Rows are appended one at a time and frozen into NumPy arrays
+    before use, which decodes each timestamp column in bulk.
+    '''
+
+    def __init__(self, layout, vocab=None):
+        self.coded, self.timestamps = layout
+        self.vocab = vocab if vocab is not None else dict((name, Vocabulary()) for name in self.coded)
+        for name in self.coded:
+            setattr(self, name, array.array('l'))
+        for name in self.timestamps:
+            setattr(self, name, list())
+
+    def __len__(self):
+        return len(getattr(self, (self.coded + self.timestamps)[0]))
+
+    def append(self, row):
+        '''
+        Store a row given as a tuple of coded column values then raw timestamp strings.
+        '''
+        for name, value in zip(self.coded, row):
+            getattr(self, name).append(self.vocab[name].code(value))
+        for name, value in zip(self.timestamps, row[len(self.coded):]):
+            getattr(self, name).append(value)
+
+    def freeze(self):
+        '''
+        Convert the column buffers to NumPy arrays.
+        '''
+        for name in self.coded:
+            setattr(self, name, np.asarray(getattr(self, name)))
+        for name in self.timestamps:
+            setattr(self, name, timestamps.decode_column(getattr(self, name)))
+        return self
+
+    def row(self, idx):
+        '''
+        Decode row idx back to a tuple of raw values.
+        '''
+        return tuple([self.vocab[name].values[getattr(self, name)[idx]] for name in self.coded] +
+                     [getattr(self, name)[idx].item() for name in self.timestamps])
+
+    def select(self, mask):
+        '''
+        Return the rows where mask is true as new columns sharing these vocabularies.
+        '''
+        cols = RawColumns((self.coded, self.timestamps), self.vocab)
+        for name in self.coded + self.timestamps:
+            setattr(cols, name, np.asarray(getattr(self, name))[mask])
+        return cols
+
+    def is_value(self, name, value):
+        '''
+        Boolean array marking rows whose coded column name equals value.
+        '''
+        code = self.vocab[name].codes.get(value)
+        if code is None:
+            return np.zeros(len(self), dtype=bool)
+        return getattr(self, name) == code
+
+    def arrays(self):
+        '''
+        All columns by name, for serialization.
+        '''
+        return dict((name, getattr(self, name)) for name in self.coded + self.timestamps)
+
+    def vocabularies(self):
+        '''
+        All vocabularies as lists of values by column name, for serialization.
+        '''
+        return dict((name, self.vocab[name].values) for name in self.coded)
+
+    @classmethod
+    def load(cls, layout, arrays, vocabularies):
+        '''
+        Rebuild columns from the output of arrays() and vocabularies().
+        '''
+        cols = cls(layout, dict((name, Vocabulary(values)) for name, values in vocabularies.items()))
+        for name, column in arrays.items():
+            setattr(cols, name, column)
+        return cols
+
+
+class PairTable(object):
+    '''
+    Computed fields for learner-item pairs, kept as columns rather than one
+    record per pair: learner and item codes sorted by learner then item, and
+    one array per field. Vocab maps 'learner', 'item' and each coded field,
+    such as the grades, to the Vocabulary its codes index.
+    '''
+
+    def __init__(self, learner, item, fields, vocab):
+        self.learner = learner
+        self.item = item
+        self.fields = fields
+        self.vocab = vocab
+
+    def __len__(self):
+        return len(self.learner)
+
+    def select(self, mask):
+        '''
+        Return the pairs where mask is true as a new table sharing these vocabularies.
+        '''
+        return PairTable(self.learner[mask], self.item[mask], dict((name, column[mask]) for name, column in self.fields.items()), self.vocab)
+
+    def values(self, field):
+        '''
+        Column field as an object array of Python values, decoded if it is coded.
+        '''
+        if field in self.vocab:
+            return np.array(self.vocab[field].values, dtype=object)[self.fields[field]]
+        return self.fields[field].astype(object)
+
+    def records(self, record):
+        '''
+        The pairs as learner -> item -> record dicts, record being a namedtuple
+        class whose fields are all in the table.
+        '''
+        data = defaultdict(lambda: defaultdict(record))
+        learners, items = self.vocab['learner'].values, self.vocab['item'].values
+        columns = [self.values(field).tolist() for field in record._fields]
+        for learner, item, values in izip(self.learner.tolist(), self.item.tolist(), izip(*columns)):
+            data[learners[learner]][items[item]] = record._make(values)
+        return data
+
+
+def group_bounds(*keys):
+    '''
+    Given sorted key columns, return start index and length of each run of equal keys.
+    '''
+    n = len(keys[0])
+    boundary = np.ones(n, dtype=bool)
+    if n:
+        boundary[1:] = False
+        for key in keys:
+            boundary[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(boundary)
+    counts = np.diff(np.append(starts, n))
+    return starts, counts
+
+
+def count_by(cols, name, mask):
+    '''
+    Count rows under mask by decoded value of coded column name.
+    '''
+    counts = np.bincount(getattr(cols, name)[mask], minlength=len(cols.vocab[name]))
+    return dict((cols.vocab[name].values[code], int(n)) for code, n in enumerate(counts) if n)
+
+
+def compute_attempts(cols):
+    '''
+    Compute ItemAttemptData fields for every learner-item pair with server events.
+    Returns learner codes, item codes, and a dict of field name -> column.
+    '''
+    server = ~cols.is_value('source', 'browser')
+    learner = cols.learner[server]
+    item = cols.item[server]
+    grade = cols.grade[server]
+    times = cols.time[server]
+
+    # Sort by learner, item, then time; lexsort is stable, so ties keep file order
+    order = np.lexsort((times, item, learner))
+    learner, item, grade, times = learner[order], item[order], grade[order], times[order]
+
+    starts, counts = group_bounds(learner, item)
+    last = starts + counts - 1
+
+    # nth attempt falls back to the last attempt when there were fewer than n
+    fields = dict()
+    for n, ordinal in enumerate(ORDINALS):
+        idx = starts + np.minimum(n, counts - 1)
+        fields['%s_attempt' % ordinal] = times[idx]
+        fields['%s_grade' % ordinal] = grade[idx]
+    fields['last_attempt'] = times[last]
+    fields['last_grade'] = grade[last]
+    fields['n_attempts'] = counts
+    fields['time_spent_attempting'] = times[last] - times[starts]
+    return learner[starts], item[starts], fields
+
+
+def timing_table(attempts, pairs, first_view):
+    '''
+    ItemTimingData fields for the pairs at indices pairs of the attempts table, given each one's first view.
+    '''
+    pairs, first_view = np.asarray(pairs, dtype=np.int64), np.asarray(first_view, dtype=np.float64)
+    fields = {'first_view': first_view}
+    for ordinal in ORDINALS + ['last']:
+        fields['time_to_%s_attempt' % ordinal] = attempts.fields['%s_attempt' % ordinal][pairs] - first_view
+    return PairTable(attempts.learner[pairs], attempts.item[pairs], fields,
+                     {'learner': attempts.vocab['learner'], 'item': attempts.vocab['item']})
+
+
+def compute_timing(attempts, learner, uri, time, matches):
+    '''
+    Compute ItemTimingData fields from browse views, as firstViews does from
+    rows in time order. Learner holds each view's attempts learner code (-1
+    for learners with no attempts) and uri its browse URI code; matches lists
+    (URI code, attempts item code) pairs, sorted by URI, for the items each URI
+    refers to. Only a learner's first view of each URI counts. A pair is
+    timing-negative if a counted view comes after its first attempt; otherwise
+    its latest counted view is its first view. Returns the timing table and a
+    mask of the timing-negative pairs in attempts, which keep the timing of any
+    counted views before the first attempt, as in firstViews.
+    '''
+    # Each learner's first view of each URI
+    seen = learner >= 0
+    learner, uri, time = learner[seen], uri[seen], time[seen]
+    order = np.lexsort((time, uri, learner))
+    starts, _ = group_bounds(learner[order], uri[order])
+    first = order[starts]
+    learner, uri, time = learner[first], uri[first], time[first]
+
+    # One row per view and attempt item its URI refers to
+    uris, items = np.array(matches, dtype=np.int64).reshape(-1, 2).T
+    lo, hi = np.searchsorted(uris, uri, 'left'), np.searchsorted(uris, uri, 'right')
+    counts = hi - lo
+    view = np.repeat(np.arange(len(uri)), counts)
+    match = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    learner, item, time = learner[view], items[match], time[view]
+
+    # Join to the attempted pairs through their sorted pair keys
+    keys = attempts.learner.astype(np.int64) << 32 | attempts.item
+    wanted = learner.astype(np.int64) << 32 | item
+    pos = np.searchsorted(keys, wanted)
+    hit = np.append(keys, -1)[pos] == wanted
+    pos, time = pos[hit], time[hit]
+
+    negative = (attempts.fields['first_attempt'][pos] - time < 0) | (attempts.fields['last_attempt'][pos] - time < 0)
+    dropped = np.zeros(len(attempts), dtype=bool)
+    dropped[pos[negative]] = True
+
+    # Later views are negative once any is, so the latest of the rest is the last one firstViews keeps
+    pos, time = pos[~negative], time[~negative]
+    order = np.lexsort((time, pos))
+    starts, counts = group_bounds(pos[order])
+    last = order[starts + counts - 1]
+    return timing_table(attempts, pos[last], time[last]), dropped
+
+
+def recode(source, target):
+    '''
+    Array mapping each code of Vocabulary source to the code of the same value in Vocabulary target, or -1.
+    '''
+    return np.array([target.codes.get(value, -1) for value in source.values], dtype=np.int64)
+
+
+def item_metadata(cols):
+    '''
+    Return a dict of item code -> (page code, rdn code) from each item's earliest browser event.
+    '''
+    browser = cols.is_value('source', 'browser')
+    item = cols.item[browser]
+    times = cols.time[browser]
+    order = np.lexsort((times, item))
+    starts, _ = group_bounds(item[order])
+    first = order[starts]
+    return dict(zip(item[first].tolist(), zip(cols.page[browser][first].tolist(), cols.rdn[browser][first].tolist())))
+
+
+def time_order(cols):
+    '''
+    Row indices in ascending time order, keeping file order among ties.
+    '''
+    return np.argsort(cols.time, kind='mergesort')
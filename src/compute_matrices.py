@@ -5,17 +5,28 @@
 #
 
 from __future__ import print_function
+import argparse
 import csv
 import json
-import time
-import datetime
 import random
-import math
 import os
 import shutil
+import tempfile
 from os.path import expanduser
-from itertools import izip
 from collections import namedtuple, defaultdict
+from functools import partial
+
+import activity_grades
+import export
+import diagnostics
+import extsort
+import ingest
+import instrument
+import interning
+import shards
+import timestamps
+import parallel
+import pipeline
 
 
 Event = namedtuple('Event', ['learner', 'item', 'type', 'source', 'grade', 'page', 'rdn', 'time'])
@@ -23,6 +34,13 @@ ItemAttemptData = namedtuple('ItemAttemptData', ['first_attempt', 'second_attemp
                                                  'second_grade', 'third_grade', 'fourth_grade', 'fifth_grade', 'time_spent_attempting'])
 ItemTimingData = namedtuple('ItemTimingData', ['first_view', 'time_to_first_attempt', 'time_to_second_attempt', 'time_to_third_attempt', 'time_to_fourth_attempt', 'time_to_fifth_attempt', 'time_to_last_attempt'])
 
+# Events that aren't valid problem submissions
+IGNORED_EVENTS = ['problem_reset', 'problem_save', 'problem_check_fail']
+
+# Progress messages for the matrix phases
+PHASE_MESSAGES = {'read_attempts': "Loaded item attempt data", 'compute_attempts': "Computed item attempt data",
+                  'compute_timing': "Computed item timing data"}
+
 
 class ItemMatrixComputer(object):
     '''
@@ -30,22 +48,46 @@ class ItemMatrixComputer(object):
     analysis using IRT models. Depends on table Edx.EdxTrackEvent. Will work if
     fed the entire EdxTrackEvent table for a single course for both args, but will
     run *very* slowly if so. See directory sql/ for queries to pull base tables.
+    For inputs too large to hold in memory, see process_course_sharded.
     '''
 
-    def __init__(self, problem_events_dir, browse_events_dir, problem_defs_dir, registrations_dir):
+    def __init__(self, problem_events_dir, browse_events_dir, problem_defs_dir, registrations_dir, engine='rows', sort_run_size=500000,
+                 cache_dir=None, cache_size=None, sample_size=100, spill_path=None, root=None, metrics=None):
         '''
         Constructor for ItemMatrixComputer.
+        Engine 'rows' keeps each learner-item pair's submissions in a compact
+        interning.AttemptLog; engine 'columnar' keeps integer-coded NumPy
+        columns and computes attempts with vectorized ops.
+        Browse events are expected in time order, as the SQL export writes them;
+        if they turn out not to be, they are sorted on disk in runs of
+        sort_run_size rows. If cache_dir is given, decoded raw files are cached
+        there (up to cache_size bytes) and memory-mapped on later runs; the rows
+        engine still re-reads ProblemEvents. Dropped data is counted, sampled
+        up to sample_size records per reason, and spilled to spill_path as JSONL
+        if given. Paths are relative to root, by default the home directory.
+        Each phase is timed into metrics, an instrument.Metrics.
         '''
         # Paths to external data
-        home = expanduser('~')
+        home = expanduser('~') if root is None else root
         self.problem_events = home + problem_events_dir
         self.browse_events = home + browse_events_dir
         self.problem_defs = home + problem_defs_dir
         self.reg_events = home + registrations_dir
+        self.sort_run_size = sort_run_size
+        self.browse_ordered = True  # Until browse_rows finds otherwise
+
+        # Decoded raw file cache
+        self.cache = None
+        if cache_dir is not None:
+            from rawcache import RawCache
+            self.cache = RawCache(cache_dir, cache_size)
 
         # Parsed course event data
-        self.events = defaultdict(lambda: defaultdict(list))
-        self.responses = defaultdict(lambda: defaultdict(list))
+        self.engine = engine
+        self.columns = None
+        self.vocab = dict((name, interning.Vocabulary()) for name in ['learner', 'item', 'grade', 'page', 'rdn'])
+        self.responses = dict()  # pair_key(learner code, item code) -> AttemptLog
+        self.first_browser = dict()  # item code -> (time, page code, rdn code) of earliest browser event
         self.problem_meta = defaultdict(tuple)
 
         # Aggregate descriptive statistics
@@ -54,29 +96,147 @@ class ItemMatrixComputer(object):
         self.ignored = defaultdict(int)
 
         # Indicators for item visibility
-        self.ran_in_course = list()
+        self.ran_in_course = set()
+
+        # Item URI index: base problem ID -> attempt URIs, browse URI -> attempt URIs
+        self.item_uris = defaultdict(set)
+        self.browse_uris = dict()
 
-        # Computed data
+        # Computed data, as records per pair or, for the columnar engine, columnar.PairTables
         self.item_attempts = defaultdict(lambda: defaultdict(ItemAttemptData))
         self.item_timing = defaultdict(lambda: defaultdict(ItemTimingData))
+        self.attempt_table = None
+        self.timing_table = None
 
         # Missing or bad data
-        self.dropped = list()
-        self.negative = list()
+        self.diagnostics = diagnostics.Diagnostics(sample_size, spill_path)
+
+        # Per-phase timing and throughput
+        self.metrics = metrics if metrics is not None else instrument.Metrics()
+
+        # Learner covariates from the other raw files, loaded on demand
+        self.covariates = pipeline.Covariates(self.rawPath)
 
         # Unique problem IDs
         self.problemset = set()
 
 
+    def rawPath(self, kind):
+        '''
+        Path to this course's raw file of another kind, alongside its problem events.
+        '''
+        if kind == 'Registrations':
+            return self.reg_events
+        course, _ = ingest.parse_name(self.problem_events)
+        return os.path.join(os.path.dirname(self.problem_events), '%s_%s.csv' % (course, kind))
+
+
+    def makePipeline(self, timing_filter=True):
+        '''
+        A pipeline.Pipeline over this computer's phases and learner covariates.
+        Attempt variables depend on compute_timing, which drops timing-negative
+        learner-item pairs; with timing_filter=False they skip it, so BrowseEvents
+        is not read but those pairs are kept.
+        '''
+        phases = {'read_attempts': ([], self.read_attempts),
+                  'compute_attempts': (['read_attempts'], self.compute_attempts),
+                  'compute_timing': (['compute_attempts'], self.compute_timing)}
+        produces = dict((v, 'compute_timing' if timing_filter else 'compute_attempts') for v in ItemAttemptData._fields)
+        produces.update((v, 'compute_timing') for v in ItemTimingData._fields)
+        for name, (kind, _, _) in pipeline.COVARIATES.items():
+            phases['load_%s' % kind] = ([], partial(self.loadCovariates, kind))
+            produces[name] = 'load_%s' % kind
+        return pipeline.Pipeline(phases, produces)
+
+
+    def loadCovariates(self, kind):
+        '''
+        Read the learner covariates that come from one raw file kind.
+        '''
+        with self.metrics.phase('load_%s' % kind):
+            self.covariates.load(kind)
+
+
     def loadProblemDefs(self):
         '''
         Read problem definitions to determine if problem was visible in course.
         '''
-        with open(self.problem_defs, 'rU') as f:
-            problems = csv.DictReader(f)
-            for item in problems:
-                if (item['chapter_idx'] > 0):  # and (~item['staff_only']):
-                    self.ran_in_course.append(item['problem_id'])
+        if self.cache is not None:
+            import columnar
+            cols = self.rawColumns(self.problem_defs, 'ProblemMetadata', columnar.PROBLEM_DEF_COLUMNS,
+                                   lambda convert: self.parseProblemDefs())
+            self.ran_in_course.update(cols.vocab['problem_id'].values)
+        else:
+            for problem_id, in self.parseProblemDefs():
+                self.ran_in_course.add(problem_id)
+
+
+    @staticmethod
+    def readCSV(path):
+        '''
+        Generate the rows of a raw file as dicts, reading headless exports
+        directly and applying any per-course ID fixups.
+        '''
+        return ingest.read_rows(path)
+
+
+    def parseProblemDefs(self):
+        '''
+        Generate (problem_id,) for each problem definition that ran in the course.
+        '''
+        for item in self.readCSV(self.problem_defs):
+            if (item['chapter_idx'] > 0):  # and (~item['staff_only']):
+                yield (item['problem_id'],)
+
+
+    def parseProblemEvents(self, convert=None, rows=None):
+        '''
+        Generate an Event for every row of the problem events file, or of rows if given.
+        Times are decoded with convert, by default convertTime.
+        '''
+        convert = convert or self.convertTime
+        for row in rows if rows is not None else self.readCSV(self.problem_events):
+            yield Event(learner=row['anon_screen_name'],
+                        item=self.extractProblemID(row['problem_id']),
+                        type=row['event_type'],
+                        source=row['event_source'],
+                        grade=row['success'],
+                        page=row['page'],
+                        rdn=row['resource_display_name'],
+                        time=convert(row['time']))
+
+
+    def parseBrowseEvents(self, rows, convert=None):
+        '''
+        Generate (learner, item URI, time) for each browse event row.
+        Times are decoded with convert, by default convertTime.
+        '''
+        convert = convert or self.convertTime
+        for row in rows:
+            item = row['event_type'].split('/')[6].replace(";_", "-").replace(":--", "-")
+            yield row['anon_screen_name'], item, convert(row['time'])
+
+
+    def rawColumns(self, path, kind, layout, parse):
+        '''
+        Return typed columns for a raw file, from the cache if possible;
+        otherwise decode the rows generated by parse(convert) and cache them.
+        Timestamps are passed through raw and decoded a column at a time.
+        '''
+        from columnar import RawColumns
+        source, variant = ingest.locate(path), repr(ingest.fixups(path))
+        if self.cache is not None:
+            key = self.cache.key(source, kind, variant)  # Hashes the whole file, so only once
+            cached = self.cache.load(source, kind, variant, key=key)
+            if cached is not None:
+                return RawColumns.load(layout, *cached)
+        cols = RawColumns(layout)
+        for row in parse(str):
+            cols.append(row)
+        cols.freeze()
+        if self.cache is not None:
+            self.cache.store(source, kind, cols.arrays(), cols.vocabularies(), variant, key=key)
+        return cols
 
 
     @staticmethod
@@ -95,153 +255,451 @@ class ItemMatrixComputer(object):
     @staticmethod
     def convertTime(timestamp):
         '''
-        Given an event timestamp, return Unix epoch time.
+        Given an event timestamp, return Unix epoch time (UTC, whole seconds).
         '''
-        return (datetime.datetime.fromtimestamp(time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S.%f'))) - datetime.datetime(1970, 1, 1)).total_seconds()
+        return timestamps.decode(timestamp)
 
 
-    def read_attempts(self):
+    def isVisible(self, problemID):
         '''
-        Read data from problem events into computer.
+        Whether a problem ID carries problem information for an item that was visible in the course.
+        '''
+        return len(problemID) >= 3 and problemID[-36:-4] in self.ran_in_course
+
+
+    def valid_events(self, rows=None):
+        '''
+        Generate valid, visible problem events (from rows, if given) and keep count of the rest.
         '''
         self.loadProblemDefs()
-        with open(self.problem_events, 'rU') as p:
-            prob_events = csv.DictReader(p)
-            for row in prob_events:
-
-                # Parse problem URI
-                problemID = self.extractProblemID(row['problem_id'])
-
-                # Read data to namedtuple
-                event = Event(learner=row['anon_screen_name'],
-                              item=problemID,
-                              type=row['event_type'],
-                              source=row['event_source'],
-                              grade=row['success'],
-                              page=row['page'],
-                              rdn=row['resource_display_name'],
-                              time=self.convertTime(row['time']))
-
-                # Skip if we didn't get any problemID information (might be '\N' or empty string)
-                # Also skip if problemID was not visible in the course.
-                item_base_id = problemID[-36:-4]
-                if len(problemID) < 3 or item_base_id not in self.ran_in_course:
-                    self.missing[event.type] += 1  # keep track of what we're losing
-                    self.dropped.append(event)
-                    continue
+        for event in self.parseProblemEvents(rows=rows):
+            problemID = event.item
 
-                # Drop events that aren't valid problem submissions
-                if event.type in ['problem_reset', 'problem_save', 'problem_check_fail']:
-                    self.ignored[event.type] += 1
-                    continue
+            # Skip if we didn't get any problemID information (might be '\N' or empty string)
+            # Also skip if problemID was not visible in the course.
+            if not self.isVisible(problemID):
+                self.missing[event.type] += 1  # keep track of what we're losing
+                self.diagnostics.record('missing', event.type, event)
+                continue
 
-                # Otherwise, store aggregate count data
-                self.aggregate[event.type] += 1
+            # Drop events that aren't valid problem submissions
+            if event.type in IGNORED_EVENTS:
+                self.ignored[event.type] += 1
+                continue
 
-                # Log problem ID in problem set
-                self.problemset.add(problemID)
+            # Otherwise, store aggregate count data
+            self.aggregate[event.type] += 1
 
-                # Store event data
+            # Log problem ID in problem set
+            self.problemset.add(problemID)
+            self.item_uris[problemID[-36:-4]].add(problemID)
+
+            yield event
+
+
+    @instrument.phase('read_attempts')
+    def read_attempts(self):
+        '''
+        Read data from problem events into computer.
+        '''
+        if self.engine == 'columnar':
+            self.read_attempts_columnar()
+        else:
+            vocab = self.vocab
+            for event in self.valid_events():
+                item = vocab['item'].code(event.item)
                 if event.source == 'browser':
-                    self.events[event.learner][problemID].append(event)
+                    # Browser events only supply item metadata, so keep just the earliest
+                    first = self.first_browser.get(item)
+                    if first is None or event.time < first[0]:
+                        self.first_browser[item] = (event.time, vocab['page'].code(event.page), vocab['rdn'].code(event.rdn))
                 else:
-                    self.responses[event.learner][problemID].append(event)
+                    # Store submission data
+                    key = interning.pair_key(vocab['learner'].code(event.learner), item)
+                    log = self.responses.get(key)
+                    if log is None:
+                        log = self.responses[key] = interning.AttemptLog()
+                    log.add(event.time, vocab['grade'].code(event.grade))
+
+        kept = sum(self.aggregate.values())
+        dropped = sum(self.missing.values()) + sum(self.ignored.values())
+        self.metrics.rows(kept + dropped, kept, dropped)
+
+
+    def read_attempts_columnar(self):
+        '''
+        Read data from problem events into integer-coded columns, applying the
+        same filters as valid_events to whole columns at once.
+        '''
+        import columnar
+        raw = self.rawColumns(self.problem_events, 'ProblemEvents', columnar.PROBLEM_EVENT_COLUMNS, self.parseProblemEvents)
+        self.loadProblemDefs()
+
+        # Skip events without problemID information or for problems not visible in the course
+        visible = raw.vocab['item'].mask(self.isVisible)[raw.item]
+        for etype, n in columnar.count_by(raw, 'type', ~visible).items():
+            self.missing[etype] += n  # keep track of what we're losing
+        dropped = (~visible).nonzero()[0]
+        self.diagnostics.record_many('missing', columnar.count_by(raw, 'type', ~visible), lambda i: Event(*raw.row(dropped[i])))
+
+        # Drop events that aren't valid problem submissions
+        ignored = raw.vocab['type'].mask(lambda t: t in IGNORED_EVENTS)[raw.type] & visible
+        for etype, n in columnar.count_by(raw, 'type', ignored).items():
+            self.ignored[etype] += n
 
+        # Keep the rest, logging aggregate counts and problem IDs
+        kept = visible & ~ignored
+        for etype, n in columnar.count_by(raw, 'type', kept).items():
+            self.aggregate[etype] += n
+        for problemID in columnar.count_by(raw, 'item', kept):
+            self.problemset.add(problemID)
+            self.item_uris[problemID[-36:-4]].add(problemID)
+        self.columns = raw.select(kept)
 
+
+    @instrument.phase('compute_attempts')
     def compute_attempts(self):
         '''
         Run computations over stored data on item attempts.
         '''
-        for learner in self.responses:
-            for item in self.responses[learner]:
-                # Sort events by timestamp
-                event_list = sorted(self.events[learner][item], key=lambda e: e.time)
-                response_list = sorted(self.responses[learner][item], key=lambda e: e.time)
-
-                # Break out sorted data into corresponding lists
-                try:
-                    _, _, types, sources, _, pages, rdns, _ = [list(elem) for elem in zip(*event_list)]
-                except:
-                    pages = ['none']
-                    rdns = ['none']  # No browser events found
-                try:
-                    _, _, _, _, grades, _, _, times = [list(elem) for elem in zip(*response_list)]
-                except:
-                    continue  # No server events found
-
-                # Catch item metadata
-                self.problem_meta[item] = [pages[0], rdns[0]]
-
-                # Store data on item attempts
-                calcs = ItemAttemptData(first_attempt=times[0],
-                                        second_attempt=times[1] if len(times) > 1 else times[-1],
-                                        third_attempt=times[2] if len(times) > 2 else times[-1],
-                                        fourth_attempt=times[3] if len(times) > 3 else times[-1],
-                                        fifth_attempt=times[4] if len(times) > 4 else times[-1],
-                                        last_attempt=times[-1],
-                                        n_attempts=len(times),
-                                        first_grade=grades[0],
-                                        second_grade=grades[1] if len(grades) > 1 else grades[-1],
-                                        third_grade=grades[2] if len(grades) > 2 else grades[-1],
-                                        fourth_grade=grades[3] if len(grades) > 3 else grades[-1],
-                                        fifth_grade=grades[4] if len(grades) > 4 else grades[-1],
-                                        last_grade=grades[-1],
-                                        time_spent_attempting=times[-1] - times[0])
-                self.item_attempts[learner][item] = calcs
+        if self.engine == 'columnar':
+            self.compute_attempts_columnar()
+        else:
+            self.compute_attempts_rows()
+        self.metrics.rows(sum(self.aggregate.values()), self.pairCounts()[0])
+
+
+    @staticmethod
+    def attemptData(times, grades):
+        '''
+        ItemAttemptData for one learner-item pair from its submission times and grades, in time order.
+        '''
+        return ItemAttemptData(first_attempt=times[0],
+                               second_attempt=times[1] if len(times) > 1 else times[-1],
+                               third_attempt=times[2] if len(times) > 2 else times[-1],
+                               fourth_attempt=times[3] if len(times) > 3 else times[-1],
+                               fifth_attempt=times[4] if len(times) > 4 else times[-1],
+                               last_attempt=times[-1],
+                               n_attempts=len(times),
+                               first_grade=grades[0],
+                               second_grade=grades[1] if len(grades) > 1 else grades[-1],
+                               third_grade=grades[2] if len(grades) > 2 else grades[-1],
+                               fourth_grade=grades[3] if len(grades) > 3 else grades[-1],
+                               fifth_grade=grades[4] if len(grades) > 4 else grades[-1],
+                               last_grade=grades[-1],
+                               time_spent_attempting=times[-1] - times[0])
+
+
+    @staticmethod
+    def timingData(attempts, first_view):
+        '''
+        ItemTimingData for one learner-item pair from its ItemAttemptData and the learner's first view of the item.
+        '''
+        return ItemTimingData(first_view=first_view,
+                              time_to_first_attempt=attempts.first_attempt - first_view,
+                              time_to_second_attempt=attempts.second_attempt - first_view,
+                              time_to_third_attempt=attempts.third_attempt - first_view,
+                              time_to_fourth_attempt=attempts.fourth_attempt - first_view,
+                              time_to_fifth_attempt=attempts.fifth_attempt - first_view,
+                              time_to_last_attempt=attempts.last_attempt - first_view)
+
+
+    def compute_attempts_rows(self):
+        '''
+        Run computations over each learner-item pair's stored submissions.
+        '''
+        learners, items = self.vocab['learner'].values, self.vocab['item'].values
+        grade_values = self.vocab['grade'].values
+        for key, log in self.responses.iteritems():
+            learner_code, item_code = interning.unpack_key(key)
+            learner, item = learners[learner_code], items[item_code]
+
+            # Sort submissions by timestamp
+            times, grades = log.ordered()
+            grades = [grade_values[code] for code in grades]
+            # Store data on item attempts
+            calcs = self.attemptData(times, grades)
+            self.item_attempts[learner][item] = calcs
+
+        # Catch item metadata from each item's earliest browser event
+        for item in self.problemset:
+            first = self.first_browser.get(self.vocab['item'].codes.get(item))
+            self.problem_meta[item] = [self.vocab['page'].values[first[1]], self.vocab['rdn'].values[first[2]]] if first else ['none', 'none']
+
+
+    def compute_attempts_columnar(self):
+        '''
+        Run vectorized computations over columnar data on item attempts,
+        keeping the results as columns with grades as codes.
+        '''
+        import columnar
+        cols = self.columns
+        learners, items, fields = columnar.compute_attempts(cols)
+
+        # Store data on item attempts
+        vocab = {'learner': cols.vocab['learner'], 'item': cols.vocab['item']}
+        vocab.update((field, cols.vocab['grade']) for field in ItemAttemptData._fields if field.endswith('_grade'))
+        self.attempt_table = columnar.PairTable(learners, items, fields, vocab)
+        self.timing_table = columnar.timing_table(self.attempt_table, [], [])
+
+        # Catch item metadata from each item's earliest browser event
+        meta = columnar.item_metadata(cols)
+        for item in self.problemset:
+            page, rdn = meta.get(cols.vocab['item'].codes[item], (None, None))
+            self.problem_meta[item] = [cols.vocab['page'].values[page], cols.vocab['rdn'].values[rdn]] if page is not None else ['none', 'none']
+
+
+    def matchItemURIs(self, item):
+        '''
+        Return all attempt URIs that a browse event URI refers to.
+        Resolved once per browse URI from the index built while reading attempts.
+        '''
+        try:
+            return self.browse_uris[item]
+        except KeyError:
+            uris = tuple(iuri for iuri in self.item_uris.get(item[-32:], ()) if iuri.find(item) != -1)
+            self.browse_uris[item] = uris
+            return uris
+
+
+    def browse_rows(self):
+        '''
+        Stream browse events in time order. The SQL export is already sorted, so
+        normally rows are read straight through, checking the order on the way;
+        once a row is found out of order, this raises extsort.Unsorted and later
+        calls sort the file on disk.
+        '''
+        with ingest.open_raw(self.browse_events) as (header, rows):
+            if self.browse_ordered:
+                rows = extsort.ordered_rows(header, rows, 'time')
+            else:
+                rows = extsort.sorted_rows(header, rows, 'time', self.sort_run_size)
+            try:
+                for row in rows:
+                    if row:
+                        yield dict(zip(header, row))
+            except extsort.Unsorted:
+                self.browse_ordered = False
+                raise
+
+
+    def browse_views(self):
+        '''
+        Generate (learner, item URI, time) for browse events in time order.
+        '''
+        if self.cache is not None:
+            import columnar
+            cols = self.rawColumns(self.browse_events, 'BrowseEvents', columnar.BROWSE_EVENT_COLUMNS,
+                                   lambda convert: self.parseBrowseEvents(self.readCSV(self.browse_events), convert))
+            for idx in columnar.time_order(cols):
+                yield cols.row(idx)
+        else:
+            for view in self.parseBrowseEvents(self.browse_rows()):
+                yield view
 
 
+    @instrument.phase('compute_timing')
     def compute_timing(self):
         '''
         Run computations over stored data on item attempts.
         '''
-        with open(self.browse_events, 'rU') as f:
-            events = sorted(csv.DictReader(f), key=lambda e: e['time'])
-            seen = defaultdict(list)
-            for row in events:
-                # Retrieve data from row
-                learner = row['anon_screen_name']
-                etype = row['event_type']
-                item = etype.split('/')[6].replace(";_", "-").replace(":--", "-")
-                timing = self.convertTime(row['time'])
-
-                item_base_id = item[-32:]
-                if item_base_id not in self.ran_in_course:
-                    continue  # Skip if item was not actually visible in the course
-
-                # Since we retrieve browse_events pre-sorted, assume first hit for this learner is earliest view
-                if item not in seen[learner]:
-                    # Apply data to all item URIs that match the one we just found
-                    for iuri in filter(lambda i: i.find(item) != -1, self.item_attempts[learner].keys()):
-                        calcs = ItemTimingData(first_view=timing,
-                                               time_to_first_attempt=self.item_attempts[learner][iuri].first_attempt - timing,
-                                               time_to_second_attempt=self.item_attempts[learner][iuri].second_attempt - timing,
-                                               time_to_third_attempt=self.item_attempts[learner][iuri].third_attempt - timing,
-                                               time_to_fourth_attempt=self.item_attempts[learner][iuri].fourth_attempt - timing,
-                                               time_to_fifth_attempt=self.item_attempts[learner][iuri].fifth_attempt - timing,
-                                               time_to_last_attempt=self.item_attempts[learner][iuri].last_attempt - timing)
-                        if calcs.time_to_first_attempt < 0 or calcs.time_to_last_attempt < 0:
-                            self.negative.append({"item": iuri, "learner": learner})  # Log this learner-item pair as timing-negative and continue without adding to final matrix
-                            del self.item_attempts[learner][iuri]  # Drop data for this learner-item pair
-                        else:
-                            self.item_timing[learner][iuri] = calcs
-                        seen[learner].append(item)  # Keep track of which items we've calculated first views for
-
-        for learner in self.item_timing.keys():
-            if learner not in self.item_attempts.keys():
-                self.dropped.append(self.item_attempts[learner])
-                del self.item_attempts[learner]  # if we got no timing data, log it and drop this learner
+        if self.engine == 'columnar':
+            self.compute_timing_columnar()
+        else:
+            self.compute_timing_rows()
+
+
+    def compute_timing_rows(self):
+        '''
+        Compute timing data from streamed browse views, dropping timing-negative pairs.
+        '''
+        try:
+            views, timings, negative = self.firstViews(self.browse_views())
+        except extsort.Unsorted:
+            views, timings, negative = self.firstViews(self.browse_views())  # Now sorted on disk
+
+        for learner, iuri in negative:
+            self.diagnostics.record('negative', 'timing', {"item": iuri, "learner": learner})  # Log this learner-item pair as timing-negative and continue without adding to final matrix
+            del self.item_attempts[learner][iuri]  # Drop data for this learner-item pair
+        for learner, calcs in timings.items():
+            self.item_timing[learner].update(calcs)
+        self.metrics.rows(views, self.cells(self.item_timing), len(negative))
+
+
+    def compute_timing_columnar(self):
+        '''
+        Compute timing data from browse event columns with vectorized ops,
+        dropping timing-negative pairs from the attempt table.
+        '''
+        import columnar
+        views = self.rawColumns(self.browse_events, 'BrowseEvents', columnar.BROWSE_EVENT_COLUMNS,
+                                lambda convert: self.parseBrowseEvents(self.readCSV(self.browse_events), convert))
+        attempts = self.attempt_table
+
+        # Resolve each browse URI visible in the course to the attempted items it refers to
+        item_codes = attempts.vocab['item'].codes
+        matches = [(uri, item_codes[iuri]) for uri, item in enumerate(views.vocab['item'].values)
+                   if item[-32:] in self.ran_in_course for iuri in self.matchItemURIs(item)]
+        learner = columnar.recode(views.vocab['learner'], attempts.vocab['learner'])[views.learner]
+        self.timing_table, negative = columnar.compute_timing(attempts, learner, views.item, views.time, matches)
+
+        # Log timing-negative learner-item pairs and continue without adding them to the final matrix
+        dropped = attempts.select(negative)
+        learners, items = attempts.vocab['learner'].values, attempts.vocab['item'].values
+        if len(dropped):
+            self.diagnostics.record_many('negative', {'timing': len(dropped)},
+                                         lambda i: {"item": items[dropped.item[i]], "learner": learners[dropped.learner[i]]})
+        self.attempt_table = attempts.select(~negative)
+        self.metrics.rows(len(views), len(self.timing_table), len(dropped))
+
+
+    def firstViews(self, views):
+        '''
+        Timing data from each learner's first view of each item, given views in
+        time order. Returns the number of views, timing data per learner and
+        attempt URI, and the timing-negative (learner, attempt URI) pairs to
+        drop. Item attempts are left as they are, so this can be run again.
+        '''
+        seen = defaultdict(set)
+        timings = defaultdict(dict)
+        negative = list()
+        dropped = set()
+        count = 0
+        for learner, item, timing in views:
+            count += 1
+            item_base_id = item[-32:]
+            if item_base_id not in self.ran_in_course:
+                continue  # Skip if item was not actually visible in the course
+
+            # Since we retrieve browse_events pre-sorted, assume first hit for this learner is earliest view
+            if item not in seen[learner]:
+                # Apply data to all item URIs that match the one we just found
+                for iuri in self.matchItemURIs(item):
+                    if iuri not in self.item_attempts[learner] or (learner, iuri) in dropped:
+                        continue  # Learner did not attempt this part
+                    calcs = self.timingData(self.item_attempts[learner][iuri], timing)
+                    if calcs.time_to_first_attempt < 0 or calcs.time_to_last_attempt < 0:
+                        negative.append((learner, iuri))
+                        dropped.add((learner, iuri))
+                    else:
+                        timings[learner][iuri] = calcs
+                    seen[learner].add(item)  # Keep track of which items we've calculated first views for
+        return count, timings, negative
+
+
+    def deltaRows(self, log, kind, path):
+        '''
+        Generate the rows of a raw file, as dicts, that are newer than log's
+        watermark for its kind. Timestamps sort as strings, so older rows are
+        skipped before they are decoded or made into dicts.
+        '''
+        mark = log.watermarks[kind][0]
+        since = timestamps.encode(mark) if mark is not None else ''
+        with ingest.open_raw(path) as (header, rows):
+            at = header.index('time')
+            for row in rows:
+                if not row or row[at][:19] < since:
+                    continue
+                row = dict(zip(header, row + [None] * (len(header) - len(row))))
+                if log.fresh(kind, self.convertTime(row['time']), row):
+                    yield row
+
+
+    @instrument.phase('read_delta')
+    def read_delta(self, log):
+        '''
+        Read the problem and browse events newer than an event_log.EventLog's
+        watermarks into it, filtering and counting problem events as read_attempts
+        does, on top of the counts and diagnostics the log carries over. Returns
+        the codes of the learners whose matrix rows the new events change.
+        '''
+        for counter in ['aggregate', 'missing', 'ignored']:
+            getattr(self, counter).update(log.counts[counter])
+        self.diagnostics.merge(log.diagnostics)
+        before = [sum(getattr(self, counter).values()) for counter in ['aggregate', 'missing', 'ignored']]
+
+        changed = set()
+        for event in self.valid_events(self.deltaRows(log, 'ProblemEvents', self.problem_events)):
+            if event.source == 'browser':
+                log.add_browser(event.item, event.time, event.page, event.rdn)
+            else:
+                changed.add(log.add_attempt(event.learner, event.item, event.time, event.grade))
+
+        # Only a learner's first view of an item can change their timing data
+        views = 0
+        for learner, item, timing in self.parseBrowseEvents(self.deltaRows(log, 'BrowseEvents', self.browse_events)):
+            views += 1
+            if item[-32:] in self.ran_in_course:
+                learner = log.add_view(learner, item, timing)
+                if learner is not None:
+                    changed.add(learner)
+
+        # Items seen in earlier runs are still matrix columns
+        for problemID in log.vocab['item'].values:
+            self.problemset.add(problemID)
+            self.item_uris[problemID[-36:-4]].add(problemID)
+
+        kept, missing, ignored = [sum(getattr(self, counter).values()) - n for counter, n in zip(['aggregate', 'missing', 'ignored'], before)]
+        self.metrics.rows(kept + missing + ignored + views, kept + views, missing + ignored)
+        return changed
+
+
+    @instrument.phase('compute_delta')
+    def compute_delta(self, log, learners):
+        '''
+        Recompute attempt and timing data for the learners with the given codes
+        from log, as compute_attempts and compute_timing would over the whole
+        course: each of a learner's first views is applied in time order to the
+        attempted items it matches, and a timing-negative pair is dropped.
+        Pairs found timing-negative in earlier runs are not recorded again.
+        '''
+        vocab = log.vocab
+        for code in learners:
+            learner = vocab['learner'].values[code]
+
+            # First views of each attempt URI, in time order
+            views = defaultdict(list)
+            for timing, uri in sorted((timing, vocab['uri'].values[uri]) for uri, timing in log.views_of(code).items()):
+                for iuri in self.matchItemURIs(uri):
+                    views[iuri].append(timing)
+
+            for item_code, attempt_log in log.attempts_of(code).items():
+                item = vocab['item'].values[item_code]
+                times, grades = attempt_log.ordered()
+                attempts = self.attemptData(times, [vocab['grade'].values[grade] for grade in grades])
+                calcs = None
+                for timing in views.get(item, ()):
+                    view_calcs = self.timingData(attempts, timing)
+                    if view_calcs.time_to_first_attempt < 0 or view_calcs.time_to_last_attempt < 0:
+                        key = interning.pair_key(code, item_code)
+                        if key not in log.negative:
+                            log.negative.add(key)
+                            self.diagnostics.record('negative', 'timing', {"item": item, "learner": learner})
+                        attempts = None
+                        break
+                    calcs = view_calcs
+                if attempts is not None:
+                    self.item_attempts[learner][item] = attempts
+                if calcs is not None:
+                    self.item_timing[learner][item] = calcs
+
+        # Catch item metadata from each item's earliest browser event
+        for item in self.problemset:
+            first = log.first_browser.get(vocab['item'].codes.get(item))
+            self.problem_meta[item] = [vocab['page'].values[first[1]], vocab['rdn'].values[first[2]]] if first else ['none', 'none']
+        self.metrics.rows(len(learners), self.cells(self.item_attempts) + self.cells(self.item_timing))
+
 
     def loadcheck(self, outfile):
         '''
         Check a random learner's data.
         '''
+        item_attempts, item_timing = self.records()
         with open(outfile, 'a') as out:
-            learner = random.choice(self.events.keys())
+            learner = random.choice(item_attempts.keys())
             print(learner, file=out)
-            print(json.dumps(self.events[learner], indent=4), file=out)
-            print(json.dumps(self.responses[learner], indent=4), file=out)
-            print(json.dumps(self.item_attempts[learner], indent=4), file=out)
-            print(json.dumps(self.item_timing[learner], indent=4), file=out)
+            print(json.dumps(item_attempts[learner], indent=4), file=out)
+            print(json.dumps(item_timing[learner], indent=4), file=out)
 
 
     def loadsummary(self, outfile):
@@ -258,11 +716,15 @@ class ItemMatrixComputer(object):
             print("Events ignored:", file=out)
             print(json.dumps(self.ignored, indent=4), file=out)
 
-            print("Dropped events:", file=out)
-            print(json.dumps(self.dropped, indent=4), file=out)
+            print("Dropped data by reason:", file=out)
+            print(json.dumps(self.diagnostics.counts(), indent=4), file=out)
 
-            print("Computed negative timing:", file=out)
-            print(json.dumps(self.negative, indent=4), file=out)
+            print("Dropped events (sample of %d):" % self.diagnostics.sample_size, file=out)
+            print(json.dumps(self.diagnostics.sample('missing'), indent=4), file=out)
+
+            print("Computed negative timing (sample of %d):" % self.diagnostics.sample_size, file=out)
+            print(json.dumps(self.diagnostics.sample('negative'), indent=4), file=out)
+        self.diagnostics.close()
 
 
     def writeCSV(self, var, outfile):
@@ -274,7 +736,8 @@ class ItemMatrixComputer(object):
             problems.extend(self.problemset)
             wrt = csv.DictWriter(out, problems, 'NA')
             wrt.writeheader()
-            data = self.item_attempts if var in ItemAttemptData._fields else self.item_timing
+            item_attempts, item_timing = self.records()
+            data = item_attempts if var in ItemAttemptData._fields else item_timing
             for learner in data.keys():
                 rowdata = {'learner': learner}
                 if not len(data[learner].keys()):
@@ -284,43 +747,511 @@ class ItemMatrixComputer(object):
                 wrt.writerow(rowdata)
 
 
-if __name__ == '__main__':
+    @instrument.phase('store')
+    def appendToStore(self, store_dir, course_id, export_dir=None):
+        '''
+        Add this course's matrices to the multi-course SparseStore in store_dir,
+        from a sparse export in export_dir if there is one.
+        '''
+        from sparsestore import SparseStore
+        store = SparseStore(store_dir)
+        if export_dir is not None:
+            segment = store.append(course_id, export_dir)
+        else:
+            tmpdir = tempfile.mkdtemp(prefix='store-%s-' % course_id)
+            try:
+                self.exportSparse(tmpdir, ItemAttemptData._fields + ItemTimingData._fields, self.matrixColumns())
+                segment = store.append(course_id, tmpdir)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        self.metrics.rows(segment['entries'], segment['entries'])
+
+
+    @instrument.phase('fit')
+    def fitIRT(self, model='rasch', field='first_grade', init=None, export_dir=None):
+        '''
+        Fit an IRT model ('rasch' or '2pl') to the graded attempts in field,
+        optionally warm-starting from a previous irt.Fit. The attempts are read
+        from the matrices exported to export_dir if given, otherwise from memory.
+        '''
+        import irt
+        if export_dir is not None:
+            resp = irt.load_responses(export_dir, field)
+        elif self.attempt_table is not None:
+            resp = irt.table_responses(self.attempt_table, field, self.matrixColumns())
+        else:
+            resp = irt.responses(self.item_attempts, field, self.matrixColumns())
+        self.metrics.rows(len(resp.outcomes), len(resp.outcomes))
+        return irt.fit(resp, model, init=init)
+
+
+    @staticmethod
+    def cells(data):
+        '''
+        Number of learner-item pairs with computed data.
+        '''
+        return sum(len(items) for items in data.values())
+
+
+    def pairCounts(self):
+        '''
+        Number of learner-item pairs with attempt data and with timing data.
+        '''
+        if self.attempt_table is not None:
+            return len(self.attempt_table), len(self.timing_table)
+        return self.cells(self.item_attempts), self.cells(self.item_timing)
+
 
-    # Retrieve course IDs
+    def records(self):
+        '''
+        Attempt and timing data as learner -> item -> ItemAttemptData and
+        ItemTimingData dicts. The columnar engine builds these from its tables
+        on each call, for callers that need one record per pair.
+        '''
+        if self.attempt_table is not None:
+            return self.attempt_table.records(ItemAttemptData), self.timing_table.records(ItemTimingData)
+        return self.item_attempts, self.item_timing
+
+
+    def matrixColumns(self):
+        '''
+        Fixed item column order shared by all exported matrices.
+        '''
+        return sorted(self.problemset)
+
+
+    @instrument.phase('export')
+    def writeMatrices(self, outdir, variables=None, columns=None, header=True):
+        '''
+        Write every requested variable's matrix to outdir as <variable>.csv,
+        walking the attempt and timing data once each. Columns defaults to
+        matrixColumns(); header=False writes data rows only, e.g. for shard parts.
+        '''
+        if variables is None:
+            variables = ItemAttemptData._fields + ItemTimingData._fields
+        if columns is None:
+            columns = self.matrixColumns()
+        attempt_fields = [v for v in variables if v in ItemAttemptData._fields]
+        timing_fields = [v for v in variables if v in ItemTimingData._fields]
+        if self.attempt_table is not None:
+            export.write_dense_columns(outdir, self.attempt_table, attempt_fields, columns, header=header)
+            export.write_dense_columns(outdir, self.timing_table, timing_fields, columns, header=header)
+        else:
+            export.write_dense(outdir, self.item_attempts, attempt_fields, columns, header=header)
+            export.write_dense(outdir, self.item_timing, timing_fields, columns, header=header)
+        cells = sum(self.pairCounts())
+        self.metrics.rows(cells, cells)
+
+
+    @instrument.phase('export')
+    def writeSparse(self, outdir, variables=None, columns=None):
+        '''
+        Write every requested variable to outdir as a <variable>.npy triplet file,
+        with shared learners.txt, items.txt and codes.txt index files.
+        Columns defaults to matrixColumns().
+        '''
+        if variables is None:
+            variables = ItemAttemptData._fields + ItemTimingData._fields
+        self.exportSparse(outdir, variables, columns if columns is not None else self.matrixColumns())
+        cells = sum(self.pairCounts())
+        self.metrics.rows(cells, cells)
+
+
+    def exportSparse(self, outdir, variables, columns):
+        '''
+        Write the requested variables' sparse triplet and index files to outdir,
+        from the columnar engine's tables if it ran, otherwise from records.
+        '''
+        attempt_fields = [v for v in variables if v in ItemAttemptData._fields]
+        timing_fields = [v for v in variables if v in ItemTimingData._fields]
+        if self.attempt_table is not None:
+            export.write_sparse_columns(outdir, [(self.attempt_table, attempt_fields), (self.timing_table, timing_fields)], columns)
+        else:
+            export.write_sparse(outdir, [(self.item_attempts, attempt_fields), (self.item_timing, timing_fields)], columns)
+
+
+    @instrument.phase('export')
+    def patchMatrices(self, outdir, learners):
+        '''
+        Rewrite only the given learners' rows of the dense matrices in outdir,
+        from data computed for those learners by compute_delta.
+        '''
+        columns = self.matrixColumns()
+        export.patch_dense(outdir, self.item_attempts, ItemAttemptData._fields, columns, learners)
+        export.patch_dense(outdir, self.item_timing, ItemTimingData._fields, columns, learners)
+        cells = self.cells(self.item_attempts) + self.cells(self.item_timing)
+        self.metrics.rows(cells, cells)
+
+
+    @instrument.phase('export')
+    def patchSparse(self, outdir, learners):
+        '''
+        Rewrite only the given learners' entries of the sparse matrices in outdir,
+        from data computed for those learners by compute_delta.
+        '''
+        export.patch_sparse(outdir, [(self.item_attempts, ItemAttemptData._fields), (self.item_timing, ItemTimingData._fields)],
+                            self.matrixColumns(), learners)
+        cells = self.cells(self.item_attempts) + self.cells(self.item_timing)
+        self.metrics.rows(cells, cells)
+
+
+def previous_fit(export_dir, model, init_dirs=()):
+    '''
+    A course's IRT fit from its last export, pooled with the fits saved in
+    init_dirs (other courses' export directories), to warm-start the next fit
+    from. Learner labels are shared across courses, so other courses supply
+    starting abilities for learners new to this one. A fit that can't be read,
+    e.g. because its course is being exported at the same time, is skipped.
+    '''
+    if model is None:
+        return None
+    import irt
+    fits = [irt.Fit.load(export_dir, model)]
+    for init_dir in init_dirs:
+        if os.path.realpath(init_dir) == os.path.realpath(export_dir):
+            continue
+        try:
+            fits.append(irt.Fit.load(init_dir, model))
+        except (IOError, ValueError, TypeError, KeyError):
+            pass
+    return irt.pool(fits)
+
+
+def raw_paths(course_id):
+    '''
+    Paths to a course's raw files, relative to the home directory.
+    '''
+    return ["/Code/irt/data/raws/%s_%s.csv" % (course_id, kind) for kind in ['ProblemEvents', 'BrowseEvents', 'ProblemMetadata', 'Registrations']]
+
+
+def process_course(course_id, engine='rows', fmt='dense', cache_dir=None, cache_size=None, sample_size=100, spill=False,
+                   profile=None, profiler='cprofile', shards=1, shard_workers=1, max_memory=None, fit=None, fit_grade='first_grade',
+                   store=None, variables=None, timing_filter=True, incremental=False, fit_init=()):
+    '''
+    Compute and export the requested variables (by default, all matrices) for one course from its raw files.
+    Only the raw files and phases they depend on are read and run; see ItemMatrixComputer.makePipeline.
+    If profile names a phase, it is run under profiler with output in the export directory.
+    With shards > 1, the course is processed out of core by process_course_sharded.
+    If fit names an IRT model, it is fit to fit_grade, warm-started from the last export's fit
+    and those in the export directories fit_init.
+    If store is given, the matrices are also added to the multi-course SparseStore there.
+    With incremental, the last export is updated from new events by process_course_incremental.
+    '''
+    # Ensure output directory exists
+    export_dir = expanduser("~") + "/Code/irt/data/exports/%s/" % course_id
+    init = previous_fit(export_dir, fit, fit_init)
+    if incremental:
+        return process_course_incremental(course_id, export_dir, fmt=fmt, sample_size=sample_size, spill=spill, profile=profile,
+                                          profiler=profiler, fit=fit, fit_grade=fit_grade, init=init, store=store)
+    try:
+        os.mkdir(export_dir, 0775)
+    except OSError:
+        shutil.rmtree(export_dir)
+        os.mkdir(export_dir, 0775)
+
+    if shards > 1:
+        return process_course_sharded(course_id, export_dir, shards, shard_workers, max_memory, engine=engine, fmt=fmt,
+                                      sample_size=sample_size, spill=spill, profile=profile, profiler=profiler,
+                                      fit=fit, fit_grade=fit_grade, init=init, store=store)
+
+    # Set up event timing computer
+    problem_events_dir, browse_events_dir, problem_defs_dir, registrations_dir = raw_paths(course_id)
+    timer = ItemMatrixComputer(problem_events_dir, browse_events_dir, problem_defs_dir, registrations_dir, engine=engine,
+                               cache_dir=cache_dir, cache_size=cache_size, sample_size=sample_size,
+                               spill_path=export_dir + 'dropped.jsonl' if spill else None,
+                               metrics=instrument.Metrics(profile, profiler, export_dir))
+
+    # Parse only the data the requested variables need
+    variables = list(variables or ItemAttemptData._fields + ItemTimingData._fields)
+    covariates = [v for v in variables if v in pipeline.COVARIATES]
+    matrices = [v for v in variables if v not in pipeline.COVARIATES]
+    needed = variables + [fit_grade] if fit is not None else variables
+    timer.makePipeline(timing_filter).run(needed, lambda phase: print("%s: %s" % (PHASE_MESSAGES.get(phase, "Ran " + phase), course_id)))
+
+    # Check that load worked
+    timer.loadsummary(outfile=export_dir + 'export_summary.txt')
+
+    # Write out data
+    if matrices:
+        if fmt == 'sparse':
+            timer.writeSparse(export_dir, matrices)
+        else:
+            timer.writeMatrices(export_dir, matrices)
+        print("Exported data to %s matrices: %s" % (fmt, course_id))
+    if covariates:
+        pipeline.write_covariates(export_dir + 'learner_covariates.csv', timer.covariates, covariates)
+        print("Exported learner covariates: %s" % course_id)
+
+    finish_course(timer, course_id, export_dir, fmt, fit, fit_grade, init, store, engine=engine)
+
+
+def finish_course(timer, course_id, export_dir, fmt, fit=None, fit_grade='first_grade', init=None, store=None, from_export=False, **info):
+    '''
+    The steps every way of processing a course ends with: fit the IRT model
+    named by fit to fit_grade, add the course to store, and write timer's
+    phase metrics with info. With from_export, the fit and store read the
+    matrices just exported to export_dir rather than the data timer holds.
+    '''
+    # Fit the IRT model
+    if fit is not None:
+        timer.fitIRT(fit, fit_grade, init, export_dir if from_export else None).save(export_dir)
+        print("Fit %s model to %s: %s" % (fit, fit_grade, course_id))
+
+    # Pool the matrices with other courses
+    if store is not None:
+        timer.appendToStore(store, course_id, export_dir if from_export or fmt == 'sparse' else None)
+        print("Added to store %s: %s" % (store, course_id))
+
+    # Record phase timings next to the summary
+    timer.metrics.write(export_dir + 'export_metrics.json', course_id=course_id, format=fmt, **info)
+
+
+def process_course_incremental(course_id, export_dir, fmt='dense', sample_size=100, spill=False, profile=None, profiler='cprofile',
+                               fit=None, fit_grade='first_grade', init=None, store=None):
+    '''
+    Update one course's matrices in export_dir from only the events newer than
+    those in its event_log.EventLog, kept in export_dir/event_log/. Only the
+    learners with new submissions or first views are recomputed and have their
+    matrix rows rewritten, so the cost follows the new events rather than the
+    course history. The export and log are rebuilt from all events if there is
+    no log yet or the problem definitions or format changed since it was saved.
+    The summary and diagnostics cover all events read so far. Adding the course
+    to a store needs sparse output.
+    '''
+    import event_log
+    from rawcache import RawCache
+    problem_events_dir, browse_events_dir, problem_defs_dir, registrations_dir = raw_paths(course_id)
+    timer = ItemMatrixComputer(problem_events_dir, browse_events_dir, problem_defs_dir, registrations_dir, sample_size=sample_size,
+                               spill_path=export_dir + 'dropped.jsonl' if spill else None,
+                               metrics=instrument.Metrics(profile, profiler, export_dir))
+
+    # Start over unless the log still describes this export
+    build = {'problem_defs': RawCache.contentHash(ingest.locate(timer.problem_defs)), 'format': fmt}
+    log_dir = export_dir + 'event_log/'
+    log = event_log.EventLog(log_dir) if os.path.isdir(log_dir) else None
+    if log is None or log.build != build:
+        shutil.rmtree(export_dir, ignore_errors=True)
+        os.mkdir(export_dir, 0775)
+        log = event_log.EventLog(log_dir)
+        print("Rebuilding event log: %s" % course_id)
+    elif os.path.exists(export_dir + 'export_summary.txt'):
+        os.remove(export_dir + 'export_summary.txt')
+
+    # Read new events and recompute the learners they touch
+    changed = timer.read_delta(log)
+    print("Loaded new events for %d learners: %s" % (len(changed), course_id))
+    timer.compute_delta(log, changed)
+    timer.loadsummary(outfile=export_dir + 'export_summary.txt')
+
+    learners = set(log.vocab['learner'].values[code] for code in changed)
+    if fmt == 'sparse':
+        timer.patchSparse(export_dir, learners)
+    else:
+        timer.patchMatrices(export_dir, learners)
+    print("Updated %s matrices: %s" % (fmt, course_id))
+
+    # Record the new events only once the export reflects them
+    log.save(build, dict((counter, getattr(timer, counter)) for counter in ['aggregate', 'missing', 'ignored']), timer.diagnostics.state())
+
+    finish_course(timer, course_id, export_dir, fmt, fit, fit_grade, init, store, from_export=True, engine='rows', incremental=True,
+                  learners_updated=len(changed))
+
+
+def process_course_sharded(course_id, export_dir, n, workers=1, max_memory=None, engine='rows', fmt='dense', sample_size=100,
+                           spill=False, profile=None, profiler='cprofile', fit=None, fit_grade='first_grade', init=None,
+                           store=None):
+    '''
+    Compute and export all matrices for one course in n learner shards, so that
+    peak memory is set by the shard size rather than the course size. One
+    streaming pass splits ProblemEvents and BrowseEvents into shards and
+    collects the course's item columns; shards are then processed by up to
+    workers processes (each capped at max_memory MB) and their matrix rows
+    concatenated. The raw file cache is not used for shards. An IRT model
+    named by fit is fit to the concatenated fit_grade matrix. Adding the course
+    to a store needs sparse output.
+    '''
+    problem_events_dir, browse_events_dir, problem_defs_dir, registrations_dir = raw_paths(course_id)
+    timer = ItemMatrixComputer(problem_events_dir, browse_events_dir, problem_defs_dir, registrations_dir, engine=engine,
+                               sample_size=sample_size, metrics=instrument.Metrics(profile, profiler, export_dir))
+    shard_root = tempfile.mkdtemp(prefix='shards-%s-' % course_id)
+    try:
+        dirs = shards.shard_dirs(shard_root, n)
+
+        # Split the event files, noting which items any shard will keep
+        with timer.metrics.phase('partition'):
+            timer.loadProblemDefs()
+
+            def visit(row):
+                problemID = timer.extractProblemID(row['problem_id'])
+                if timer.isVisible(problemID) and row['event_type'] not in IGNORED_EVENTS:
+                    timer.problemset.add(problemID)
+
+            rows = sum(shards.partition(timer.problem_events, dirs, visit=visit))
+            rows += sum(shards.partition(timer.browse_events, dirs))
+            timer.metrics.rows(rows, rows)
+        print("Partitioned %d shards: %s" % (n, course_id))
+
+        # Compute each shard's matrix rows against the shared item columns
+        columns = timer.matrixColumns()
+        with timer.metrics.phase('process_shards'):
+            report = parallel.run_courses(partial(process_shard, course_id=course_id, problem_defs=timer.problem_defs, columns=columns,
+                                                  engine=engine, fmt=fmt, sample_size=sample_size, spill=spill,
+                                                  profile=profile, profiler=profiler, profile_dir=export_dir), dirs, workers=workers, max_memory=max_memory)
+        failed = [r for r in report if r.status != 'ok']
+        if failed:
+            raise RuntimeError("%d of %d shards failed:\n%s" % (len(failed), n, '\n'.join(r.error for r in failed)))
+
+        # Fold shard counts into the course summary and join the shard matrices
+        states = list()
+        for shard in dirs:
+            with open(shard + 'shard.json', 'r') as f:
+                states.append(json.load(f))
+            for counter in ['aggregate', 'missing', 'ignored']:
+                for etype, count in states[-1][counter].items():
+                    getattr(timer, counter)[etype] += count
+            timer.diagnostics.merge(states[-1]['diagnostics'])
+        timer.loadsummary(outfile=export_dir + 'export_summary.txt')
+
+        with timer.metrics.phase('concatenate'):
+            variables = ItemAttemptData._fields + ItemTimingData._fields
+            if fmt == 'sparse':
+                export.concat_sparse(export_dir, dirs, variables, columns)
+            else:
+                export.concat_dense(export_dir, dirs, variables, columns)
+            if spill:
+                with open(export_dir + 'dropped.jsonl', 'wb') as out:
+                    for shard in dirs:
+                        if os.path.exists(shard + 'dropped.jsonl'):
+                            with open(shard + 'dropped.jsonl', 'rb') as f:
+                                shutil.copyfileobj(f, out)
+        print("Exported data to %s matrices: %s" % (fmt, course_id))
+
+        finish_course(timer, course_id, export_dir, fmt, fit, fit_grade, init, store, from_export=True, engine=engine, shards=n,
+                      shard_metrics=[state['metrics'] for state in states])
+    finally:
+        shutil.rmtree(shard_root, ignore_errors=True)
+
+
+def process_shard(shard_dir, course_id, problem_defs, columns, engine='rows', fmt='dense', sample_size=100, spill=False,
+                  profile=None, profiler='cprofile', profile_dir='.'):
+    '''
+    Compute one shard's matrix parts into shard_dir, using the course's item
+    columns and no headers, and save its counts and metrics to shard.json.
+    '''
+    name = os.path.basename(shard_dir.rstrip(os.sep))
+    timer = ItemMatrixComputer(shard_dir + '%s_ProblemEvents.csv' % course_id, shard_dir + '%s_BrowseEvents.csv' % course_id, problem_defs,
+                               shard_dir + '%s_Registrations.csv' % course_id, engine=engine, sample_size=sample_size,
+                               spill_path=shard_dir + 'dropped.jsonl' if spill else None, root='',
+                               metrics=instrument.Metrics(profile, profiler, profile_dir, name + '_'))
+    timer.read_attempts()
+    timer.compute_attempts()
+    timer.compute_timing()
+    if fmt == 'sparse':
+        timer.writeSparse(shard_dir, columns=columns)
+    else:
+        timer.writeMatrices(shard_dir, columns=columns, header=False)
+    timer.diagnostics.close()
+
+    with open(shard_dir + 'shard.json', 'w') as out:
+        json.dump({'aggregate': timer.aggregate, 'missing': timer.missing, 'ignored': timer.ignored,
+                   'diagnostics': timer.diagnostics.state(), 'metrics': timer.metrics.summary(shard=name)}, out)
+
+
+def add_arguments(parser):
+    '''
+    Add the per-course parsing options to an argparse parser.
+    '''
+    parser.add_argument('--source', choices=['events', 'activity-grade'], default='events',
+                        help='build matrices from tracking events, or only final grades from ActivityGrade')
+    parser.add_argument('--engine', choices=['rows', 'columnar'], default='rows', help='attempt computation engine')
+    parser.add_argument('--format', choices=['dense', 'sparse'], default='dense', help='matrix output format')
+    parser.add_argument('--cache-dir', default=None, help='directory for cached decoded raw files')
+    parser.add_argument('--cache-size', type=int, default=None, help='raw cache size limit in MB')
+    parser.add_argument('--sample-size', type=int, default=100, help='dropped records to sample per reason for export_summary.txt')
+    parser.add_argument('--spill-dropped', action='store_true', help='write every dropped record to dropped.jsonl')
+    parser.add_argument('--workers', type=int, default=1, help='number of courses to process at once')
+    parser.add_argument('--max-memory', type=int, default=None, help='per-worker memory budget in MB')
+    parser.add_argument('--shards', type=int, default=1, help='split each course into this many learner shards to bound memory')
+    parser.add_argument('--shard-workers', type=int, default=1, help='number of shards of a course to process at once')
+    parser.add_argument('--fit', choices=['rasch', '2pl'], default=None, help='fit an IRT model to each course, written to irt_<model>_*.csv')
+    parser.add_argument('--fit-grade', choices=[f for f in ItemAttemptData._fields if f.endswith('_grade')], default='first_grade',
+                        help='grade variable to fit')
+    parser.add_argument('--fit-init', nargs='+', default=[], metavar='EXPORT_DIR',
+                        help="also warm-start learner abilities from the fits in these courses' export directories")
+    parser.add_argument('--variables', nargs='+', default=None,
+                        choices=list(ItemAttemptData._fields + ItemTimingData._fields) + sorted(pipeline.COVARIATES) +
+                        [f for f in activity_grades.ActivityGradeData._fields if f not in ItemAttemptData._fields],
+                        help='output variables to compute (default: all matrices); only the inputs they need are read')
+    parser.add_argument('--no-timing-filter', dest='timing_filter', action='store_false',
+                        help="don't drop timing-negative pairs from attempt variables, so attempt-only runs skip BrowseEvents")
+    parser.add_argument('--store', default=None, help='also add each course to the multi-course sparse store in this directory')
+    parser.add_argument('--incremental', action='store_true',
+                        help='update each course from only the events newer than its last incremental run')
+    parser.add_argument('--profile-phase', choices=instrument.PHASES, default=None,
+                        help='profile one phase of each course, writing the output to its export directory')
+    parser.add_argument('--profiler', choices=sorted(instrument.PROFILERS), default='cprofile', help='profiler for --profile-phase')
+    parser.add_argument('--report', default=expanduser("~") + "/Code/irt/data/exports/parse_report.json", help='path for the batch status report')
+
+
+def course_processor(parser, args):
+    '''
+    Check parsed options and return the function that processes one course with them.
+    '''
+    if args.store and args.shards > 1 and args.format != 'sparse':
+        parser.error('--store with --shards needs --format sparse')
+    if args.variables and args.shards > 1:
+        parser.error('--variables is not supported with --shards')
+    if args.incremental and (args.shards > 1 or args.variables):
+        parser.error('--incremental is not supported with --shards or --variables')
+    if args.store and args.incremental and args.format != 'sparse':
+        parser.error('--store with --incremental needs --format sparse')
+    grade_fields = activity_grades.ActivityGradeData._fields
+    if args.source == 'activity-grade' and args.variables and not set(args.variables) <= set(grade_fields):
+        parser.error('ActivityGrade variables are: %s' % ', '.join(grade_fields))
+    if args.fit_init and not args.fit:
+        parser.error('--fit-init needs --fit')
+    event_fields = ItemAttemptData._fields + ItemTimingData._fields + tuple(sorted(pipeline.COVARIATES))
+    if args.source == 'events' and args.variables and not set(args.variables) <= set(event_fields):
+        parser.error('--variables %s need --source activity-grade' % ', '.join(v for v in args.variables if v not in event_fields))
+    if args.source == 'activity-grade':
+        for option, used in [('--engine', args.engine != parser.get_default('engine')), ('--cache-dir', args.cache_dir),
+                             ('--shards', args.shards > 1), ('--fit', args.fit), ('--fit-init', args.fit_init), ('--store', args.store),
+                             ('--incremental', args.incremental)]:
+            if used:
+                parser.error('%s is not supported with --source activity-grade' % option)
+
+    cache_size = args.cache_size * 1024 * 1024 if args.cache_size else None
+    if args.source == 'activity-grade':
+        return partial(activity_grades.process_course, fmt=args.format, variables=args.variables,
+                       profile=args.profile_phase, profiler=args.profiler, sample_size=args.sample_size, spill=args.spill_dropped)
+    return partial(process_course, engine=args.engine, fmt=args.format,
+                   cache_dir=args.cache_dir, cache_size=cache_size,
+                   sample_size=args.sample_size, spill=args.spill_dropped,
+                   profile=args.profile_phase, profiler=args.profiler, shards=args.shards,
+                   shard_workers=args.shard_workers, max_memory=args.max_memory,
+                   fit=args.fit, fit_grade=args.fit_grade, store=args.store,
+                   variables=args.variables, timing_filter=args.timing_filter, incremental=args.incremental,
+                   fit_init=args.fit_init)
+
+
+def read_courses(path='./data/done_courses.txt'):
+    '''
+    Course IDs, as used in raw file names, from a course list file.
+    '''
     course_ids = []
-    with open('./data/done_courses.txt', 'r') as clist:
+    with open(path, 'r') as clist:
         for course in clist:
             course_ids.append(course.replace('/', '_').rstrip())
+    return course_ids
 
-    for course_id in course_ids:
 
-        # Ensure output directory exists
-        export_dir = expanduser("~") + "/Code/irt/data/exports/%s/" % course_id
-        try:
-            os.mkdir(export_dir, 0775)
-        except OSError:
-            shutil.rmtree(export_dir)
-            os.mkdir(export_dir, 0775)
-
-        # Set up event timing computer
-        problem_events_dir = "/Code/irt/data/raws/%s_ProblemEvents.csv" % course_id
-        browse_events_dir = "/Code/irt/data/raws/%s_BrowseEvents.csv" % course_id
-        problem_defs_dir = "/Code/irt/data/raws/%s_ProblemMetadata.csv" % course_id
-        registrations_dir = "/Code/irt/data/raws/%s_Registrations.csv" % course_id
-        timer = ItemMatrixComputer(problem_events_dir, browse_events_dir, problem_defs_dir, registrations_dir)
-
-        # Parse data
-        timer.read_attempts()
-        print("Loaded item attempt data: %s" % course_id)
-        timer.compute_attempts()
-        print("Computed item attempt data: %s" % course_id)
-        timer.compute_timing()
-        print("Computed item timing data: %s" % course_id)
-
-        # Check that load worked
-        timer.loadsummary(outfile='/Users/vpoluser/Code/irt/data/exports/%s/export_summary.txt' % course_id)
-
-        # Write out data to CSV
-        for variable in list(set(ItemAttemptData._fields).union(ItemTimingData._fields)):
-            timer.writeCSV('%s' % variable, '/Users/vpoluser/Code/irt/data/exports/%s/%s.csv' % (course_id, variable))
-        print("Exported data to CSV: %s" % course_id)
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Calculate IRT matrices from raw data files.')
+    add_arguments(parser)
+    args = parser.parse_args()
+    process = course_processor(parser, args)
+
+    # Courses are independent, so run them in a worker pool and report on the batch
+    report = parallel.run_courses(process, read_courses(), workers=args.workers, max_memory=args.max_memory)
+    parallel.write_report(report, args.report)
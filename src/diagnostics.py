@@ -0,0 +1,174 @@
+# Bounded-memory diagnostics for data dropped while parsing
+#
+
+import json
+import math
+import random
+from collections import defaultdict
+
+
+class Reservoir(object):
+    '''
+    Uniform random sample of fixed size over a stream of any length
+    (reservoir sampling, Algorithm L). Items that are not sampled are
+    skipped without being built, so offering a batch costs time in the
+    number of sampled items rather than the batch size.
+    '''
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.items = list()
+        self.seen = 0
+        self.w = 1.0
+        self.next = None  # Index of the next item to sample once full
+
+    def advance(self, idx):
+        '''
+        Draw the index of the next sampled item after idx.
+        '''
+        self.w *= math.exp(math.log(1.0 - self.rng.random()) / self.size)
+        self.schedule(idx)
+
+    def schedule(self, idx):
+        '''
+        Draw how many items after idx to skip, given the current threshold w.
+        '''
+        skip = math.floor(math.log(1.0 - self.rng.random()) / math.log(1.0 - self.w)) if self.w < 1.0 else 0
+        self.next = idx + int(skip) + 1
+
+    def offer(self, item):
+        self.offer_many(1, lambda i: item)
+
+    def offer_many(self, n, fetch):
+        '''
+        Offer n items, where fetch(i) builds the i-th; fetch is only called for sampled items.
+        '''
+        start, end = self.seen, self.seen + n
+        if self.size <= 0:
+            self.seen = end
+            return
+
+        # Fill the reservoir
+        idx = start
+        while idx < end and len(self.items) < self.size:
+            self.items.append(fetch(idx - start))
+            if len(self.items) == self.size:
+                self.advance(idx)
+            idx += 1
+
+        # Then replace a random slot at each sampled index
+        while self.next is not None and self.next < end:
+            self.items[self.rng.randrange(self.size)] = fetch(self.next - start)
+            self.advance(self.next)
+        self.seen = end
+
+    def merge(self, seen, items):
+        '''
+        Fold in a sample of items drawn from another stream of seen items,
+        keeping a uniform sample over both streams. How many to keep from each
+        side is drawn hypergeometrically, as if sampling the combined stream
+        without replacement, and that many are then picked from each sample.
+        '''
+        total = self.seen + seen
+        size = min(self.size, total)
+        ours, theirs, keep = self.seen, seen, 0
+        for _ in range(size):
+            if self.rng.random() * (ours + theirs) < ours:
+                ours, keep = ours - 1, keep + 1
+            else:
+                theirs -= 1
+        self.items = self.rng.sample(self.items, keep) + self.rng.sample(items, size - keep)
+        self.seen = total
+        self.w, self.next = 1.0, None
+        if self.size > 0 and len(self.items) == self.size:
+            # Threshold after seen items: the size-th smallest of seen uniform keys
+            self.w = self.rng.betavariate(self.size, self.seen - self.size + 1)
+            self.schedule(self.seen - 1)
+
+
+class Diagnostics(object):
+    '''
+    Tracks dropped records with streaming counts by (reason, event type), a
+    fixed-size reservoir sample per reason, and optionally a JSONL spill file
+    with one line per record. Memory use does not grow with the input.
+    '''
+
+    def __init__(self, sample_size=100, spill_path=None, seed=None):
+        self.sample_size = sample_size
+        self.spill_path = spill_path
+        self.spill = None
+        self.rng = random.Random(seed)
+        self.tallies = defaultdict(lambda: defaultdict(int))
+        self.reservoirs = dict()
+
+    def reservoir(self, reason):
+        if reason not in self.reservoirs:
+            self.reservoirs[reason] = Reservoir(self.sample_size, self.rng)
+        return self.reservoirs[reason]
+
+    def write(self, reason, etype, record):
+        if self.spill is None:
+            self.spill = open(self.spill_path, 'a')
+        self.spill.write(json.dumps({'reason': reason, 'type': etype, 'record': record}) + '\n')
+
+    def record(self, reason, etype, record):
+        '''
+        Log one dropped record.
+        '''
+        self.tallies[reason][etype] += 1
+        self.reservoir(reason).offer(record)
+        if self.spill_path is not None:
+            self.write(reason, etype, record)
+
+    def record_many(self, reason, counts, fetch):
+        '''
+        Log a batch of dropped records. Counts maps event type -> number dropped;
+        fetch(i) builds the i-th record of the batch and is only called for
+        records that are sampled or spilled. Records without a type of their
+        own are spilled with the batch's event type if it has only one.
+        '''
+        default = counts.keys()[0] if len(counts) == 1 else None
+        n = 0
+        for etype, count in counts.items():
+            self.tallies[reason][etype] += count
+            n += count
+        self.reservoir(reason).offer_many(n, fetch)
+        if self.spill_path is not None:
+            for i in range(n):
+                record = fetch(i)
+                self.write(reason, getattr(record, 'type', default), record)
+
+    def counts(self):
+        '''
+        Dropped record counts as {reason: {event type: count}}.
+        '''
+        return dict((reason, dict(tally)) for reason, tally in self.tallies.items())
+
+    def sample(self, reason):
+        '''
+        The current sample of dropped records for a reason.
+        '''
+        return list(self.reservoirs[reason].items) if reason in self.reservoirs else []
+
+    def state(self):
+        '''
+        Counts and samples as plain data, for merging into another Diagnostics.
+        '''
+        return {'counts': self.counts(),
+                'samples': dict((reason, {'seen': r.seen, 'items': r.items}) for reason, r in self.reservoirs.items())}
+
+    def merge(self, state):
+        '''
+        Add the counts and samples saved by state() from another run over disjoint data.
+        '''
+        for reason, tally in state['counts'].items():
+            for etype, count in tally.items():
+                self.tallies[reason][etype] += count
+        for reason, sample in state['samples'].items():
+            self.reservoir(reason).merge(sample['seen'], sample['items'])
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
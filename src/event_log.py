@@ -0,0 +1,275 @@
+# Persistent, time-ordered event log for incremental course updates
+#
+# Layout of a log directory:
+#   log.json            vocabularies, watermarks, counts and the list of segments
+#   seg<N>/attempts_<column>.npy
+#                       valid submissions as key, time and grade code columns,
+#                       sorted by learner-item pair key and then time
+#   seg<N>/views_<column>.npy
+#                       first views of browse URIs as key (pair key of learner
+#                       and URI codes) and time columns, sorted by key
+# Each segment holds all of a table's entries for the learners it has, and a
+# learner's entries are read from the newest segment that has any. Learners
+# are looked up in the memory-mapped key columns and loaded only when new
+# events touch them. Saving writes just the learners loaded this run as a new
+# segment, sorted on its own, so an update costs in proportion to the new
+# events; a segment is merged into the one before it once that is no longer
+# MERGE_RATIO times bigger, so each entry is rewritten a logarithmic number of
+# times and lookups search few segments. Segments are written under new names
+# before log.json is replaced, so an interrupted save leaves the log as it was.
+#
+
+import hashlib
+import json
+import os
+import shutil
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from interning import AttemptLog, Vocabulary, pair_key
+
+TABLES = {'attempts': [('key', '<i8'), ('time', '<f8'), ('grade', '<i4')],
+          'views': [('key', '<i8'), ('time', '<f8')]}
+KINDS = ['ProblemEvents', 'BrowseEvents']
+MERGE_RATIO = 4
+
+
+def row_key(row):
+    '''
+    Digest of a raw row's contents, to tell apart rows with the same time.
+    '''
+    return hashlib.sha1(repr(sorted(row.items()))).hexdigest()
+
+
+class EventLog(object):
+    '''
+    A course's valid problem submissions, grouped per learner-item pair in time
+    order, and each learner's first view of each browse URI, with a watermark
+    per raw file kind marking the latest events read. Also keeps what is needed
+    to carry the course summary across updates: event counts, diagnostics
+    state, the earliest browser event per item and the pairs already dropped
+    for negative timing.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.reload()
+
+    def reload(self):
+        '''
+        Read log.json and memory-map the arrays of its segments.
+        '''
+        manifest = os.path.join(self.path, 'log.json')
+        state = None
+        if os.path.exists(manifest):
+            with open(manifest, 'r') as f:
+                state = json.load(f)
+        if state is None or 'segments' not in state:  # Logs from before segments read as empty, so are rebuilt
+            state = {'segments': [], 'next_segment': 0, 'build': None, 'vocab': {}, 'watermarks': {}, 'counts': {},
+                     'diagnostics': {'counts': {}, 'samples': {}}, 'first_browser': [], 'negative': []}
+        self.segments = state['segments']  # Oldest first
+        self.next_segment = state['next_segment']
+        self.build = state['build']
+        self.vocab = dict((name, Vocabulary(state['vocab'].get(name, ()))) for name in ['learner', 'item', 'grade', 'page', 'rdn', 'uri'])
+        self.watermarks = dict((kind, tuple(state['watermarks'].get(kind, (None, {})))) for kind in KINDS)  # kind -> (time, {row key: count})
+        self.counts = dict((counter, state['counts'].get(counter, {})) for counter in ['aggregate', 'missing', 'ignored'])
+        self.diagnostics = state['diagnostics']
+        self.first_browser = dict((item, tuple(first)) for item, first in state['first_browser'])  # item code -> (time, page code, rdn code)
+        self.negative = set(state['negative'])  # pair keys dropped for negative timing
+
+        self.attempts = [self.load(segment, 'attempts') for segment in self.segments]
+        self.views = [self.load(segment, 'views') for segment in self.segments]
+        self.pending = dict((kind, (mark, Counter(rows), [])) for kind, (mark, rows) in self.watermarks.items())
+        self.skipped = dict((kind, defaultdict(int)) for kind in KINDS)
+        self.learner_attempts = dict()  # learner code -> {item code: AttemptLog}, for learners loaded this run
+        self.learner_views = dict()  # learner code -> {URI code: time}, for learners loaded this run
+
+    def load(self, segment, table):
+        '''
+        A segment's columns of a table by name, memory-mapped.
+        '''
+        segdir = os.path.join(self.path, segment)
+        return dict((column, np.load(os.path.join(segdir, '%s_%s.npy' % (table, column)), mmap_mode='r')) for column, _ in TABLES[table])
+
+    @staticmethod
+    def span(segments, learner):
+        '''
+        A learner's entries in a table: the columns of the newest segment that
+        has any, and their index range in it.
+        '''
+        bounds = [pair_key(learner, 0), pair_key(learner + 1, 0)]
+        for columns in reversed(segments):
+            start, end = np.searchsorted(columns['key'], bounds)
+            if end > start:
+                return columns, start, end
+        return None, 0, 0
+
+    def fresh(self, kind, time, row):
+        '''
+        Whether a row of a raw file kind is newer than the log's watermark.
+        Rows at the watermark time are told apart by content, counting
+        duplicates, since event IDs repeat across joined rows. Fresh rows move
+        the watermark that save() will record.
+        '''
+        mark, seen = self.watermarks[kind]
+        if mark is not None and time <= mark:
+            if time < mark:
+                return False
+            key = row_key(row)
+            if self.skipped[kind][key] < seen.get(key, 0):
+                self.skipped[kind][key] += 1
+                return False
+        latest, keys, rows = self.pending[kind]
+        if latest is None or time > latest:
+            self.pending[kind] = (time, Counter(), [row])
+        elif time == latest:
+            rows.append(row)
+        return True
+
+    def add_attempt(self, learner, item, time, grade):
+        '''
+        Add a submission; returns the learner's code.
+        '''
+        learner = self.vocab['learner'].code(learner)
+        item = self.vocab['item'].code(item)
+        logs = self.attempts_of(learner)
+        log = logs.get(item)
+        if log is None:
+            log = logs[item] = AttemptLog()
+        log.add(time, self.vocab['grade'].code(grade))
+        return learner
+
+    def add_browser(self, item, time, page, rdn):
+        '''
+        Add a browser event, which only supplies item metadata, keeping the earliest per item.
+        '''
+        item = self.vocab['item'].code(item)
+        first = self.first_browser.get(item)
+        if first is None or time < first[0]:
+            self.first_browser[item] = (time, self.vocab['page'].code(page), self.vocab['rdn'].code(rdn))
+
+    def add_view(self, learner, uri, time):
+        '''
+        Add a browse event. Returns the learner's code if this is their first
+        view of the URI (so their timing may change), otherwise None.
+        '''
+        learner = self.vocab['learner'].code(learner)
+        uri = self.vocab['uri'].code(uri)
+        views = self.views_of(learner)
+        if uri in views and views[uri] <= time:
+            return None
+        views[uri] = time
+        return learner
+
+    def views_of(self, learner):
+        '''
+        A learner's first view time per URI code, loaded on first use.
+        '''
+        try:
+            return self.learner_views[learner]
+        except KeyError:
+            columns, start, end = self.span(self.views, learner)
+            self.learner_views[learner] = views = dict()
+            if columns is not None:
+                views.update((key & 0xffffffff, time) for key, time in zip(columns['key'][start:end].tolist(), columns['time'][start:end].tolist()))
+            return views
+
+    def attempts_of(self, learner):
+        '''
+        A learner's AttemptLog per item code, loaded on first use.
+        '''
+        try:
+            return self.learner_attempts[learner]
+        except KeyError:
+            columns, start, end = self.span(self.attempts, learner)
+            self.learner_attempts[learner] = logs = dict()
+            if columns is None:
+                return logs
+            keys = columns['key'][start:end].tolist()
+            times, grades = columns['time'][start:end].tolist(), columns['grade'][start:end].tolist()
+            for n, key in enumerate(keys):
+                if n == 0 or key != keys[n - 1]:
+                    log = logs[key & 0xffffffff] = AttemptLog()
+                log.times.append(times[n])
+                log.grades.append(grades[n])
+            return logs
+
+    def write(self, tables):
+        '''
+        Write tables ({table: {column: values}}) as a new segment; returns its name.
+        '''
+        segment = 'seg%d' % self.next_segment
+        self.next_segment += 1
+        segdir = os.path.join(self.path, segment)
+        if os.path.isdir(segdir):
+            shutil.rmtree(segdir)  # Left by an interrupted save
+        os.mkdir(segdir)
+        for table, columns in tables.items():
+            for column, values in columns.items():
+                np.save(os.path.join(segdir, '%s_%s.npy' % (table, column)), values)
+        return segment
+
+    @staticmethod
+    def merge(older, newer):
+        '''
+        The columns of a table in two segments as one, sorted by key, with each
+        learner's entries in newer replacing theirs in older. Newer is inserted
+        into older by binary search, so neither is sorted again.
+        '''
+        learners = newer['key'] >> 32
+        if len(learners):
+            learners = learners[np.concatenate([[True], learners[1:] != learners[:-1]])]
+            at = np.minimum(np.searchsorted(learners, older['key'] >> 32), len(learners) - 1)
+            keep = learners[at] != older['key'] >> 32
+        else:
+            keep = np.ones(len(older['key']), dtype=bool)
+        kept = dict((column, np.asarray(older[column])[keep]) for column in older)
+        at = np.searchsorted(kept['key'], newer['key'])
+        return dict((column, np.insert(kept[column], at, newer[column])) for column in kept)
+
+    def save(self, build, counts, diagnostics):
+        '''
+        Write the entries of the learners loaded this run as a new segment,
+        merging segments as needed, and record the advanced watermarks, the
+        course's event counts and diagnostics state, and build (anything the
+        log's exports depend on, such as the problem definitions).
+        '''
+        entries = {'attempts': [(pair_key(learner, item), time, grade) for learner, logs in self.learner_attempts.iteritems()
+                                for item, log in logs.iteritems() for time, grade in zip(*log.ordered())],
+                   'views': [(pair_key(learner, uri), time) for learner, views in self.learner_views.iteritems() for uri, time in views.items()]}
+        tables = dict()
+        for table, rows in entries.items():
+            block = np.array(rows, dtype=TABLES[table])
+            block = block[np.argsort(block['key'], kind='mergesort')]  # Stable, so each pair's attempts stay in time order
+            tables[table] = dict((column, block[column]) for column, _ in TABLES[table])
+        segments, loaded = list(self.segments), dict(zip(self.segments, zip(self.attempts, self.views)))
+        if entries['attempts'] or entries['views']:
+            segments.append(self.write(tables))
+            loaded[segments[-1]] = (tables['attempts'], tables['views'])
+
+        # Merge the newest segment into the one before it while that isn't much bigger
+        size = lambda segment: len(loaded[segment][0]['key']) + len(loaded[segment][1]['key'])
+        while len(segments) > 1 and size(segments[-2]) < MERGE_RATIO * size(segments[-1]):
+            (old_attempts, old_views), (new_attempts, new_views) = loaded[segments[-2]], loaded[segments[-1]]
+            tables = {'attempts': self.merge(old_attempts, new_attempts), 'views': self.merge(old_views, new_views)}
+            segments[-2:] = [self.write(tables)]
+            loaded[segments[-1]] = (tables['attempts'], tables['views'])
+
+        state = {'segments': segments, 'next_segment': self.next_segment, 'build': build,
+                 'vocab': dict((name, vocab.values) for name, vocab in self.vocab.items()),
+                 'watermarks': dict((kind, (mark, dict(keys + Counter(row_key(row) for row in rows))))
+                                    for kind, (mark, keys, rows) in self.pending.items()),
+                 'counts': counts, 'diagnostics': diagnostics,
+                 'first_browser': sorted(self.first_browser.items()), 'negative': sorted(self.negative)}
+        tmp = os.path.join(self.path, 'log.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, os.path.join(self.path, 'log.json'))
+
+        self.reload()
+        for name in os.listdir(self.path):
+            if name.startswith('seg') and name not in segments:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
@@ -0,0 +1,432 @@
+# Writers for learner-by-item matrices
+#
+
+import array
+import csv
+import os
+import shutil
+import tempfile
+from itertools import izip
+from operator import attrgetter
+
+CODE_LIMIT = 2 ** 15  # String values are stored as '<i2' codes
+
+
+def write_dense(outdir, data, fields, columns, na='NA', header=True):
+    '''
+    Write one dense CSV matrix per field to outdir in a single walk over data.
+    Data maps learner -> item -> record (a namedtuple); columns fixes the item order.
+    Learners with no items are skipped. With header=False, only data rows are written.
+    '''
+    if not fields:
+        return
+    position = dict((item, n + 1) for n, item in enumerate(columns))
+    getter = attrgetter(*fields) if len(fields) > 1 else lambda record: (getattr(record, fields[0]),)
+
+    files = [open(os.path.join(outdir, '%s.csv' % field), 'w') for field in fields]
+    try:
+        writers = [csv.writer(f) for f in files]
+        if header:
+            for wrt in writers:
+                wrt.writerow(['learner'] + list(columns))
+
+        for learner in data.keys():
+            items = data[learner]
+            if not len(items):
+                continue  # Ignore rows for learners that tried no problems
+
+            # Fill one row per field from a single pass over the learner's items
+            rows = [[learner] + [na] * len(columns) for _ in fields]
+            for item, record in items.items():
+                idx = position[item]
+                for row, value in zip(rows, getter(record)):
+                    row[idx] = value
+            for wrt, row in zip(writers, rows):
+                wrt.writerow(row)
+    finally:
+        for f in files:
+            f.close()
+
+
+def write_dense_columns(outdir, table, fields, columns, na='NA', header=True, block=1024):
+    '''
+    Write one dense CSV matrix per field to outdir, as write_dense does, from a
+    columnar.PairTable. Rows follow learner codes and are filled a block of
+    learners at a time by array assignment rather than cell by cell.
+    '''
+    import numpy as np
+    from columnar import group_bounds
+
+    if not fields:
+        return
+    position = dict((item, n) for n, item in enumerate(columns))
+    cols = np.array([position.get(item, -1) for item in table.vocab['item'].values], dtype=np.int64)[table.item]
+    starts, counts = group_bounds(table.learner)
+    rows = np.repeat(np.arange(len(starts)), counts)
+    learners = [table.vocab['learner'].values[code] for code in table.learner[starts].tolist()]
+    values = [table.values(field) for field in fields]
+
+    files = [open(os.path.join(outdir, '%s.csv' % field), 'w') for field in fields]
+    try:
+        writers = [csv.writer(f) for f in files]
+        if header:
+            for wrt in writers:
+                wrt.writerow(['learner'] + list(columns))
+
+        for lo in range(0, len(starts), block):
+            hi = min(lo + block, len(starts))
+            first, last = starts[lo], starts[hi - 1] + counts[hi - 1]
+            for wrt, column in zip(writers, values):
+                grid = np.empty((hi - lo, len(columns)), dtype=object)
+                grid.fill(na)
+                grid[rows[first:last] - lo, cols[first:last]] = column[first:last]
+                wrt.writerows([learner] + row for learner, row in izip(learners[lo:hi], grid.tolist()))
+    finally:
+        for f in files:
+            f.close()
+
+
+def write_sparse(outdir, tables, columns):
+    '''
+    Write one memory-mappable triplet file <field>.npy per field to outdir, plus
+    shared index files learners.txt, items.txt and codes.txt. Tables is a list of
+    (data, fields) pairs as for write_dense. Each triplet file is a structured
+    array of (row, col, value) sorted by row then col; string values such as
+    grades are stored as integer codes into codes.txt.
+    '''
+    import numpy as np
+
+    # Shared learner index: every learner with at least one item in any table
+    learners = list()
+    row_of = dict()
+    for data, fields in tables:
+        if not fields:
+            continue
+        for learner in data.keys():
+            if len(data[learner]) and learner not in row_of:
+                row_of[learner] = len(learners)
+                learners.append(learner)
+    col_of = dict((item, n) for n, item in enumerate(columns))
+    codes = dict()
+
+    for data, fields in tables:
+        if not fields:
+            continue
+        getter = attrgetter(*fields) if len(fields) > 1 else lambda record: (getattr(record, fields[0]),)
+
+        # Walk the table once, collecting coordinates and every field's values
+        rows, cols = array.array('l'), array.array('l')
+        values = [list() for _ in fields]
+        for learner in learners:
+            items = data.get(learner)
+            if not items:
+                continue
+            row = row_of[learner]
+            for col, item in sorted((col_of[item], item) for item in items.keys()):
+                rows.append(row)
+                cols.append(col)
+                for column, value in zip(values, getter(items[item])):
+                    column.append(value)
+
+        for field, column in zip(fields, values):
+            if column and isinstance(column[0], basestring):
+                column = [codes.setdefault(value, len(codes)) for value in column]
+                check_codes(codes, field)
+                dtype = '<i2'
+            elif column and isinstance(column[0], float):
+                dtype = '<f8'
+            else:
+                dtype = '<i4'
+            triplets = np.empty(len(rows), dtype=[('row', '<i4'), ('col', '<i4'), ('value', dtype)])
+            triplets['row'] = rows
+            triplets['col'] = cols
+            triplets['value'] = column
+            np.save(os.path.join(outdir, '%s.npy' % field), triplets)
+
+    write_index(os.path.join(outdir, 'learners.txt'), learners)
+    write_index(os.path.join(outdir, 'items.txt'), columns)
+    write_index(os.path.join(outdir, 'codes.txt'), sorted(codes, key=codes.get))
+
+
+def write_sparse_columns(outdir, tables, columns):
+    '''
+    Write the triplet and index files of write_sparse from (columnar.PairTable,
+    fields) pairs whose tables share one learner and item vocabulary. Rows
+    follow learner codes; coded fields are mapped to codes.txt a vocabulary
+    at a time rather than value by value.
+    '''
+    import numpy as np
+
+    # Shared learner index: every learner with at least one item in any table
+    used = [(table, fields) for table, fields in tables if fields]
+    present = np.unique(np.concatenate([table.learner for table, _ in used])) if used else np.zeros(0, dtype=np.int64)
+    learners = [used[0][0].vocab['learner'].values[code] for code in present.tolist()] if used else []
+    position = dict((item, n) for n, item in enumerate(columns))
+    codes = dict()
+
+    for table, fields in used:
+        rows = np.searchsorted(present, table.learner)
+        cols = np.array([position.get(item, -1) for item in table.vocab['item'].values], dtype=np.int64)[table.item]
+        order = np.lexsort((cols, rows))
+        rows, cols = rows[order], cols[order]
+
+        for field in fields:
+            column = table.fields[field][order]
+            if not len(column):
+                dtype = '<i4'
+            elif field in table.vocab:
+                values = table.vocab[field].values
+                recode = np.zeros(len(values), dtype=np.int64)
+                for code in np.unique(column).tolist():
+                    recode[code] = codes.setdefault(values[code], len(codes))
+                check_codes(codes, field)
+                column, dtype = recode[column], '<i2'
+            elif column.dtype.kind == 'f':
+                dtype = '<f8'
+            else:
+                dtype = '<i4'
+            triplets = np.empty(len(rows), dtype=[('row', '<i4'), ('col', '<i4'), ('value', dtype)])
+            triplets['row'] = rows
+            triplets['col'] = cols
+            triplets['value'] = column
+            np.save(os.path.join(outdir, '%s.npy' % field), triplets)
+
+    write_index(os.path.join(outdir, 'learners.txt'), learners)
+    write_index(os.path.join(outdir, 'items.txt'), columns)
+    write_index(os.path.join(outdir, 'codes.txt'), sorted(codes, key=codes.get))
+
+
+def check_codes(codes, field):
+    '''
+    Raise if there are more distinct string values than '<i2' codes can hold,
+    rather than let them wrap around.
+    '''
+    if len(codes) > CODE_LIMIT:
+        raise ValueError('%s: %d distinct string values, more than the %d sparse codes' % (field, len(codes), CODE_LIMIT))
+
+
+def concat_dense(outdir, partdirs, fields, columns):
+    '''
+    Join headerless dense parts written with the same columns into one
+    <field>.csv per field in outdir, copying the parts through unparsed.
+    '''
+    for field in fields:
+        with open(os.path.join(outdir, '%s.csv' % field), 'wb') as out:
+            csv.writer(out).writerow(['learner'] + list(columns))
+            for part in partdirs:
+                with open(os.path.join(part, '%s.csv' % field), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+
+
+def concat_sparse(outdir, partdirs, fields, columns):
+    '''
+    Join sparse parts written with the same columns and disjoint learners into
+    one set of triplet and index files in outdir. Rows are offset by the
+    learners before each part and string codes are mapped to a shared codes.txt.
+    '''
+    import numpy as np
+
+    learners, offsets = list(), list()
+    for part in partdirs:
+        offsets.append(len(learners))
+        learners.extend(read_index(os.path.join(part, 'learners.txt')))
+
+    codes = dict()
+    remaps = dict()
+    for field in fields:
+        pieces = list()
+        for part, offset in zip(partdirs, offsets):
+            triplets = np.load(os.path.join(part, '%s.npy' % field))
+            if not len(triplets):
+                continue
+            triplets['row'] += offset
+            if triplets.dtype['value'] == np.dtype('<i2'):
+                if part not in remaps:
+                    part_codes = read_index(os.path.join(part, 'codes.txt'))
+                    remap = [codes.setdefault(code, len(codes)) for code in part_codes]
+                    check_codes(codes, field)
+                    remaps[part] = np.array(remap, dtype='<i2')
+                triplets['value'] = remaps[part][triplets['value']]
+            pieces.append(triplets)
+        if pieces:
+            dtype = [('row', '<i4'), ('col', '<i4'), ('value', np.result_type(*[piece.dtype['value'] for piece in pieces]))]
+            merged = np.concatenate([piece.astype(dtype) for piece in pieces])
+        else:
+            merged = np.empty(0, dtype=[('row', '<i4'), ('col', '<i4'), ('value', '<i4')])
+        np.save(os.path.join(outdir, '%s.npy' % field), merged)
+
+    write_index(os.path.join(outdir, 'learners.txt'), learners)
+    write_index(os.path.join(outdir, 'items.txt'), columns)
+    write_index(os.path.join(outdir, 'codes.txt'), sorted(codes, key=codes.get))
+
+
+def patch_dense(outdir, data, fields, columns, learners, na='NA'):
+    '''
+    Update the dense matrices in outdir for the given learners only: their rows
+    are replaced from data (or dropped if they have no items left) and every
+    other row is copied through, moved into columns if items were added.
+    Matrices not in outdir yet are written from data.
+    '''
+    position = dict((item, n + 1) for n, item in enumerate(columns))
+    for field in fields:
+        path = os.path.join(outdir, '%s.csv' % field)
+        if not os.path.exists(path):
+            write_dense(outdir, data, [field], columns, na)
+            continue
+        with open(path, 'rb') as f, open(path + '.tmp', 'wb') as out:
+            old = next(csv.reader([f.readline()]))[1:]
+            wrt = csv.writer(out)
+            wrt.writerow(['learner'] + list(columns))
+            if old == list(columns):
+                # Copy the other rows through unparsed
+                for line in f:
+                    learner = next(csv.reader([line]))[0] if line.startswith('"') else line.split(',', 1)[0]
+                    if learner not in learners:
+                        out.write(line)
+            else:
+                moved = [position[item] for item in old]
+                for row in csv.reader(f):
+                    if row[0] in learners:
+                        continue
+                    values, row = row[1:], [row[0]] + [na] * len(columns)
+                    for idx, value in izip(moved, values):
+                        row[idx] = value
+                    wrt.writerow(row)
+            for learner in learners:
+                items = data.get(learner)
+                if not items:
+                    continue
+                row = [learner] + [na] * len(columns)
+                for item, record in items.items():
+                    row[position[item]] = getattr(record, field)
+                wrt.writerow(row)
+        os.rename(path + '.tmp', path)
+
+
+def patch_sparse(outdir, tables, columns, learners):
+    '''
+    Update the sparse matrices in outdir for the given learners only, as
+    patch_dense does. Existing learners keep their rows and new ones are
+    appended to learners.txt; in each triplet file just the given learners'
+    blocks of rows are replaced, by their rows from tables sorted on their
+    own, and new string values are appended to codes.txt. If items were added
+    or a learner has no items left, the matrices are rewritten with
+    rewrite_sparse instead. Writes everything from tables if outdir has no
+    matrices yet.
+    '''
+    import numpy as np
+    if not os.path.exists(os.path.join(outdir, 'learners.txt')):
+        return write_sparse(outdir, tables, columns)
+    old_learners = read_index(os.path.join(outdir, 'learners.txt'))
+    row_of = dict((learner, n) for n, learner in enumerate(old_learners))
+    present = set(learner for learner in learners if any(data.get(learner) for data, fields in tables if fields))
+    emptied = [learner for learner in learners if learner in row_of and learner not in present]
+    if emptied or read_index(os.path.join(outdir, 'items.txt')) != list(columns):
+        return rewrite_sparse(outdir, tables, columns, learners)
+
+    added = sorted(learner for learner in present if learner not in row_of)
+    for learner in added:
+        row_of[learner] = len(row_of)
+    changed = np.array(sorted(row_of[learner] for learner in learners if learner in row_of and learner not in added), dtype='<i4')
+    old_codes = read_index(os.path.join(outdir, 'codes.txt'))
+    code_of = dict((code, n) for n, code in enumerate(old_codes))
+
+    tmp = tempfile.mkdtemp(prefix='patch-', dir=outdir)
+    try:
+        # The given learners' rows on their own, renumbered to their rows in outdir
+        write_sparse(tmp, [(dict((learner, data[learner]) for learner in learners if data.get(learner)), table_fields)
+                           for data, table_fields in tables], columns)
+        rows = np.array([row_of[learner] for learner in read_index(os.path.join(tmp, 'learners.txt'))], dtype='<i4')
+        remap = [code_of.setdefault(code, len(code_of)) for code in read_index(os.path.join(tmp, 'codes.txt'))]
+
+        for field in [field for _, table_fields in tables for field in table_fields]:
+            path = os.path.join(outdir, '%s.npy' % field)
+            new = np.load(os.path.join(tmp, '%s.npy' % field))
+            new['row'] = rows[new['row']]
+            if new.dtype['value'] == np.dtype('<i2'):
+                check_codes(code_of, field)
+                new['value'] = np.array(remap, dtype='<i2')[new['value']]
+            new = new[np.lexsort((new['col'], new['row']))]
+            old = np.load(path) if os.path.exists(path) else new[:0]
+            if not len(old):
+                old = old.astype(new.dtype)
+            elif len(new) and new.dtype != old.dtype:
+                dtype = [('row', '<i4'), ('col', '<i4'), ('value', np.result_type(old.dtype['value'], new.dtype['value']))]
+                old, new = old.astype(dtype), new.astype(dtype)
+
+            # Cut out the changed learners' blocks and insert their new rows in row order
+            bounds = np.zeros(len(old) + 1, dtype='<i4')
+            np.add.at(bounds, np.searchsorted(old['row'], changed, 'left'), 1)
+            np.add.at(bounds, np.searchsorted(old['row'], changed, 'right'), -1)
+            old = old[np.cumsum(bounds[:-1]) == 0]
+            np.save(path, np.insert(old, np.searchsorted(old['row'], new['row'], 'left'), new))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    with open(os.path.join(outdir, 'learners.txt'), 'a') as f:
+        for learner in added:
+            f.write('%s\n' % learner)
+    with open(os.path.join(outdir, 'codes.txt'), 'a') as f:
+        for code in sorted(code_of, key=code_of.get)[len(old_codes):]:
+            f.write('%s\n' % code)
+
+
+def rewrite_sparse(outdir, tables, columns, learners):
+    '''
+    Rewrite the sparse matrices in outdir with the given learners' rows
+    replaced from tables: the other learners' triplets are kept, renumbered
+    and moved into columns, and joined with the new rows.
+    '''
+    import numpy as np
+    old_learners = read_index(os.path.join(outdir, 'learners.txt'))
+    keep = np.array([learner not in learners for learner in old_learners], dtype=bool)
+    rows = np.cumsum(keep) - 1
+    col_of = dict((item, n) for n, item in enumerate(columns))
+    cols = np.array([col_of[item] for item in read_index(os.path.join(outdir, 'items.txt'))], dtype='<i4')
+    fields = [field for _, table_fields in tables for field in table_fields]
+
+    # Split into a part with the kept rows and a part with the new ones, then join them
+    tmp = tempfile.mkdtemp(prefix='patch-', dir=outdir)
+    try:
+        kept, changed = os.path.join(tmp, 'kept'), os.path.join(tmp, 'changed')
+        os.mkdir(kept)
+        os.mkdir(changed)
+        for field in fields:
+            triplets = np.load(os.path.join(outdir, '%s.npy' % field))
+            triplets = triplets[keep[triplets['row']]] if len(triplets) else triplets
+            triplets['row'] = rows[triplets['row']]
+            triplets['col'] = cols[triplets['col']]
+            np.save(os.path.join(kept, '%s.npy' % field), triplets)
+        write_index(os.path.join(kept, 'learners.txt'), [learner for learner, k in izip(old_learners, keep) if k])
+        shutil.copy(os.path.join(outdir, 'codes.txt'), kept)
+
+        write_sparse(changed, [(dict((learner, data[learner]) for learner in learners if data.get(learner)), table_fields)
+                               for data, table_fields in tables], columns)
+        concat_sparse(outdir, [kept, changed], fields, columns)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def write_index(path, labels):
+    '''
+    Write labels one per line; line n names row or column n.
+    '''
+    with open(path, 'w') as f:
+        for label in labels:
+            f.write('%s\n' % label)
+
+
+def read_index(path):
+    '''
+    Read an index file written by write_index.
+    '''
+    with open(path, 'rU') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def read_sparse(outdir, field):
+    '''
+    Memory-map the triplets for one field written by write_sparse.
+    '''
+    import numpy as np
+    return np.load(os.path.join(outdir, '%s.npy' % field), mmap_mode='r')
@@ -0,0 +1,83 @@
+# Sorted streaming access to CSV rows that may not fit in memory
+#
+
+import csv
+import heapq
+import os
+import shutil
+import tempfile
+from itertools import islice
+
+
+class Unsorted(ValueError):
+    '''
+    Raised by ordered_rows on the first row that is out of order.
+    '''
+
+
+def ordered_rows(header, rows, key):
+    '''
+    Yield rows that are expected to be sorted ascending on column key,
+    checking the order as they stream past, so sorted input is read once.
+    Raises Unsorted at the first row that is out of order; rows already
+    yielded are then only a prefix, and the caller must start over.
+    '''
+    idx = header.index(key)
+    previous = None
+    for n, row in enumerate(rows):
+        if not row:
+            continue
+        if previous is not None and row[idx] < previous:
+            raise Unsorted('row %d is out of order on %s' % (n, key))
+        previous = row[idx]
+        yield row
+
+
+def sorted_rows(header, rows, key, run_size=500000, tmpdir=None):
+    '''
+    Yield rows (lists of values) stably sorted on column key.
+    Sorts in memory if the rows fit in one run of run_size; otherwise
+    writes sorted runs to disk and merges them, holding one row per run.
+    '''
+    idx = header.index(key)
+    rows = (row for row in rows if row)
+
+    # Sort the first run in memory; finish here if nothing is left over
+    run = list(islice(rows, run_size))
+    run.sort(key=lambda r: r[idx])
+    nxt = list(islice(rows, run_size))
+    if not nxt:
+        for row in run:
+            yield row
+        return
+
+    # Spill sorted runs to disk
+    rundir = tempfile.mkdtemp(prefix='extsort-', dir=tmpdir)
+    try:
+        paths = []
+        while run:
+            paths.append(os.path.join(rundir, 'run%05d.csv' % len(paths)))
+            with open(paths[-1], 'wb') as out:
+                csv.writer(out).writerows(run)
+            run, nxt = nxt, list(islice(rows, run_size))
+            run.sort(key=lambda r: r[idx])
+
+        # Merge runs; ties break on run then position, so the sort stays stable
+        files = [open(p, 'rb') for p in paths]
+        try:
+            streams = [decorate(csv.reader(runfile), idx, n) for n, runfile in enumerate(files)]
+            for _, _, _, row in heapq.merge(*streams):
+                yield row
+        finally:
+            for runfile in files:
+                runfile.close()
+    finally:
+        shutil.rmtree(rundir, ignore_errors=True)
+
+
+def decorate(rows, idx, run):
+    '''
+    Wrap rows of a sorted run as (key, run, position, row) tuples for merging.
+    '''
+    for pos, row in enumerate(rows):
+        yield row[idx], run, pos, row
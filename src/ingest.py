@@ -0,0 +1,127 @@
+# Schema-aware reading of raw export files
+#
+# Raw files are named <course>_<Kind>.csv. Some SQL exports are written
+# without a header as <course>_<Kind>_headless.csv; these are read directly
+# using the schema below. Course IDs containing '.' come out of the exports
+# with '_' in their problem IDs; the FIXUPS table repairs them line by line
+# while reading.
+#
+
+import csv
+import os
+from contextlib import contextmanager
+from itertools import chain
+
+# Column names for each raw file type, as selected by the queries in sql/
+SCHEMAS = {
+    'ProblemEvents': ['event_id', 'anon_screen_name', 'event_type', 'event_source', 'time', 'resource_display_name', 'page',
+                      'problem_id', 'problem_choice', 'submission_id', 'attempts', 'success', 'answer_id', 'answer'],
+    'BrowseEvents': ['event_id', 'event_type', 'anon_screen_name', 'time', 'problem_id'],
+    'ProblemMetadata': ['problem_id', 'problem_display_name', 'course_display_name', 'problem_text', 'trackevent_hook',
+                        'vertical_uri', 'problem_idx', 'sequential_uri', 'vertical_idx', 'chapter_uri', 'sequential_idx',
+                        'chapter_idx', 'staff_only', 'context'],
+    'Certificates': ['anon_screen_name', 'course_display_name', 'grade', 'created_date', 'certificate_granted'],
+    'Registrations': ['anon_screen_name', 'course_display_name', 'enrolled'],
+    'ViewProgress': ['anon_screen_name', 'event_type', 'time'],
+    'VideoEvents': ['event_type', 'resource_display_name', 'video_current_time', 'video_speed', 'video_new_speed',
+                    'video_old_speed', 'video_new_time', 'video_old_time', 'video_seek_type', 'video_codec', 'time',
+                    'course_display_name', 'quarter', 'anon_screen_name', 'video_id'],
+    'ActivityGrade': ['anon_screen_name', 'module_id', 'module_type', 'grade', 'max_grade', 'percent_grade', 'num_attempts',
+                      'first_submit', 'last_submit'],
+    'CourseInfo': ['course_display_name', 'course_catalog_name', 'academic_year', 'quarter', 'total_enrollment', 'self_paced',
+                   'start_date', 'enrollment_start', 'end_date', 'enrollment_end', 'grade_policy', 'certs_policy'],
+}
+
+# Per-course (find, replace) fixups for course IDs containing '.', by raw file type
+FIXUPS = {
+    'Medicine_MedStats._Summer2015': {'ProblemEvents': [('-MedStats_-', '-MedStats.-')]},
+    'Engineering_QMSE01._Autumn2015': {'ProblemEvents': [('-QMSE01_-', '-QMSE01.-')]},
+    'GlobalHealth_INT.WomensHealth_July2015': {'ProblemEvents': [('-INT_WomensHealth-', '-INT.WomensHealth-')]},
+    'Medicine_SciWrite._Fall2015': {'ProblemEvents': [('-SciWrite_-', '-SciWrite.-')]},
+}
+
+
+def parse_name(path):
+    '''
+    Split a raw file path into (course, kind), e.g. ('Engineering_QMSE-02_Winter2015', 'BrowseEvents').
+    Kind is None if the file name doesn't follow the raw naming scheme.
+    '''
+    name = os.path.basename(path)
+    if name.endswith('.csv'):
+        name = name[:-len('.csv')]
+    if name.endswith('_headless'):
+        name = name[:-len('_headless')]
+    course, _, kind = name.rpartition('_')
+    if kind not in SCHEMAS:
+        return name, None
+    return course, kind
+
+
+def locate(path):
+    '''
+    Return the file to read for a raw file path: the path itself, or its
+    _headless variant if only that exists.
+    '''
+    if not os.path.exists(path) and path.endswith('.csv'):
+        headless = path[:-len('.csv')] + '_headless.csv'
+        if os.path.exists(headless):
+            return headless
+    return path
+
+
+def fixups(path):
+    '''
+    The (find, replace) pairs to apply to a raw file.
+    '''
+    course, kind = parse_name(path)
+    return FIXUPS.get(course, {}).get(kind, [])
+
+
+def apply_fixups(lines, pairs):
+    '''
+    Apply (find, replace) pairs to each line of a stream.
+    '''
+    for line in lines:
+        for find, replace in pairs:
+            line = line.replace(find, replace)
+        yield line
+
+
+def normalize(header):
+    '''
+    Strip whitespace and quoting left around column names by the header scripts.
+    '''
+    return [name.strip().strip('"').strip("'") for name in header]
+
+
+@contextmanager
+def open_raw(path):
+    '''
+    Open a raw file for reading as (header, rows), where rows yields lists of
+    values. Headless files get their header from SCHEMAS, and any course ID
+    fixups are applied as rows are read.
+    '''
+    _, kind = parse_name(path)
+    with open(locate(path), 'rU') as f:
+        pairs = fixups(path)
+        rows = csv.reader(apply_fixups(f, pairs) if pairs else f)
+        first = next(rows, None)
+        if kind is None or (first is not None and set(SCHEMAS[kind]) <= set(normalize(first))):
+            header = normalize(first) if first is not None else []
+        else:
+            header = SCHEMAS[kind]  # Headless: the first line is data
+            rows = chain([first], rows) if first is not None else rows
+        yield header, rows
+
+
+def read_rows(path):
+    '''
+    Generate the rows of a raw file as dicts keyed by column name.
+    '''
+    with open_raw(path) as (header, rows):
+        for row in rows:
+            if not row:
+                continue  # Skip blank lines, as csv.DictReader does
+            if len(row) < len(header):
+                row = row + [None] * (len(header) - len(row))
+            yield dict(zip(header, row))
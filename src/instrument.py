@@ -0,0 +1,141 @@
+# Per-phase timing, throughput and memory metrics, with optional profiling
+#
+
+import cProfile
+import json
+import os
+import signal
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+import pipeline
+from parallel import peak_rss_mb
+
+# Every phase Metrics records, in the order a course runs them; --profile-phase offers the same names
+PHASES = (['read_attempts', 'read_delta', 'read_grades', 'partition', 'process_shards', 'compute_attempts', 'compute_delta',
+           'compute_timing'] + sorted(set('load_%s' % kind for kind, _, _ in pipeline.COVARIATES.values())) +
+          ['export', 'concatenate', 'fit', 'store'])
+
+
+def phase(name):
+    '''
+    Decorate an ItemMatrixComputer method to run as the named phase of self.metrics.
+    '''
+    def decorate(method):
+        @wraps(method)
+        def measured(self, *args, **kwargs):
+            with self.metrics.phase(name):
+                return method(self, *args, **kwargs)
+        return measured
+    return decorate
+
+
+def cpu_time():
+    '''
+    User plus system CPU seconds used by this process.
+    '''
+    times = os.times()
+    return times[0] + times[1]
+
+
+class StackSampler(object):
+    '''
+    Statistical profiler: samples the main thread's Python stack on a CPU-time
+    timer and counts collapsed stacks, in the "folded" format read by flame
+    graph tools. Cheaper than cProfile on long phases; Unix only.
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+
+    def sample(self, signum, frame):
+        stack = list()
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+    def dump_stats(self, path):
+        with open(path, 'w') as out:
+            for stack, count in sorted(self.stacks.items()):
+                out.write('%s %d\n' % (stack, count))
+
+
+PROFILERS = {'cprofile': (cProfile.Profile, '.prof'), 'sampling': (StackSampler, '.folded')}
+
+
+class Metrics(object):
+    '''
+    Collects one record per phase run: wall and CPU seconds, rows read, kept
+    and dropped, rows read per second and peak RSS so far. If profile names a
+    phase, that phase runs under the chosen profiler ('cprofile' or
+    'sampling') and its output is written to profile_dir as <prefix><phase>.prof
+    or <prefix><phase>.folded.
+    '''
+
+    def __init__(self, profile=None, profiler='cprofile', profile_dir='.', prefix=''):
+        self.profile = profile
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.prefix = prefix
+        self.phases = list()
+        self.current = None
+
+    @contextmanager
+    def phase(self, name):
+        if name not in PHASES:
+            raise ValueError('unknown phase %s, add it to instrument.PHASES' % name)
+        record = {'phase': name, 'rows_read': None, 'rows_kept': None, 'rows_dropped': None}
+        outer, self.current = self.current, record
+        profiler = None
+        if name == self.profile:
+            profiler = PROFILERS[self.profiler][0]()
+            profiler.enable()
+        wall, cpu = time.time(), cpu_time()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = time.time() - wall
+            record['cpu_seconds'] = cpu_time() - cpu
+            if profiler is not None:
+                profiler.disable()
+                record['profile'] = os.path.join(self.profile_dir, self.prefix + name + PROFILERS[self.profiler][1])
+                profiler.dump_stats(record['profile'])
+            record['rows_per_second'] = record['rows_read'] / record['wall_seconds'] if record['rows_read'] and record['wall_seconds'] else None
+            record['peak_rss_mb'] = peak_rss_mb()
+            self.phases.append(record)
+            self.current = outer
+
+    def rows(self, read, kept, dropped=0):
+        '''
+        Set row counts for the phase that is running, if any.
+        '''
+        if self.current is not None:
+            self.current.update(rows_read=read, rows_kept=kept, rows_dropped=dropped)
+
+    def summary(self, **info):
+        '''
+        All phase records plus totals, with any extra info (e.g. course_id) at the top level.
+        '''
+        record = dict(info)
+        record['phases'] = self.phases
+        record['wall_seconds'] = sum(p['wall_seconds'] for p in self.phases)
+        record['cpu_seconds'] = sum(p['cpu_seconds'] for p in self.phases)
+        record['peak_rss_mb'] = max([p['peak_rss_mb'] for p in self.phases] or [peak_rss_mb()])
+        return record
+
+    def write(self, outfile, **info):
+        with open(outfile, 'w') as out:
+            json.dump(self.summary(**info), out, indent=4)
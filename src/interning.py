@@ -0,0 +1,84 @@
+# Compact interned storage for per-learner-item event data
+#
+# Strings that repeat across events (learners, items, grades, pages, resource
+# names) are stored once in a Vocabulary and referred to by integer code.
+#
+
+import array
+import bisect
+
+
+class Vocabulary(object):
+    '''
+    Maps strings to dense integer codes, in order of first appearance.
+    '''
+
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = dict((value, code) for code, value in enumerate(self.values))
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, value):
+        '''
+        Return the integer code for value, assigning a new one if needed.
+        '''
+        try:
+            return self.codes[value]
+        except KeyError:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+            return self.codes[value]
+
+    def mask(self, predicate):
+        '''
+        Boolean array over codes marking the values for which predicate holds.
+        '''
+        import numpy as np
+        return np.array([bool(predicate(value)) for value in self.values], dtype=bool)
+
+
+def pair_key(learner, item):
+    '''
+    Pack a learner code and an item code into a single int dict key.
+    '''
+    return learner << 32 | item
+
+
+def unpack_key(key):
+    '''
+    Learner code and item code from a pair_key.
+    '''
+    return key >> 32, key & 0xffffffff
+
+
+class AttemptLog(object):
+    '''
+    One learner's submissions for one item: times and grade codes in parallel
+    arrays, kept in time order as they are added.
+    '''
+    __slots__ = ('times', 'grades')
+
+    def __init__(self, times=(), grades=()):
+        self.times = array.array('d', times)
+        self.grades = array.array('i', grades)
+
+    def add(self, time, grade):
+        '''
+        Insert a submission in time order, after any at the same time. Submissions
+        mostly arrive in order, so this is usually an append.
+        '''
+        if not self.times or time >= self.times[-1]:
+            self.times.append(time)
+            self.grades.append(grade)
+        else:
+            n = bisect.bisect_right(self.times, time)
+            self.times.insert(n, time)
+            self.grades.insert(n, grade)
+
+    def ordered(self):
+        '''
+        Times and grade codes in time order; ties keep the order they were added in.
+        '''
+        return self.times, self.grades
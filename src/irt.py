@@ -0,0 +1,259 @@
+# Rasch and 2PL item response models fit directly on computed grades
+#
+# Responses are kept sparse as (learner, item, outcome) triplets, so missing
+# responses are simply absent and cost nothing. Parameters are estimated by
+# joint maximum likelihood, with every learner's and item's Newton step
+# computed at once from np.bincount sums over the observed responses.
+#
+
+import csv
+import os
+from collections import defaultdict, namedtuple
+
+import numpy as np
+
+import export
+
+MODELS = ['rasch', '2pl']
+
+# Grade strings scored as responses; any other grade counts as missing
+OUTCOMES = {'correct': 1, 'incorrect': 0}
+
+Responses = namedtuple('Responses', ['learners', 'items', 'rows', 'cols', 'outcomes'])
+
+
+def responses(data, field='first_grade', columns=None):
+    '''
+    Collect scored responses from learner -> item -> ItemAttemptData, using the
+    grade in field. Columns fixes the item order (by default, sorted items).
+    '''
+    if columns is None:
+        columns = sorted(set(item for items in data.values() for item in items))
+    col_of = dict((item, n) for n, item in enumerate(columns))
+    learners, rows, cols, outcomes = list(), list(), list(), list()
+    for learner in data.keys():
+        row = len(learners)
+        for item, record in data[learner].items():
+            outcome = OUTCOMES.get(getattr(record, field))
+            if outcome is not None:
+                rows.append(row)
+                cols.append(col_of[item])
+                outcomes.append(outcome)
+        if len(rows) and rows[-1] == row:
+            learners.append(learner)
+    return Responses(learners, list(columns), np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64),
+                     np.array(outcomes, dtype=np.float64))
+
+
+def table_responses(table, field='first_grade', columns=None):
+    '''
+    Collect scored responses from a columnar.PairTable, as responses does from
+    records, scoring each grade code once rather than each pair.
+    '''
+    items = table.vocab['item'].values
+    if columns is None:
+        columns = sorted(items[code] for code in np.unique(table.item).tolist())
+    col_of = dict((item, n) for n, item in enumerate(columns))
+    scores = np.array([OUTCOMES.get(value, -1) for value in table.vocab[field].values] or [-1])
+    outcomes = scores[table.fields[field]]
+    keep = outcomes >= 0
+    present, rows = np.unique(table.learner[keep], return_inverse=True)
+    cols = np.array([col_of.get(item, -1) for item in items] or [-1])[table.item[keep]]
+    learners = table.vocab['learner'].values
+    return Responses([learners[code] for code in present.tolist()], list(columns), rows.astype(np.int64), cols.astype(np.int64),
+                     outcomes[keep].astype(np.float64))
+
+
+def load_responses(outdir, field='first_grade'):
+    '''
+    Collect scored responses for field from matrices exported to outdir, as
+    <field>.npy triplets if present, otherwise <field>.csv.
+    '''
+    if os.path.exists(os.path.join(outdir, '%s.npy' % field)):
+        triplets = export.read_sparse(outdir, field)
+        codes = export.read_index(os.path.join(outdir, 'codes.txt'))
+        scores = np.array([OUTCOMES.get(code, -1) for code in codes] or [-1])
+        outcomes = scores[triplets['value']]
+        keep = outcomes >= 0
+        return Responses(export.read_index(os.path.join(outdir, 'learners.txt')), export.read_index(os.path.join(outdir, 'items.txt')),
+                         triplets['row'][keep].astype(np.int64), triplets['col'][keep].astype(np.int64),
+                         outcomes[keep].astype(np.float64))
+
+    learners, rows, cols, outcomes = list(), list(), list(), list()
+    with open(os.path.join(outdir, '%s.csv' % field), 'rU') as f:
+        reader = csv.reader(f)
+        items = next(reader)[1:]
+        for line in reader:
+            found = False
+            for col, value in enumerate(line[1:]):
+                outcome = OUTCOMES.get(value)
+                if outcome is not None:
+                    rows.append(len(learners))
+                    cols.append(col)
+                    outcomes.append(outcome)
+                    found = True
+            if found:
+                learners.append(line[0])
+    return Responses(learners, items, np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64),
+                     np.array(outcomes, dtype=np.float64))
+
+
+class Fit(object):
+    '''
+    Estimated abilities (theta) per learner and difficulties (b) and
+    discriminations (a, all 1 for Rasch) per item, with response counts.
+    '''
+
+    def __init__(self, model, learners, items, theta, b, a, n_learner, n_item, iterations=0, converged=False, loglik=None):
+        self.model = model
+        self.learners = learners
+        self.items = items
+        self.theta = theta
+        self.b = b
+        self.a = a
+        self.n_learner = n_learner
+        self.n_item = n_item
+        self.iterations = iterations
+        self.converged = converged
+        self.loglik = loglik
+
+    def save(self, outdir):
+        '''
+        Write irt_<model>_items.csv and irt_<model>_learners.csv to outdir.
+        '''
+        with open(os.path.join(outdir, 'irt_%s_items.csv' % self.model), 'wb') as f:
+            wrt = csv.writer(f)
+            wrt.writerow(['item', 'a', 'b', 'n'])
+            for row in zip(self.items, self.a.tolist(), self.b.tolist(), self.n_item.tolist()):
+                wrt.writerow(row)
+        with open(os.path.join(outdir, 'irt_%s_learners.csv' % self.model), 'wb') as f:
+            wrt = csv.writer(f)
+            wrt.writerow(['learner', 'theta', 'n'])
+            for row in zip(self.learners, self.theta.tolist(), self.n_learner.tolist()):
+                wrt.writerow(row)
+
+    @classmethod
+    def load(cls, outdir, model):
+        '''
+        Read a fit saved by save(), or return None if there isn't one.
+        '''
+        paths = [os.path.join(outdir, 'irt_%s_%s.csv' % (model, kind)) for kind in ['items', 'learners']]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        with open(paths[0], 'rU') as f:
+            items = list(csv.DictReader(f))
+        with open(paths[1], 'rU') as f:
+            learners = list(csv.DictReader(f))
+        return cls(model, [r['learner'] for r in learners], [r['item'] for r in items],
+                   np.array([float(r['theta']) for r in learners]), np.array([float(r['b']) for r in items]),
+                   np.array([float(r['a']) for r in items]), np.array([int(r['n']) for r in learners]),
+                   np.array([int(r['n']) for r in items]))
+
+
+def warm_start(labels, previous, default):
+    '''
+    Initial values for labels, taken from a previous fit's labels and values where they match.
+    '''
+    start = np.full(len(labels), default, dtype=np.float64)
+    if previous is not None:
+        index = dict((label, n) for n, label in enumerate(labels))
+        for label, value in zip(*previous):
+            if label in index:
+                start[index[label]] = value
+    return start
+
+
+def pool(fits):
+    '''
+    One Fit to warm-start from, pooling fits of the same model (None entries
+    are skipped). The first fit, usually the course's own previous one, takes
+    precedence; learners it lacks get their mean ability over the others, so
+    learners new to a course start from what their other courses estimated.
+    Items are taken from the first fit that has them.
+    '''
+    fits = [f for f in fits if f is not None]
+    if len(fits) < 2:
+        return fits[0] if fits else None
+    sums, counts = defaultdict(float), defaultdict(int)
+    for f in fits[1:]:
+        for learner, theta in zip(f.learners, f.theta.tolist()):
+            sums[learner] += theta
+            counts[learner] += 1
+    thetas = dict((learner, sums[learner] / counts[learner]) for learner in sums)
+    thetas.update(zip(fits[0].learners, fits[0].theta.tolist()))
+    params = dict()
+    for f in reversed(fits):
+        params.update(zip(f.items, zip(f.b.tolist(), f.a.tolist())))
+    learners, items = sorted(thetas), sorted(params)
+    return Fit(fits[0].model, learners, items, np.array([thetas[l] for l in learners]), np.array([params[i][0] for i in items]),
+               np.array([params[i][1] for i in items]), np.zeros(len(learners), dtype=np.int64), np.zeros(len(items), dtype=np.int64))
+
+
+def newton_step(grad, info, step=1.0):
+    '''
+    Newton updates from summed gradients and information, with each step clipped to +/-step.
+    '''
+    return np.clip(grad / np.maximum(info, 1e-9), -step, step)
+
+
+def fit(resp, model='rasch', init=None, max_iter=200, tol=1e-4, limit=6.0):
+    '''
+    Fit a Rasch or 2PL model to responses by joint maximum likelihood,
+    alternating vectorized Newton steps for abilities, difficulties and (2PL)
+    discriminations until no parameter moves more than tol. Parameters are
+    bounded to +/-limit, which keeps learners and items with all-correct or
+    all-incorrect responses finite. The scale is fixed by centering
+    difficulties (Rasch) or standardizing abilities (2PL). Init is a previous
+    Fit (e.g. an earlier run or another run of the course) to warm-start from,
+    matched by learner and item label.
+    '''
+    if model not in MODELS:
+        raise ValueError("Unknown IRT model: %s" % model)
+    rows, cols, y = resp.rows, resp.cols, resp.outcomes
+    n_learners, n_items = len(resp.learners), len(resp.items)
+    n_learner = np.bincount(rows, minlength=n_learners)
+    n_item = np.bincount(cols, minlength=n_items)
+
+    theta = warm_start(resp.learners, (init.learners, init.theta) if init else None, 0.0)
+    b = warm_start(resp.items, (init.items, init.b) if init else None, 0.0)
+    a = warm_start(resp.items, (init.items, init.a) if init and model == '2pl' else None, 1.0)
+
+    converged = False
+    iterations = 0
+    for iterations in range(1, max_iter + 1):
+        previous = np.concatenate([theta, b, a])
+
+        # Abilities
+        p = 1.0 / (1.0 + np.exp(-a[cols] * (theta[rows] - b[cols])))
+        theta += newton_step(np.bincount(rows, a[cols] * (y - p), n_learners),
+                             np.bincount(rows, a[cols] ** 2 * p * (1 - p), n_learners))
+        np.clip(theta, -limit, limit, out=theta)
+
+        # Difficulties
+        p = 1.0 / (1.0 + np.exp(-a[cols] * (theta[rows] - b[cols])))
+        b -= newton_step(np.bincount(cols, a[cols] * (y - p), n_items),
+                         np.bincount(cols, a[cols] ** 2 * p * (1 - p), n_items))
+        np.clip(b, -limit, limit, out=b)
+
+        # Discriminations
+        if model == '2pl':
+            p = 1.0 / (1.0 + np.exp(-a[cols] * (theta[rows] - b[cols])))
+            d = theta[rows] - b[cols]
+            a += newton_step(np.bincount(cols, d * (y - p), n_items),
+                             np.bincount(cols, d ** 2 * p * (1 - p), n_items), 0.5)
+
+        # Fix the scale
+        if model == '2pl' and n_learners > 1:
+            mean, sd = theta.mean(), max(theta.std(), 1e-9)
+            theta, b, a = (theta - mean) / sd, (b - mean) / sd, np.clip(a * sd, 0.05, 5.0)
+        elif n_items:
+            shift = b[n_item > 0].mean() if n_item.any() else 0.0
+            theta, b = theta - shift, b - shift
+
+        if len(previous) and np.abs(np.concatenate([theta, b, a]) - previous).max() < tol:
+            converged = True
+            break
+
+    z = a[cols] * (theta[rows] - b[cols])
+    loglik = -float(np.logaddexp(0, np.where(y > 0, -z, z)).sum())
+    return Fit(model, resp.learners, resp.items, theta, b, a, n_learner, n_item, iterations, converged, loglik)
@@ -0,0 +1,164 @@
+# Process-pool driver for running independent per-course jobs
+#
+
+from __future__ import print_function
+import Queue
+import json
+import multiprocessing
+import resource
+import sys
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+CourseStatus = namedtuple('CourseStatus', ['course_id', 'status', 'seconds', 'peak_rss_mb', 'error'])
+POLL_SECONDS = 0.1  # How often to check on running workers
+
+
+def limit_memory(max_memory):
+    '''
+    Cap this process's address space at max_memory MB, so a runaway course
+    raises MemoryError in its worker instead of taking down the machine.
+    '''
+    if max_memory:
+        limit = max_memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on OS X).
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def run_course(task):
+    '''
+    Run one course job, catching any failure so the rest of the batch carries on.
+    '''
+    func, course_id = task
+    start = time.time()
+    try:
+        func(course_id)
+        status, error = 'ok', None
+    except MemoryError:
+        status, error = 'out of memory', traceback.format_exc()
+    except Exception:
+        status, error = 'failed', traceback.format_exc()
+    return CourseStatus(course_id, status, time.time() - start, peak_rss_mb(), error)
+
+
+def run_child(task, conn, max_memory):
+    '''
+    Worker process body: cap memory, run one course and send back its CourseStatus.
+    '''
+    limit_memory(max_memory)
+    conn.send(run_course(task))
+    conn.close()
+
+
+def feed(course_ids, ready, failure):
+    '''
+    Put each course on the ready queue as it is yielded, then None when there
+    are no more. An error raised by course_ids is kept in failure.
+    '''
+    try:
+        for course_id in course_ids:
+            ready.put(course_id)
+    except BaseException:
+        failure.append(sys.exc_info())
+    finally:
+        ready.put(None)
+
+
+def run_courses(func, course_ids, workers=1, max_memory=None, total=None):
+    '''
+    Call func(course_id) for every course, each in its own worker process
+    capped at max_memory MB, with up to workers running at once. Memory is
+    returned between courses, and a worker that dies without reporting (killed
+    by the OOM killer, say) is recorded as failed rather than stalling the
+    batch. Course_ids may also be a generator that yields courses as they
+    become ready, in which case total gives the expected count for progress;
+    each course starts as soon as it is yielded and a worker is free. Returns
+    a list of CourseStatus, one per course.
+    '''
+    total = len(course_ids) if total is None else total
+    report = list()
+    if multiprocessing.current_process().daemon:
+        # Daemon processes can't have children; run in this one, without a memory cap
+        for course_id in course_ids:
+            report.append(run_course((func, course_id)))
+            print_progress(report[-1], len(report), total)
+        return report
+
+    ready, failure = Queue.Queue(), list()
+    feeder = threading.Thread(target=feed, args=(course_ids, ready, failure))
+    feeder.daemon = True
+    feeder.start()
+    running, more = dict(), True
+    try:
+        while more or running:
+            while more and len(running) < workers:
+                try:
+                    course_id = ready.get(timeout=POLL_SECONDS)
+                except Queue.Empty:
+                    break
+                if course_id is None:
+                    more = False
+                    break
+                receive, send = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=run_child, args=((func, course_id), send, max_memory))
+                process.start()
+                send.close()
+                running[course_id] = (process, receive, time.time())
+
+            for course_id, (process, receive, start) in running.items():
+                if not receive.poll() and process.is_alive():
+                    continue
+                result = None
+                if receive.poll():  # Again, in case it reported just before exiting
+                    try:
+                        result = receive.recv()
+                    except EOFError:
+                        pass  # Exited without reporting
+                process.join()
+                if result is None:
+                    result = CourseStatus(course_id, 'killed', time.time() - start, 0.0,
+                                          "worker exited with code %s before reporting" % process.exitcode)
+                receive.close()
+                del running[course_id]
+                report.append(result)
+                print_progress(result, len(report), total)
+            if running and (not more or len(running) == workers):
+                time.sleep(POLL_SECONDS)
+    finally:
+        for process, receive, start in running.values():
+            process.terminate()
+            process.join()
+
+    if failure:
+        raise failure[0][0], failure[0][1], failure[0][2]
+    return report
+
+
+def print_progress(result, done, total):
+    '''
+    Print one line of batch progress.
+    '''
+    print("[%d/%d] %s: %s (%.1fs, peak %.0f MB)" % (done, total, result.course_id, result.status, result.seconds, result.peak_rss_mb))
+    if result.error:
+        print(result.error)
+
+
+def write_report(report, outfile):
+    '''
+    Print a batch summary and write per-course statuses to outfile as JSON.
+    '''
+    failed = [r for r in report if r.status != 'ok']
+    print("Processed %d courses: %d ok, %d failed" % (len(report), len(report) - len(failed), len(failed)))
+    for result in failed:
+        print("  %s: %s" % (result.course_id, result.status))
+    with open(outfile, 'w') as out:
+        json.dump([r._asdict() for r in report], out, indent=4)
@@ -0,0 +1,120 @@
+# Demand-driven evaluation of requested output variables
+#
+# Each output variable is produced by a phase, and each phase lists the phases
+# it needs. Running a set of variables runs only the phases they depend on,
+# each at most once, so e.g. grade matrices alone never touch BrowseEvents.
+# Learner covariates come from the raw files that the matrices don't use and
+# are loaded lazily, one pass per file the first time one of them is asked for.
+#
+
+import csv
+from collections import defaultdict
+
+import ingest
+
+# Learner covariates: name -> (raw file kind, column, how values are combined per learner)
+COVARIATES = {
+    'enrolled': ('Registrations', 'enrolled', 'first'),
+    'certificate_grade': ('Certificates', 'grade', 'first'),
+    'certificate_granted': ('Certificates', 'certificate_granted', 'first'),
+    'progress_views': ('ViewProgress', None, 'count'),
+    'video_events': ('VideoEvents', None, 'count'),
+    'videos_watched': ('VideoEvents', 'video_id', 'distinct'),
+}
+
+
+class Pipeline(object):
+    '''
+    Runs the phases behind requested variables in dependency order. Phases maps
+    phase name -> (required phase names, callable); produces maps variable ->
+    phase name.
+    '''
+
+    def __init__(self, phases, produces):
+        self.phases = phases
+        self.produces = produces
+        self.done = set()
+
+    def plan(self, variables):
+        '''
+        The phases needed for variables, in an order that respects dependencies.
+        '''
+        order = list()
+
+        def visit(phase):
+            if phase in order:
+                return
+            for required in self.phases[phase][0]:
+                visit(required)
+            order.append(phase)
+
+        for variable in variables:
+            if variable not in self.produces:
+                raise ValueError("Unknown variable: %s" % variable)
+            visit(self.produces[variable])
+        return order
+
+    def run(self, variables, report=None):
+        '''
+        Run every phase needed for variables that hasn't run yet, calling
+        report(phase) after each one if given.
+        '''
+        for phase in self.plan(variables):
+            if phase not in self.done:
+                self.phases[phase][1]()
+                self.done.add(phase)
+                if report is not None:
+                    report(phase)
+
+
+class Covariates(object):
+    '''
+    Per-learner covariates read on demand from a course's raw files, with
+    path(kind) giving the raw file for each kind.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.loaded = dict()
+
+    def load(self, kind):
+        '''
+        Compute every covariate from one raw file kind in a single pass over it.
+        '''
+        names = [name for name, (source, _, _) in COVARIATES.items() if source == kind]
+        values = dict((name, dict()) for name in names)
+        distinct = defaultdict(set)
+        for row in ingest.read_rows(self.path(kind)):
+            learner = row['anon_screen_name']
+            for name in names:
+                _, column, combine = COVARIATES[name]
+                if combine == 'first':
+                    values[name].setdefault(learner, row[column])
+                elif combine == 'count':
+                    values[name][learner] = values[name].get(learner, 0) + 1
+                else:
+                    distinct[(name, learner)].add(row[column])
+        for (name, learner), seen in distinct.items():
+            values[name][learner] = len(seen)
+        self.loaded.update(values)
+
+    def values(self, name):
+        '''
+        Learner -> value for one covariate, loading its raw file if needed.
+        '''
+        if name not in self.loaded:
+            self.load(COVARIATES[name][0])
+        return self.loaded[name]
+
+
+def write_covariates(outfile, covariates, names, na='NA'):
+    '''
+    Write the named covariates as one CSV with a row per learner that has any of them.
+    '''
+    columns = [covariates.values(name) for name in names]
+    learners = sorted(set(learner for column in columns for learner in column))
+    with open(outfile, 'wb') as out:
+        wrt = csv.writer(out)
+        wrt.writerow(['learner'] + list(names))
+        for learner in learners:
+            wrt.writerow([learner] + [column.get(learner, na) for column in columns])
@@ -0,0 +1,138 @@
+# On-disk cache of decoded raw file columns
+#
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+
+class RawCache(object):
+    '''
+    Stores the decoded, typed columns of raw CSV files as .npy arrays that are
+    memory-mapped on later runs. Entries are keyed by the raw file's path, size,
+    mtime and content hash, plus a variant string describing how it was decoded,
+    so any change to the file or its decoding misses the cache. The
+    cache directory is kept under max_bytes by evicting least recently used entries.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+
+    @staticmethod
+    def contentHash(path, blocksize=1 << 20):
+        '''
+        SHA-1 of a file's contents, read in blocks.
+        '''
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+
+    def key(self, path, kind, variant=''):
+        '''
+        Cache key for a raw file of the given kind in its current state.
+        '''
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        ident = '|'.join([kind, variant, path, str(st.st_size), repr(st.st_mtime), self.contentHash(path)])
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+
+    def load(self, path, kind, variant='', key=None):
+        '''
+        Return (arrays, vocabularies) cached for a raw file, or None on a miss.
+        Arrays are memory-mapped read-only. Pass key (from key()) to skip
+        hashing the file again when it is already known.
+        '''
+        entry = os.path.join(self.cache_dir, key or self.key(path, kind, variant))
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return None
+        arrays = dict((name, np.load(os.path.join(entry, '%s.npy' % name), mmap_mode='r')) for name in meta['arrays'])
+        os.utime(entry, None)  # Mark as recently used
+        return arrays, meta['vocabularies']
+
+
+    def store(self, path, kind, arrays, vocabularies, variant='', key=None):
+        '''
+        Cache the columns of a raw file, replacing stale entries for the same file.
+        Key is as for load().
+        '''
+        key = key or self.key(path, kind, variant)
+        self.invalidate(path, kind, keep=key)
+
+        # Write to a scratch directory first so readers never see a partial entry
+        tmp = tempfile.mkdtemp(prefix='tmp-', dir=self.cache_dir)
+        for name, column in arrays.items():
+            np.save(os.path.join(tmp, '%s.npy' % name), np.asarray(column))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'path': os.path.realpath(path), 'kind': kind, 'created': time.time(),
+                       'arrays': sorted(arrays), 'vocabularies': vocabularies}, f)
+        try:
+            os.rename(tmp, os.path.join(self.cache_dir, key))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)  # Another process stored it first
+        self.evict()
+
+
+    def entries(self):
+        '''
+        List (path, last used, size in bytes, meta) for every complete cache entry.
+        '''
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            try:
+                with open(os.path.join(entry, 'meta.json'), 'r') as f:
+                    meta = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue  # Scratch directory or unreadable entry
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((entry, os.path.getmtime(entry), size, meta))
+        return entries
+
+
+    def invalidate(self, path, kind, keep=None):
+        '''
+        Remove cached entries for a raw file, except the entry named keep.
+        '''
+        path = os.path.realpath(path)
+        for entry, _, _, meta in self.entries():
+            if meta['path'] == path and meta['kind'] == kind and os.path.basename(entry) != keep:
+                shutil.rmtree(entry, ignore_errors=True)
+
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache fits in max_bytes.
+        '''
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries(), key=lambda e: e[1])
+        total = sum(e[2] for e in entries)
+        for entry, _, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+    def clear(self):
+        '''
+        Remove every cache entry.
+        '''
+        for entry, _, _, _ in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
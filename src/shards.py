@@ -0,0 +1,62 @@
+# Hash partitioning of raw files by learner for out-of-core processing
+#
+# Every per-learner computation in ItemMatrixComputer is independent of other
+# learners, so a course too large to hold in memory can be split into shards
+# by anon_screen_name, each shard processed on its own, and the per-shard
+# matrix rows concatenated. Row order within a shard follows the input, so a
+# time-ordered BrowseEvents export stays time-ordered in every shard.
+#
+
+import csv
+import os
+import zlib
+
+import ingest
+
+
+def shard_of(key, n):
+    '''
+    Shard number for a key; stable across runs, processes and platforms.
+    '''
+    return (zlib.crc32(key) & 0xffffffff) % n
+
+
+def shard_dirs(root, n):
+    '''
+    Create and return n shard directories under root.
+    '''
+    dirs = [os.path.join(root, 'shard%03d' % k) + os.sep for k in range(n)]
+    for path in dirs:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    return dirs
+
+
+def partition(path, dirs, key='anon_screen_name', visit=None):
+    '''
+    Split a raw file into one file per shard directory in a single streaming
+    pass, by hash of the key column. Shard files keep the raw file's name and
+    get a header; course ID fixups are applied on the way through. If given,
+    visit(row) is called with each row as a dict. Returns rows per shard.
+    '''
+    name = os.path.basename(path)
+    counts = [0] * len(dirs)
+    with ingest.open_raw(path) as (header, rows):
+        idx = header.index(key)
+        files = [open(os.path.join(d, name), 'wb') for d in dirs]
+        try:
+            writers = [csv.writer(f) for f in files]
+            for wrt in writers:
+                wrt.writerow(header)
+            for row in rows:
+                if not row:
+                    continue
+                if visit is not None:
+                    visit(dict(zip(header, row + [None] * (len(header) - len(row)))))
+                shard = shard_of(row[idx], len(dirs))
+                writers[shard].writerow(row)
+                counts[shard] += 1
+        finally:
+            for f in files:
+                f.close()
+    return counts
@@ -0,0 +1,205 @@
+# Append-only sparse matrix store pooling many courses
+#
+# Layout of a store directory:
+#   manifest.json   index sizes and the list of live segments
+#   learners.txt    global learner index, shared by all courses
+#   items.txt       global item index; items are namespaced as <course>/<item>
+#   codes.txt       global codes for string values such as grades
+#   seg<NNNNN>/     one course's <field>.npy triplets (row, col, value), with
+#                   rows and columns in the global indexes
+# Appending a course writes a new segment and extends the index files; data
+# already in the store is never rewritten. Re-appending a course replaces its
+# previous segment. The manifest is replaced atomically, and index files are
+# cut back to the sizes it records, so an interrupted append leaves the store
+# as it was.
+#
+
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+import export
+
+
+def item_label(course_id, item):
+    return '%s/%s' % (course_id, item)
+
+
+class SparseStore(object):
+    '''
+    Learner-by-item triplet matrices for many courses, with a global learner
+    index and per-course item namespaces. Select reads only the segments of
+    the requested courses, memory-mapped, so column subsets are cheap.
+    '''
+
+    INDEXES = ['learners', 'items', 'codes']
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.reload()
+
+    def reload(self):
+        '''
+        Read the manifest and the part of each index file it covers.
+        '''
+        manifest = os.path.join(self.path, 'manifest.json')
+        if os.path.exists(manifest):
+            with open(manifest, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'segments': [], 'next_segment': 0, 'sizes': dict((name, 0) for name in self.INDEXES)}
+        self.index = dict()
+        for name in self.INDEXES:
+            path = os.path.join(self.path, '%s.txt' % name)
+            labels = export.read_index(path) if os.path.exists(path) else []
+            self.index[name] = labels[:self.manifest['sizes'][name]]
+        self.position = dict((name, dict((label, n) for n, label in enumerate(labels))) for name, labels in self.index.items())
+
+    def courses(self):
+        return [segment['course'] for segment in self.manifest['segments']]
+
+    def learners(self):
+        return self.index['learners']
+
+    def items(self, courses=None):
+        '''
+        Global item labels, or (column, label) pairs for the given courses only.
+        '''
+        if courses is None:
+            return self.index['items']
+        prefixes = tuple(item_label(course, '') for course in courses)
+        return [(col, label) for col, label in enumerate(self.index['items']) if label.startswith(prefixes)]
+
+    def codes(self):
+        return self.index['codes']
+
+    def coded(self, field):
+        '''
+        Whether values of field are codes into codes().
+        '''
+        return any(field in segment['coded'] for segment in self.manifest['segments'])
+
+    def fields(self):
+        return sorted(set(field for segment in self.manifest['segments'] for field in segment['fields']))
+
+    @contextmanager
+    def lock(self):
+        '''
+        Hold an exclusive lock on the store, so concurrent appends take turns.
+        '''
+        with open(os.path.join(self.path, '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self.reload()
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def extend(self, name, labels):
+        '''
+        Map labels to global positions in an index, adding new ones at the end.
+        '''
+        position = self.position[name]
+        codes = np.empty(len(labels), dtype=np.int64)
+        for n, label in enumerate(labels):
+            if label not in position:
+                position[label] = len(self.index[name])
+                self.index[name].append(label)
+            codes[n] = position[label]
+        return codes
+
+    def append_index(self, name, labels):
+        '''
+        Append labels to an index file, first cutting it back to the size in the manifest.
+        '''
+        path = os.path.join(self.path, '%s.txt' % name)
+        with open(path, 'ab') as f:
+            f.truncate(self.manifest['bytes'][name] if 'bytes' in self.manifest else 0)
+            for label in labels:
+                f.write('%s\n' % label)
+            return f.tell()
+
+    def append(self, course_id, export_dir, fields=None):
+        '''
+        Add a course's sparse export (as written by write_sparse) to the store as
+        a new segment, replacing any earlier segment for the course. Returns the
+        segment's manifest entry.
+        '''
+        with self.lock():
+            learners = self.extend('learners', export.read_index(os.path.join(export_dir, 'learners.txt')))
+            items = self.extend('items', [item_label(course_id, item) for item in export.read_index(os.path.join(export_dir, 'items.txt'))])
+            codes = self.extend('codes', export.read_index(os.path.join(export_dir, 'codes.txt')))
+            if fields is None:
+                fields = sorted(name[:-len('.npy')] for name in os.listdir(export_dir) if name.endswith('.npy'))
+
+            # Write the segment with rows, columns and codes in the global indexes,
+            # in a scratch directory so an interrupted append leaves no seg<N> behind
+            name = 'seg%05d' % self.manifest['next_segment']
+            segdir = os.path.join(self.path, name)
+            tmp = tempfile.mkdtemp(prefix='tmp-', dir=self.path)
+            try:
+                entries = 0
+                coded_fields = list()
+                for field in fields:
+                    triplets = export.read_sparse(export_dir, field)
+                    coded = triplets.dtype['value'] == np.dtype('<i2')
+                    out = np.empty(len(triplets), dtype=[('row', '<i4'), ('col', '<i4'), ('value', '<i4' if coded else triplets.dtype['value'])])
+                    out['row'] = learners[triplets['row']]
+                    out['col'] = items[triplets['col']]
+                    out['value'] = codes[triplets['value']] if coded else triplets['value']
+                    if coded:
+                        coded_fields.append(field)
+                    np.save(os.path.join(tmp, '%s.npy' % field), out)
+                    entries += len(out)
+                if os.path.isdir(segdir):
+                    shutil.rmtree(segdir)  # Left by an append that died between renaming its segment and the manifest
+                os.rename(tmp, segdir)
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)  # Gone already unless the append failed
+            segment = {'course': course_id, 'dir': name, 'fields': fields, 'coded': coded_fields, 'entries': entries}
+
+            # Extend the indexes, then publish the segment
+            sizes = dict((index, len(self.index[index])) for index in self.INDEXES)
+            written = dict((index, self.append_index(index, self.index[index][self.manifest['sizes'][index]:])) for index in self.INDEXES)
+            replaced = [s for s in self.manifest['segments'] if s['course'] == course_id]
+            manifest = dict(self.manifest, sizes=sizes, bytes=written, next_segment=self.manifest['next_segment'] + 1,
+                            segments=[s for s in self.manifest['segments'] if s['course'] != course_id] + [segment])
+            tmp = os.path.join(self.path, 'manifest.json.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f, indent=4)
+            os.rename(tmp, os.path.join(self.path, 'manifest.json'))
+            self.manifest = manifest
+            for old in replaced:
+                shutil.rmtree(os.path.join(self.path, old['dir']), ignore_errors=True)
+            return segment
+
+    def select(self, field, courses=None, items=None):
+        '''
+        Triplets (row, col, value) for field in the global indexes, from only
+        the segments of the given courses and, if items (global column numbers
+        or item labels) are given, only those columns. Coded values index codes().
+        '''
+        pieces = list()
+        cols = None
+        if items is not None:
+            cols = np.array([self.position['items'][item] if isinstance(item, basestring) else item for item in items], dtype=np.int64)
+        for segment in self.manifest['segments']:
+            if (courses is not None and segment['course'] not in courses) or field not in segment['fields']:
+                continue
+            triplets = np.load(os.path.join(self.path, segment['dir'], '%s.npy' % field), mmap_mode='r')
+            if cols is not None:
+                triplets = triplets[np.in1d(triplets['col'], cols)]
+            pieces.append(triplets)
+        if not pieces:
+            return np.empty(0, dtype=[('row', '<i4'), ('col', '<i4'), ('value', '<i4')])
+        if len(pieces) == 1:
+            return pieces[0]
+        dtype = [('row', '<i4'), ('col', '<i4'), ('value', np.result_type(*[piece.dtype['value'] for piece in pieces]))]
+        return np.concatenate([piece.astype(dtype) for piece in pieces])
@@ -0,0 +1,77 @@
+# Fast decoding of SQL export timestamps to Unix epoch seconds
+#
+# Timestamps come from EdxTrackEvent as 'YYYY-MM-DD HH:MM:SS.ffffff' and are
+# decoded as UTC to whole seconds. This matches what convertTime's old
+# strptime/mktime/fromtimestamp round trip produced, except near daylight
+# saving transitions, where that round trip depended on the local timezone.
+#
+
+import calendar
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Positions of the digits and separators in 'YYYY-MM-DD HH:MM:SS'
+DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+SEPARATORS = {4: '-', 7: '-', 10: ' ', 13: ':', 16: ':'}
+
+_days = dict()
+
+
+def day(date):
+    '''
+    Epoch seconds at midnight UTC of a 'YYYY-MM-DD' date, cached per date.
+    '''
+    try:
+        return _days[date]
+    except KeyError:
+        _days[date] = calendar.timegm(time.strptime(date, '%Y-%m-%d'))
+        return _days[date]
+
+
+def decode(timestamp):
+    '''
+    Decode one timestamp to epoch seconds, reusing the cached date prefix.
+    '''
+    if len(timestamp) < 19 or any(timestamp[i] != sep for i, sep in SEPARATORS.items()):
+        raise ValueError("time data %r does not match format '%%Y-%%m-%%d %%H:%%M:%%S.%%f'" % timestamp)
+    return float(day(timestamp[:10]) + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19]))
+
+
+def encode(seconds):
+    '''
+    Format epoch seconds as 'YYYY-MM-DD HH:MM:SS' (UTC), the prefix that decode reads.
+    Timestamps in this format sort as strings in time order.
+    '''
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+def decode_column(timestamps):
+    '''
+    Decode a sequence of timestamps to a float64 array of epoch seconds.
+    Parses digits for the whole column at once and converts each distinct
+    date only once. Falls back to decode() per value without NumPy.
+    '''
+    if np is None:
+        return [decode(timestamp) for timestamp in timestamps]
+
+    stamps = np.array(timestamps, dtype='S19')
+    if not len(stamps):
+        return np.zeros(0)
+    chars = stamps.view(np.uint8).reshape(-1, 19)
+
+    # Check the layout for every row before trusting the digit arithmetic
+    digits = chars[:, DIGITS].astype(np.int64) - ord('0')
+    bad = ((digits < 0) | (digits > 9)).any(axis=1)
+    for i, sep in SEPARATORS.items():
+        bad |= chars[:, i] != ord(sep)
+    if bad.any():
+        raise ValueError("time data %r does not match format '%%Y-%%m-%%d %%H:%%M:%%S.%%f'" % timestamps[int(bad.nonzero()[0][0])])
+
+    seconds = (digits[:, 8] * 10 + digits[:, 9]) * 3600 + (digits[:, 10] * 10 + digits[:, 11]) * 60 + digits[:, 12] * 10 + digits[:, 13]
+    dates, inverse = np.unique(stamps.astype('S10'), return_inverse=True)
+    days = np.array([day(date if isinstance(date, str) else date.decode('ascii')) for date in dates.tolist()], dtype=np.int64)
+    return (days[inverse] + seconds).astype(np.float64)